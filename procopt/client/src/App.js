@@ -1,4 +1,4 @@
-import React, { useState, useEffect } from 'react';
+import React, { useState, useEffect, useRef } from 'react';
 import Chat from './Chat';
 
 function App() {
@@ -73,6 +73,7 @@ function App() {
         // Always show as processing when a file is uploaded since transcription starts immediately
         if (job.processMap) return progressMessages.transcription.complete;
         // Always show processing for transcription since it starts immediately after upload
+        if (job.tilesTotal) return `${progressMessages.transcription.processing} (${job.tilesDone}/${job.tilesTotal} sections)`;
         return progressMessages.transcription.processing;
       
       case 'bottlenecks':
@@ -88,80 +89,105 @@ function App() {
     }
   };
 
-  // Polling effect for all jobs
-  useEffect(() => {
-    if (jobs.length === 0) return;
+  // Latest jobs for the event handlers below, which outlive a single render
+  const jobsRef = useRef(jobs);
+  jobsRef.current = jobs;
+  // Open event streams keyed by run id
+  const eventSourcesRef = useRef({});
 
-    const interval = setInterval(async () => {
-      // Create a copy of jobs to update
-      const updatedJobs = [...jobs];
-      let hasUpdates = false;
+  // Fetch a run after its status changed and update the job, triggering the next step if needed
+  const refreshJob = async (runId) => {
+    try {
+      const response = await fetch(`${API_URL}/runs/${runId}`);
+      const data = await response.json();
+      const job = jobsRef.current.find(job => job.runId === runId);
+      if (!job) return;
 
-      // Check each job that's not complete
-      for (let i = 0; i < updatedJobs.length; i++) {
-        const job = updatedJobs[i];
-        
-        // Skip jobs that are already complete
-        if (job.status === 'complete' || job.status?.includes('failed')) continue;
+      // Calculate the current step based on available data
+      let newCurrentStep = job.currentStep;
+      if (data.transcription) newCurrentStep = Math.max(newCurrentStep, 2);
+      if (data.bottlenecks) newCurrentStep = Math.max(newCurrentStep, 3);
+      if (data.improvements) newCurrentStep = Math.max(newCurrentStep, 4);
 
-        try {
-          const response = await fetch(`${API_URL}/runs/${job.runId}`);
-          const data = await response.json();
-          
-          // Update job data
-          if (data.status !== job.status || 
-              data.transcription !== job.processMap ||
-              data.bottlenecks !== job.bottlenecks ||
-              data.improvements !== job.improvements) {
-            
-            // Calculate the current step based on available data
-            let newCurrentStep = job.currentStep;
-            if (data.transcription) newCurrentStep = Math.max(newCurrentStep, 2);
-            if (data.bottlenecks) newCurrentStep = Math.max(newCurrentStep, 3);
-            if (data.improvements) newCurrentStep = Math.max(newCurrentStep, 4);
-            
-            updatedJobs[i] = {
-              ...job,
-              status: data.status,
-              processMap: data.transcription || job.processMap,
-              bottlenecks: data.bottlenecks || job.bottlenecks,
-              improvements: data.improvements || job.improvements,
-              currentStep: newCurrentStep,
-              // Keep transcriptionInProgress true until we get the transcription
-              transcriptionInProgress: data.transcription ? false : true
-            };
-            hasUpdates = true;
-            
-            // Automatically trigger the next step if needed
-            if (data.transcription && !data.bottlenecks && !job.bottlenecksRequested) {
-              // Mark this job as having bottlenecks requested to prevent multiple requests
-              updatedJobs[i].bottlenecksRequested = true;
-              // Queue the bottlenecks identification (will run after the state update)
-              setTimeout(() => identifyBottlenecks(job.runId), 1000);
-            }
-            
-            if (data.bottlenecks && !data.improvements && !job.improvementsRequested) {
-              // Mark this job as having improvements requested to prevent multiple requests
-              updatedJobs[i].improvementsRequested = true;
-              // Queue the improvements suggestion (will run after the state update)
-              setTimeout(() => suggestImprovements(job.runId), 1000);
-            }
-          }
-        } catch (error) {
-          console.error(`Error polling for updates for job ${job.runId}:`, error);
-        }
-      }
+      const updates = {
+        status: data.status,
+        processMap: data.transcription || job.processMap,
+        bottlenecks: data.bottlenecks || job.bottlenecks,
+        improvements: data.improvements || job.improvements,
+        currentStep: newCurrentStep,
+        // Keep transcriptionInProgress true until we get the transcription
+        transcriptionInProgress: data.transcription ? false : true
+      };
 
-      // Only update state if there were changes
-      if (hasUpdates) {
-        setJobs(updatedJobs);
+      // Automatically trigger the next step if needed
+      if (data.transcription && !data.bottlenecks && !job.bottlenecksRequested) {
+        // Mark this job as having bottlenecks requested to prevent multiple requests
+        updates.bottlenecksRequested = true;
+        setTimeout(() => identifyBottlenecks(runId), 0);
       }
-    }, 2000); // Poll every 2 seconds
+      if (data.bottlenecks && !data.improvements && !job.improvementsRequested) {
+        // Mark this job as having improvements requested to prevent multiple requests
+        updates.improvementsRequested = true;
+        setTimeout(() => suggestImprovements(runId), 0);
+      }
+
+      setJobs(prevJobs =>
+        prevJobs.map(job => job.runId === runId ? { ...job, ...updates } : job)
+      );
+    } catch (error) {
+      console.error(`Error fetching updates for job ${runId}:`, error);
+    }
+  };
+
+  // Subscribe to the server's event stream of every job that's not complete
+  useEffect(() => {
+    const sources = eventSourcesRef.current;
 
-    // Cleanup function to clear interval when component unmounts
-    return () => clearInterval(interval);
+    jobs.forEach(job => {
+      // `<step>_failed` is final: while the job queue will still retry a step the run is `<step>_retrying`
+      const finished = job.status === 'complete' || job.status?.endsWith('_failed');
+      if (finished && sources[job.runId]) {
+        sources[job.runId].close();
+        delete sources[job.runId];
+      } else if (!finished && !sources[job.runId]) {
+        const source = new EventSource(`${API_URL}/runs/${job.runId}/events`);
+        source.addEventListener('status', (event) => {
+          if (JSON.parse(event.data).status === 'transcribing') {
+            // A (re)started transcription sends every tile again
+            setJobs(prevJobs =>
+              prevJobs.map(prevJob => prevJob.runId === job.runId ? { ...prevJob, tilesDone: 0 } : prevJob)
+            );
+          }
+          refreshJob(job.runId);
+        });
+        source.addEventListener('tile', (event) => {
+          const tile = JSON.parse(event.data);
+          setJobs(prevJobs =>
+            prevJobs.map(prevJob => prevJob.runId === job.runId
+              ? { ...prevJob, tilesDone: (prevJob.tilesDone || 0) + 1, tilesTotal: tile.total }
+              : prevJob)
+          );
+        });
+        source.addEventListener('step_error', (event) => {
+          // A pipeline step failed; the `status` event that follows says whether it will be retried
+          const { step, message } = JSON.parse(event.data);
+          console.error(`Step ${step} failed for job ${job.runId}: ${message}`);
+        });
+        source.addEventListener('error', () => {
+          // Connection errors only: the browser reconnects on its own (resuming from the last event id)
+          console.error(`Event stream error for job ${job.runId}`);
+        });
+        sources[job.runId] = source;
+      }
+    });
   }, [jobs, API_URL]);
 
+  // Close all event streams when the component unmounts
+  useEffect(() => {
+    const sources = eventSourcesRef.current;
+    return () => Object.values(sources).forEach(source => source.close());
+  }, []);
+
   const handleFileUpload = async (event) => {
     const uploadedFiles = event.target.files;
     if (uploadedFiles.length === 0) return;
@@ -11,6 +11,8 @@ const Chat = ({ selectedJob }) => {
     }
   ]);
   const [newMessage, setNewMessage] = useState('');
+  // Server-side chat session of each run, keyed by run id
+  const [sessionIds, setSessionIds] = useState({});
   const [isChatHidden, setIsChatHidden] = useState(false);
 
   // Toggle chat visibility and update main content padding
@@ -67,34 +69,67 @@ const Chat = ({ selectedJob }) => {
     setMessages([...messages, userMessage]);
     setNewMessage('');
     
-    // Send request to server
+    // Add an empty assistant message that the streamed text is appended to
+    const assistantId = messages.length + 2;
+    setMessages(prevMessages => [...prevMessages, { id: assistantId, role: 'assistant', text: '' }]);
+    const appendToAssistant = (text) => {
+      setMessages(prevMessages => prevMessages.map(message =>
+        message.id === assistantId ? { ...message, text: message.text + text } : message
+      ));
+    };
+    const removeAssistant = () => {
+      setMessages(prevMessages => prevMessages.filter(message => message.id !== assistantId));
+    };
+
+    // Send request to server, streaming the response as server-sent events
     fetch(`${API_URL}/chat_response`, {
       method: 'POST',
       body: JSON.stringify({ 
-        conversation: [...messages, userMessage],
+        message: userMessage.text,
         runId: selectedJob?.runId,
+        sessionId: sessionIds[selectedJob?.runId],
+        stream: true,
        }),
       headers: {
         'Content-Type': 'application/json'
       }
     })
-    .then(response => response.json())
-    .then(data => {
-      console.log('Received response from server:', data);
-      if (data.error) {
-        // Received error from server
+    .then(async response => {
+      if (!response.headers.get('Content-Type')?.includes('text/event-stream')) {
+        // Validation errors are still returned as JSON
+        const data = await response.json();
+        console.log('Received response from server:', data);
+        removeAssistant();
         // TODO -- replace alert with a toast notification
-        alert(data.error);
+        alert(data.error || 'Unexpected response from server');
         return;
-      } else {
-        // Received valid response from server, add to messages
-        const assistantMessage = {
-          id: messages.length + 2,
-          role: 'assistant',
-          text: data.text
-        };
-      
-        setMessages(prevMessages => [...prevMessages, assistantMessage]);
+      }
+
+      const reader = response.body.getReader();
+      const decoder = new TextDecoder();
+      let buffer = '';
+      while (true) {
+        const { done, value } = await reader.read();
+        if (done) break;
+        buffer += decoder.decode(value, { stream: true });
+
+        // Events are separated by a blank line
+        const events = buffer.split('\n\n');
+        buffer = events.pop();
+        for (const rawEvent of events) {
+          const lines = rawEvent.split('\n');
+          const event = lines.find(line => line.startsWith('event: '))?.slice(7);
+          const data = JSON.parse(lines.find(line => line.startsWith('data: '))?.slice(6) || '{}');
+          if (event === 'session') {
+            setSessionIds(prevSessionIds => ({ ...prevSessionIds, [selectedJob.runId]: data.sessionId }));
+          } else if (event === 'delta') {
+            appendToAssistant(data.text);
+          } else if (event === 'done') {
+            console.log('Chat response stats:', data);
+          } else if (event === 'error') {
+            alert(data.error);
+          }
+        }
       }
     })
     .catch(error => {
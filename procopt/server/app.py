@@ -1,26 +1,71 @@
 from flask import Flask
 import os
 from flask_cors import CORS
-from procopt.server.routes import main, runs, uploads, chat
+from procopt.server.routes import main, runs, uploads, chat, jobs, batches
 from dotenv import load_dotenv
-from procopt.server.db import db
+from procopt.server.db import DB_MAX_OVERFLOW, DB_POOL_SIZE, SQLITE_BUSY_TIMEOUT_SECONDS, configure_engine, db, engine_options, migrate_schema
+from procopt.server.chat_sessions import CHAT_FULL_CONTEXT_TOKENS, CHAT_HISTORY_TOKENS, CHAT_RETRIEVAL_TOP_K
+from procopt.server.models import Base
+from procopt.server.jobs import JOB_HEARTBEAT_SECONDS, JOB_LEASE_SECONDS, JOB_MAX_ATTEMPTS, JOB_RETRY_BACKOFF_SECONDS, JOB_WORKERS, start_job_workers
+from procopt.server.encoding import DEFAULT_TILE_FORMAT, DEFAULT_TILE_QUALITY
+from procopt.server.merging import MERGE_GROUP_TILES, MERGE_MAX_PROMPT_TOKENS
+from procopt.server.pipeline import MERGE_MODE, TRANSCRIBE_CONCURRENCY, TRANSCRIBE_MODE
+from procopt.server.tiling import DEFAULT_TILING_STRATEGY
+from procopt.server.vector_text import VECTOR_TEXT_MIN_CHARS
+from procopt.server.utils import BLANK_INK_THRESHOLD, BLANK_MIN_INK_RATIO, BLANK_MIN_STD, PDF_MAX_DPI, PDF_PIXEL_BUDGET
 load_dotenv()
 
 # Assert OpenAI client is set
 if not os.getenv('OPENAI_API_KEY'):
     raise ValueError("OPENAI_API_KEY not found in environment variables")
 
-def create_app():
+def create_app(start_workers: bool = True):
     app = Flask(__name__, static_folder='client/build')
     
     basedir = os.path.abspath(os.path.dirname(__file__))
     app.config.update(
-        SQLALCHEMY_DATABASE_URI=f"sqlite:///{os.path.join(basedir, 'database.sqlite')}",
+        SQLALCHEMY_DATABASE_URI=os.getenv("SQLALCHEMY_DATABASE_URI", f"sqlite:///{os.path.join(basedir, 'database.sqlite')}"),
         SQLALCHEMY_TRACK_MODIFICATIONS=False,
+        SQLITE_BUSY_TIMEOUT_SECONDS=float(os.getenv("SQLITE_BUSY_TIMEOUT_SECONDS", SQLITE_BUSY_TIMEOUT_SECONDS)),
+        DB_POOL_SIZE=int(os.getenv("DB_POOL_SIZE", DB_POOL_SIZE)),
+        DB_MAX_OVERFLOW=int(os.getenv("DB_MAX_OVERFLOW", DB_MAX_OVERFLOW)),
         UPLOAD_FOLDER=os.path.join(basedir, "uploads"),
+        TRACING=os.getenv("TRACING", "true").lower() == "true",
+        TRACE_FOLDER=os.getenv("TRACE_FOLDER", os.path.join(basedir, "traces")),
+        TRANSCRIBE_CONCURRENCY=int(os.getenv("TRANSCRIBE_CONCURRENCY", TRANSCRIBE_CONCURRENCY)),
+        TRANSCRIBE_MODE=os.getenv("TRANSCRIBE_MODE", TRANSCRIBE_MODE),
+        MERGE_MODE=os.getenv("MERGE_MODE", MERGE_MODE),
+        MERGE_MAX_PROMPT_TOKENS=int(os.getenv("MERGE_MAX_PROMPT_TOKENS", MERGE_MAX_PROMPT_TOKENS)),
+        MERGE_GROUP_TILES=int(os.getenv("MERGE_GROUP_TILES", MERGE_GROUP_TILES)),
+        JOB_WORKERS=int(os.getenv("JOB_WORKERS", JOB_WORKERS)),
+        JOB_MAX_ATTEMPTS=int(os.getenv("JOB_MAX_ATTEMPTS", JOB_MAX_ATTEMPTS)),
+        JOB_LEASE_SECONDS=int(os.getenv("JOB_LEASE_SECONDS", JOB_LEASE_SECONDS)),
+        JOB_HEARTBEAT_SECONDS=int(os.getenv("JOB_HEARTBEAT_SECONDS", JOB_HEARTBEAT_SECONDS)),
+        JOB_RETRY_BACKOFF_SECONDS=int(os.getenv("JOB_RETRY_BACKOFF_SECONDS", JOB_RETRY_BACKOFF_SECONDS)),
+        TILE_FORMAT=os.getenv("TILE_FORMAT", DEFAULT_TILE_FORMAT),
+        TILE_QUALITY=int(os.getenv("TILE_QUALITY", DEFAULT_TILE_QUALITY)),
+        TILE_COLOR_MODE=os.getenv("TILE_COLOR_MODE", "rgb"),
+        TILE_DOWNSCALE_TO_MODEL=os.getenv("TILE_DOWNSCALE_TO_MODEL", "true").lower() == "true",
+        TILE_MAX_BYTES=int(os.getenv("TILE_MAX_BYTES")) if os.getenv("TILE_MAX_BYTES") else None,
+        TILE_MAX_TOKENS=int(os.getenv("TILE_MAX_TOKENS")) if os.getenv("TILE_MAX_TOKENS") else None,
+        TILING_STRATEGY=os.getenv("TILING_STRATEGY", DEFAULT_TILING_STRATEGY),
+        TILE_REUSE=os.getenv("TILE_REUSE", "true").lower() == "true",
+        BLANK_TILE_FILTER=os.getenv("BLANK_TILE_FILTER", "true").lower() == "true",
+        BLANK_TILE_INK_THRESHOLD=int(os.getenv("BLANK_TILE_INK_THRESHOLD", BLANK_INK_THRESHOLD)),
+        BLANK_TILE_MIN_INK_RATIO=float(os.getenv("BLANK_TILE_MIN_INK_RATIO", BLANK_MIN_INK_RATIO)),
+        BLANK_TILE_MIN_STD=float(os.getenv("BLANK_TILE_MIN_STD", BLANK_MIN_STD)),
+        PDF_PIXEL_BUDGET=int(os.getenv("PDF_PIXEL_BUDGET", PDF_PIXEL_BUDGET)),
+        PDF_MAX_DPI=int(os.getenv("PDF_MAX_DPI", PDF_MAX_DPI)),
+        VECTOR_TEXT_FAST_PATH=os.getenv("VECTOR_TEXT_FAST_PATH", "true").lower() == "true",
+        VECTOR_TEXT_MIN_CHARS=int(os.getenv("VECTOR_TEXT_MIN_CHARS", VECTOR_TEXT_MIN_CHARS)),
+        CHAT_HISTORY_TOKENS=int(os.getenv("CHAT_HISTORY_TOKENS", CHAT_HISTORY_TOKENS)),
+        CHAT_FULL_CONTEXT_TOKENS=int(os.getenv("CHAT_FULL_CONTEXT_TOKENS", CHAT_FULL_CONTEXT_TOKENS)),
+        CHAT_RETRIEVAL_TOP_K=int(os.getenv("CHAT_RETRIEVAL_TOP_K", CHAT_RETRIEVAL_TOP_K)),
     )
 
-    CORS(app)
+    app.config["SQLALCHEMY_ENGINE_OPTIONS"] = engine_options(app.config["SQLALCHEMY_DATABASE_URI"], app.config)
+
+    CORS(app, expose_headers=["X-Next-Cursor"])
     db.init_app(app)
 
     # Register routes
@@ -28,15 +73,23 @@ def create_app():
     app.register_blueprint(runs)
     app.register_blueprint(uploads)
     app.register_blueprint(chat)
+    app.register_blueprint(jobs)
+    app.register_blueprint(batches)
 
     os.makedirs(app.config["UPLOAD_FOLDER"], exist_ok=True)
 
-    # Create database tables
+    # Create or migrate database tables
     with app.app_context():
+        configure_engine(db.engine)
         db.create_all()
+        migrate_schema(db.engine, Base.metadata)
+
+    if start_workers:
+        start_job_workers(app)
 
     return app
 
 if __name__ == "__main__":
-    app = create_app()
+    # With the debug reloader only the child process (which serves requests) runs job workers
+    app = create_app(start_workers=os.environ.get("WERKZEUG_RUN_MAIN") == "true")
     app.run(debug=True, host='0.0.0.0', port=5001)
@@ -0,0 +1,104 @@
+"""Stress the database with N runs going through the whole pipeline in parallel, against a fake LLM backend.
+
+Every run is processed by its own job worker while reader threads poll the run listing and run details,
+so status writes, heartbeats, row saves and reads all contend for the database. Reports how many
+statements failed on a locked database and how many runs didn't complete.
+
+Usage:
+    python -m procopt.server.bench.db_stress --runs 16 --readers 4 --latency 0.05
+    SQLALCHEMY_DATABASE_URI=postgresql://... python -m procopt.server.bench.db_stress --runs 32
+"""
+import argparse
+import io
+import json
+import os
+import tempfile
+import threading
+import time
+from sqlalchemy import event
+from sqlalchemy.exc import OperationalError
+from procopt.server import pipeline
+from procopt.server.bench.fake_llm import FakeLLM
+from procopt.server.bench.transcribe import make_image_bytes
+
+def bench_db_stress(num_runs: int, num_readers: int, latency: float, width: int, height: int, timeout: float) -> dict:
+    os.environ["JOB_WORKERS"] = str(num_runs)
+    os.environ.setdefault("OPENAI_API_KEY", "bench")
+    os.environ.setdefault("LLM_CACHE_ENABLED", "false")
+    os.environ.setdefault("SQLALCHEMY_DATABASE_URI", f"sqlite:///{os.path.join(tempfile.mkdtemp(), 'db_stress.sqlite')}")
+    from procopt.server.app import create_app
+    from procopt.server.db import db
+
+    fake_llm = FakeLLM(latency=latency, jitter=latency / 2, seed=0)
+    pipeline.call_llm = fake_llm
+    app = create_app(start_workers=False)
+    lock_errors = [0]
+    with app.app_context():
+        @event.listens_for(db.engine, "handle_error")
+        def _count_lock_errors(context):
+            if isinstance(context.sqlalchemy_exception, OperationalError) and "locked" in str(context.original_exception):
+                lock_errors[0] += 1
+
+    from procopt.server.jobs import start_job_workers
+    workers = start_job_workers(app)
+    client = app.test_client()
+    image_bytes = make_image_bytes(width, height)
+    start = time.perf_counter()
+    response = client.post("/batches", data={
+        "files": [ (io.BytesIO(image_bytes), f"map_{idx}.png") for idx in range(num_runs) ],
+        "steps": "all",
+    }, content_type="multipart/form-data").get_json()
+    batch_id = response["batch_id"]
+
+    done = threading.Event()
+    reads = [0]
+    def _read() -> None:
+        with app.test_client() as reader:
+            while not done.is_set():
+                reader.get("/runs?limit=50")
+                for run_id in response["run_ids"]:
+                    reader.get(f"/runs/{run_id}")
+                reads[0] += 1 + len(response["run_ids"])
+    readers = [ threading.Thread(target=_read, daemon=True) for _ in range(num_readers) ]
+    for reader in readers:
+        reader.start()
+
+    # Failed jobs are retried with backoff, so give up after `timeout` rather than wait them all out
+    while time.perf_counter() - start < timeout:
+        batch = client.get(f"/batches/{batch_id}").get_json()
+        if batch["runs_in_progress"] == 0:
+            break
+        time.sleep(0.2)
+    elapsed = time.perf_counter() - start
+    done.set()
+    for reader in readers:
+        reader.join()
+    workers.stop(timeout=5)
+
+    statuses = [ client.get(f"/runs/{run_id}").get_json()["status"] for run_id in response["run_ids"] ]
+    return {
+        "database": app.config["SQLALCHEMY_DATABASE_URI"].split(":", 1)[0],
+        "runs": num_runs,
+        "readers": num_readers,
+        "completed": statuses.count("complete"),
+        "failed": num_runs - statuses.count("complete"),
+        "lock_errors": lock_errors[0],
+        "reads": reads[0],
+        "llm_calls": fake_llm.calls,
+        "wall_time_s": round(elapsed, 3),
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=16, help="Runs processed in parallel, one job worker each")
+    parser.add_argument("--readers", type=int, default=4, help="Threads polling the run listing and details")
+    parser.add_argument("--latency", type=float, default=0.05, help="Seconds per fake LLM call")
+    parser.add_argument("--width", type=int, default=2000)
+    parser.add_argument("--height", type=int, default=1500)
+    parser.add_argument("--timeout", type=float, default=300, help="Seconds to wait for the runs to finish")
+    args = parser.parse_args()
+
+    print(json.dumps(bench_db_stress(args.runs, args.readers, args.latency, args.width, args.height, args.timeout)))
+
+if __name__ == "__main__":
+    main()
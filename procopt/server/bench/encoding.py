@@ -0,0 +1,44 @@
+"""Compare tile encoding settings by bytes per tile, encode time and estimated image tokens.
+
+Usage:
+    python -m procopt.server.bench.encoding --image procopt/server/uploads/process.png
+"""
+import argparse
+import io
+import json
+from PIL import Image
+from procopt.server.encoding import TileEncoder, estimate_image_tokens
+from procopt.server.pipeline import BLOCK_SIZE
+from procopt.server.utils import grid_boxes, iter_blocks
+
+ENCODER_SETTINGS = [
+    { "image_format": "png", "downscale_to_model": False },
+    { "image_format": "png" },
+    { "image_format": "png", "color_mode": "grayscale" },
+    { "image_format": "png", "color_mode": "palette" },
+    { "image_format": "jpeg", "quality": 85 },
+    { "image_format": "jpeg", "quality": 70, "color_mode": "grayscale" },
+    { "image_format": "webp", "quality": 80 },
+    { "image_format": "webp", "quality": 80, "max_bytes": 60_000 },
+]
+
+def bench_encoding(img: Image.Image, settings: dict) -> dict:
+    encoder = TileEncoder(**settings)
+    tokens = 0
+    for block in iter_blocks(img, grid_boxes(img.width, img.height, BLOCK_SIZE)):
+        data, _ = encoder.encode(block)
+        tokens += estimate_image_tokens(*Image.open(io.BytesIO(data)).size)
+    return { "settings": settings, "image_tokens_est": tokens, **encoder.stats() }
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--image", required=True)
+    args = parser.parse_args()
+
+    with Image.open(args.image) as img:
+        img.load()
+        for settings in ENCODER_SETTINGS:
+            print(json.dumps(bench_encoding(img, settings)))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,112 @@
+import asyncio
+import random
+import re
+import threading
+import time
+from typing import Dict, List, Optional, Tuple, Union
+from pydantic import BaseModel
+from procopt.server.prompt_models import (
+    BottleneckModel,
+    BottleneckOutputModel,
+    ImprovementModel,
+    ImprovementOutputModel,
+    MergeTranscriptionOutputModel,
+    StepModel,
+    TranscriptionOutputModel,
+)
+
+CHARS_PER_TOKEN: int = 4 # Rough size of a token in generated JSON
+JSON_STEP_PATTERN = re.compile(r'"step_number":\s*(\d+)')
+MARKDOWN_STEP_PATTERN = re.compile(r'#### Step (\d+):')
+
+class FakeLLM:
+    """Drop-in replacement for `call_llm` that sleeps instead of calling a provider.
+
+    Each call sleeps for `latency` seconds (+/- `jitter`), plus the time to generate its output at
+    `tokens_per_second` if set, and raises with probability `error_rate`. Structured outputs are
+    synthesized from `response_format` so the pipeline can run end-to-end without network access:
+    each transcription returns `steps_per_response` steps, overlapping the previous call's by one
+    step like neighbouring tiles do, and merge calls return the steps named in their prompt.
+    """
+    def __init__(self, latency: float = 0.5, jitter: float = 0.0, error_rate: float = 0.0, seed: Optional[int] = None,
+                 tokens_per_second: Optional[float] = None, steps_per_response: int = 1):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.tokens_per_second = tokens_per_second
+        self.steps_per_response = steps_per_response
+        self.calls = 0
+        self.errors = 0
+        self.completion_tokens = 0
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def _next_call(self):
+        with self._lock:
+            self.calls += 1
+            call_idx = self.calls
+            delay = max(0.0, self.latency + self._rng.uniform(-self.jitter, self.jitter))
+            should_fail = self._rng.random() < self.error_rate
+            self.errors += should_fail
+        return call_idx, delay, should_fail
+
+    def _respond(self, messages: List[Dict[str, str]], response_format: Optional[BaseModel], call_idx: int) -> Tuple[Union[BaseModel, str], float]:
+        """The response and the seconds it takes to generate"""
+        response = fake_response(response_format, call_idx, self.steps_per_response, prompt_text(messages))
+        tokens = len(response.model_dump_json() if isinstance(response, BaseModel) else response) // CHARS_PER_TOKEN
+        with self._lock:
+            self.completion_tokens += tokens
+        return response, tokens / self.tokens_per_second if self.tokens_per_second else 0.0
+
+    def __call__(self, messages: List[Dict[str, str]], model: str = "fake", response_format: Optional[BaseModel] = None, **kwargs) -> Union[BaseModel, str]:
+        call_idx, delay, should_fail = self._next_call()
+        time.sleep(delay)
+        if should_fail:
+            raise RuntimeError(f"FakeLLM injected error on call #{call_idx}")
+        response, generation_seconds = self._respond(messages, response_format, call_idx)
+        time.sleep(generation_seconds)
+        return response
+
+    async def acall(self, messages: List[Dict[str, str]], model: str = "fake", response_format: Optional[BaseModel] = None, **kwargs) -> Union[BaseModel, str]:
+        """Async counterpart of `__call__`, a drop-in for `acall_llm`"""
+        call_idx, delay, should_fail = self._next_call()
+        await asyncio.sleep(delay)
+        if should_fail:
+            raise RuntimeError(f"FakeLLM injected error on call #{call_idx}")
+        response, generation_seconds = self._respond(messages, response_format, call_idx)
+        await asyncio.sleep(generation_seconds)
+        return response
+
+def prompt_text(messages: List[Dict]) -> str:
+    """Text parts of the last message"""
+    content = messages[-1].get("content", "") if messages else ""
+    if isinstance(content, str):
+        return content
+    return "\n".join(part.get("text", "") for part in content if part.get("type") == "text")
+
+def prompt_steps(text: str) -> List[StepModel]:
+    """Steps a merge prompt asks about: the JSON steps of a conflict, else the markdown steps of a full merge"""
+    numbers = [ int(number) for number in JSON_STEP_PATTERN.findall(text) ] or [ int(number) for number in MARKDOWN_STEP_PATTERN.findall(text) ]
+    return [ fake_step(number) for number in sorted(set(numbers)) ]
+
+def fake_step(step_number: int) -> StepModel:
+    return StepModel(
+        step_number=step_number,
+        name=f"Step {step_number}",
+        operator="Operator",
+        pain_points=[],
+        transitions=[f"Step {step_number + 1}"],
+    )
+
+def fake_response(response_format: Optional[BaseModel], call_idx: int, steps_per_response: int = 1, prompt: str = "") -> Union[BaseModel, str]:
+    """Build a minimal valid instance of `response_format`"""
+    if response_format is TranscriptionOutputModel:
+        first = (call_idx - 1) * max(1, steps_per_response - 1) + 1
+        return TranscriptionOutputModel(thinking="fake", is_valid=True, steps=[ fake_step(first + offset) for offset in range(max(1, steps_per_response)) ])
+    if response_format is MergeTranscriptionOutputModel:
+        return MergeTranscriptionOutputModel(thinking="fake", steps=prompt_steps(prompt) or [fake_step(call_idx)])
+    if response_format is BottleneckOutputModel:
+        return BottleneckOutputModel(thinking="fake", bottlenecks=[BottleneckModel(step_number=1, description="fake", impact="fake")])
+    if response_format is ImprovementOutputModel:
+        return ImprovementOutputModel(thinking="fake", improvements=[ImprovementModel(bottleneck_id=1, description="fake", impacted_steps=[1], impact="fake", timeline="fake")])
+    return "FAKE RESPONSE"
@@ -0,0 +1,247 @@
+"""End-to-end benchmark suite: synthetic process maps through `run_pipeline` against a fake LLM backend.
+
+Each scenario generates a process map of the given size and step count, creates `--runs` runs for it
+and drives every pipeline step (transcribe, bottlenecks, improvements) through `run_pipeline`, with
+up to `concurrency` runs in flight. Scenarios run in a fresh process each so peak RSS and CPU time
+are their own. Per-stage wall and CPU time come from the runs' traces (see tracing.py).
+
+Results are printed as one JSON line per scenario. `--output` also writes them with the commit and
+settings they were measured at, and `--baseline` compares against such a file, exiting non-zero if
+any scenario regressed by more than `--tolerance`.
+
+Usage:
+    python -m procopt.server.bench.pipeline
+    python -m procopt.server.bench.pipeline --scenario small large --output bench.json
+    python -m procopt.server.bench.pipeline --baseline bench.json --tolerance 0.2
+"""
+import argparse
+import io
+import json
+import math
+import multiprocessing
+import os
+import platform
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from datetime import datetime
+from typing import Dict, List, Optional, Tuple
+from PIL import Image, ImageDraw
+from sqlalchemy import func, select
+
+SCENARIOS: Dict[str, Dict] = {
+    "small": { "width": 2000, "height": 1500, "steps": 12, "runs": 4, "concurrency": 2 },
+    "medium": { "width": 6000, "height": 4000, "steps": 60, "runs": 4, "concurrency": 2 },
+    "large": { "width": 12000, "height": 8000, "steps": 250, "runs": 2, "concurrency": 2 },
+    "many_runs": { "width": 3000, "height": 2000, "steps": 20, "runs": 24, "concurrency": 8 },
+    "flaky": { "width": 6000, "height": 4000, "steps": 60, "runs": 4, "concurrency": 2, "error_rate": 0.1 },
+    "hierarchical_merge": { "width": 12000, "height": 8000, "steps": 250, "runs": 2, "concurrency": 2, "merge_mode": "hierarchical" },
+    "async": { "width": 6000, "height": 4000, "steps": 60, "runs": 4, "concurrency": 2, "transcribe_mode": "async" },
+}
+SCENARIO_DEFAULTS: Dict = {
+    "latency": 0.2, # Seconds per fake LLM call
+    "jitter": 0.05,
+    "error_rate": 0.0,
+    "tokens_per_second": 200.0, # Fake generation speed, adds output tokens / tokens_per_second to each call
+    "tiling_strategy": "grid",
+    "merge_mode": "local",
+    "transcribe_mode": "threads",
+    "pipeline_steps": ["transcribe", "bottlenecks", "improvements"],
+    "seed": 0,
+}
+STAGES: List[str] = ["split", "plan_reuse", "encode", "tile", "transcribe", "merge", "bottlenecks", "improvements", "db_commit"]
+REGRESSION_KEYS: List[str] = ["wall_time_s", "llm_calls_per_run", "peak_rss_mb", "cpu_time_s"]
+
+def make_process_map(width: int, height: int, num_steps: int, seed: int = 0) -> bytes:
+    """PNG of `num_steps` labelled boxes laid out left to right, row by row, with arrows between consecutive steps"""
+    rng = random.Random(seed)
+    img = Image.new("RGB", (width, height), "white")
+    draw = ImageDraw.Draw(img)
+    cols = max(1, math.ceil(math.sqrt(num_steps * width / height)))
+    rows = max(1, math.ceil(num_steps / cols))
+    cell_w, cell_h = width / cols, height / rows
+    box_w, box_h = cell_w * 0.6, cell_h * 0.4
+    centers: List[Tuple[float, float]] = []
+    for idx in range(num_steps):
+        row, col = divmod(idx, cols)
+        if row % 2:
+            col = cols - 1 - col # Serpentine, so consecutive steps are neighbours
+        cx, cy = (col + 0.5) * cell_w, (row + 0.5) * cell_h
+        centers.append((cx, cy))
+        draw.rectangle((cx - box_w / 2, cy - box_h / 2, cx + box_w / 2, cy + box_h / 2), outline="black", width=3)
+        draw.text((cx - box_w / 2 + 10, cy - 10), f"Step {idx + 1}: Task {rng.randint(100, 999)}", fill="black")
+    for (x1, y1), (x2, y2) in zip(centers, centers[1:]):
+        draw.line((x1, y1, x2, y2), fill="gray", width=2)
+    buffer = io.BytesIO()
+    img.save(buffer, format="PNG")
+    return buffer.getvalue()
+
+def count_tiles(width: int, height: int, block_size: int) -> int:
+    return math.ceil(width / block_size) * math.ceil(height / block_size)
+
+def stage_times(traces: List[Dict]) -> Dict[str, Dict[str, float]]:
+    """Count, wall and CPU seconds per stage. A span's CPU time includes child spans that ran on other threads"""
+    totals: Dict[str, Dict[str, float]] = { stage: { "count": 0, "wall_s": 0.0, "cpu_s": 0.0 } for stage in STAGES }
+    tile_ms: List[float] = []
+    for trace in traces:
+        spans = { span["id"]: span for span in trace["spans"] }
+        children: Dict[int, List[Dict]] = {}
+        for span in trace["spans"]:
+            children.setdefault(span["parent_id"], []).append(span)
+
+        def _cpu_ms(span: Dict) -> float:
+            return span["cpu_ms"] + sum(_cpu_ms(child) for child in children.get(span["id"], []) if child["thread"] != span["thread"])
+
+        for span in spans.values():
+            if span["name"] in totals:
+                totals[span["name"]]["count"] += 1
+                totals[span["name"]]["wall_s"] += span["duration_ms"] / 1000
+                totals[span["name"]]["cpu_s"] += _cpu_ms(span) / 1000
+            if span["name"] == "tile":
+                tile_ms.append(span["duration_ms"])
+    result = { stage: { key: round(value, 3) for key, value in times.items() } for stage, times in totals.items() if times["count"] }
+    if tile_ms:
+        tile_ms.sort()
+        result["tile"]["p95_ms"] = round(tile_ms[min(len(tile_ms) - 1, int(0.95 * len(tile_ms)))], 1)
+    return result
+
+def run_scenario(name: str, scenario: Dict) -> Dict:
+    """Run one scenario in this process. Meant to be called in a fresh process (see `main`)"""
+    sys.stdout = sys.stderr # Keep the pipeline's progress prints out of the parent's JSON output
+    workdir = tempfile.mkdtemp(prefix=f"bench_{name}_")
+    os.environ.setdefault("OPENAI_API_KEY", "bench")
+    os.environ.update(
+        LLM_CACHE_ENABLED="false",
+        SQLALCHEMY_DATABASE_URI=f"sqlite:///{os.path.join(workdir, 'bench.sqlite')}",
+        TRACING="true",
+        TRACE_FOLDER=os.path.join(workdir, "traces"),
+        TILE_REUSE="false", # Every run transcribes its map from scratch
+        TILING_STRATEGY=scenario["tiling_strategy"],
+        MERGE_MODE=scenario["merge_mode"],
+        TRANSCRIBE_MODE=scenario["transcribe_mode"],
+    )
+    from procopt.server import pipeline, tracing
+    from procopt.server.app import create_app
+    from procopt.server.bench.fake_llm import FakeLLM
+    from procopt.server.db import db
+    from procopt.server.models import ProcessRun, RunStep
+
+    tiles = count_tiles(scenario["width"], scenario["height"], pipeline.BLOCK_SIZE)
+    fake_llm = FakeLLM(
+        latency=scenario["latency"], jitter=scenario["jitter"], error_rate=scenario["error_rate"], seed=scenario["seed"],
+        tokens_per_second=scenario["tokens_per_second"], steps_per_response=math.ceil(scenario["steps"] / tiles) + 1,
+    )
+    pipeline.call_llm = fake_llm
+    pipeline.acall_llm = fake_llm.acall
+    app = create_app(start_workers=False)
+
+    image_path = os.path.join(workdir, "map.png")
+    with open(image_path, "wb") as f:
+        f.write(make_process_map(scenario["width"], scenario["height"], scenario["steps"], scenario["seed"]))
+    with app.app_context():
+        runs = [ ProcessRun(image_path=image_path, status="uploaded") for _ in range(scenario["runs"]) ]
+        db.session.add_all(runs)
+        db.session.commit()
+        run_ids = [ run.id for run in runs ]
+
+    def _process(run_id: int) -> bool:
+        for step in scenario["pipeline_steps"]:
+            if not pipeline.run_pipeline(app, run_id, step):
+                return False
+        return True
+
+    usage_start = resource.getrusage(resource.RUSAGE_SELF)
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=max(1, scenario["concurrency"])) as executor:
+        completed = list(executor.map(_process, run_ids))
+    elapsed = time.perf_counter() - start
+    usage_end = resource.getrusage(resource.RUSAGE_SELF)
+
+    traces = [ trace for run_id in run_ids for trace in tracing.load_traces(app.config["TRACE_FOLDER"], run_id) ]
+    with app.app_context():
+        merged_steps = db.session.execute(select(func.count(RunStep.id)).where(RunStep.run_id.in_(run_ids))).scalar()
+    return {
+        "scenario": name,
+        **{ key: scenario[key] for key in ("width", "height", "steps", "runs", "concurrency", "latency", "error_rate", "tokens_per_second", "tiling_strategy", "merge_mode", "transcribe_mode") },
+        "tiles_per_run": tiles,
+        "runs_completed": sum(completed),
+        "runs_failed": len(completed) - sum(completed),
+        "wall_time_s": round(elapsed, 3),
+        "runs_per_minute": round(60 * len(run_ids) / elapsed, 2) if elapsed else None,
+        "llm_calls": fake_llm.calls,
+        "llm_calls_per_run": round(fake_llm.calls / len(run_ids), 2),
+        "llm_errors": fake_llm.errors,
+        "completion_tokens_per_run": round(fake_llm.completion_tokens / len(run_ids)),
+        "merged_steps_per_run": round(merged_steps / len(run_ids), 1),
+        "peak_rss_mb": round(usage_end.ru_maxrss / 1024, 1),
+        "cpu_time_s": round((usage_end.ru_utime + usage_end.ru_stime) - (usage_start.ru_utime + usage_start.ru_stime), 3),
+        "stages": stage_times(traces),
+    }
+
+def git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+    except Exception:
+        return None
+
+def compare(results: List[Dict], baseline: Dict, tolerance: float) -> List[str]:
+    """Scenarios whose REGRESSION_KEYS grew by more than `tolerance` (a fraction) over `baseline`"""
+    previous = { result["scenario"]: result for result in baseline.get("results", []) }
+    regressions = []
+    for result in results:
+        before = previous.get(result["scenario"])
+        if not before:
+            continue
+        for key in REGRESSION_KEYS:
+            if before.get(key) and result.get(key) is not None and result[key] > before[key] * (1 + tolerance):
+                regressions.append(f"{result['scenario']}: {key} {before[key]} -> {result[key]} (+{100 * (result[key] / before[key] - 1):.0f}%)")
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--scenario", nargs="+", choices=list(SCENARIOS), default=list(SCENARIOS))
+    parser.add_argument("--latency", type=float, help="Override the seconds per fake LLM call")
+    parser.add_argument("--tokens-per-second", type=float, help="Override the fake generation speed (0 for instant)")
+    parser.add_argument("--error-rate", type=float, help="Override the fraction of fake LLM calls that fail")
+    parser.add_argument("--runs", type=int, help="Override the number of runs per scenario")
+    parser.add_argument("--output", help="Write the results and the commit they were measured at to this JSON file")
+    parser.add_argument("--baseline", help="JSON file written by --output to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="Allowed growth over the baseline before a metric counts as regressed")
+    args = parser.parse_args()
+
+    overrides = { key: value for key, value in {
+        "latency": args.latency, "tokens_per_second": args.tokens_per_second, "error_rate": args.error_rate, "runs": args.runs,
+    }.items() if value is not None }
+    results = []
+    for name in args.scenario:
+        scenario = { **SCENARIO_DEFAULTS, **SCENARIOS[name], **overrides }
+        # A fresh process per scenario, so peak RSS, CPU time and module state aren't shared
+        with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context("spawn")) as executor:
+            result = executor.submit(run_scenario, name, scenario).result()
+        print(json.dumps(result), flush=True)
+        results.append(result)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({
+                "commit": git_commit(),
+                "created_at": datetime.utcnow().isoformat() + "Z",
+                "python": platform.python_version(),
+                "platform": platform.platform(),
+                "cpu_count": os.cpu_count(),
+                "results": results,
+            }, f, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for regression in regressions:
+            print(f"REGRESSION {regression}", file=sys.stderr)
+        if regressions:
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
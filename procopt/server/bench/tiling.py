@@ -0,0 +1,55 @@
+"""Compare tiling strategies by LLM calls, pixels sent and transcription latency against a fake LLM backend.
+
+Usage:
+    python -m procopt.server.bench.tiling --image procopt/server/uploads/process.png --latency 0.5
+"""
+import argparse
+import json
+import os
+import resource
+import tempfile
+import time
+from unittest import mock
+from procopt.server import pipeline
+from procopt.server.bench.fake_llm import FakeLLM
+from procopt.server.bench.transcribe import make_image_bytes
+from procopt.server.tiling import TILING_STRATEGIES
+
+def bench_tiling(image_path: str, tiling_strategy: str, concurrency: int, latency: float, jitter: float, blank_filter: bool) -> dict:
+    fake_llm = FakeLLM(latency=latency, jitter=jitter, seed=0)
+    config = { "BLANK_TILE_FILTER": blank_filter, "TRANSCRIBE_CONCURRENCY": concurrency }
+    with mock.patch.object(pipeline, "call_llm", fake_llm):
+        start = time.perf_counter()
+        _, _, stats = pipeline.transcribe_image(config, image_path, tiling_strategy)
+        elapsed = time.perf_counter() - start
+    return {
+        "tiling_strategy": tiling_strategy,
+        "tiles_total": stats["tiles_total"],
+        "llm_calls": fake_llm.calls,
+        "pixels_sent": stats["pixels_sent"],
+        "wall_time_s": round(elapsed, 3),
+        "peak_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--image", help="Process map to tile (a synthetic map is generated if omitted)")
+    parser.add_argument("--width", type=int, default=8000)
+    parser.add_argument("--height", type=int, default=6000)
+    parser.add_argument("--latency", type=float, default=0.5, help="Seconds per fake LLM call")
+    parser.add_argument("--jitter", type=float, default=0.1)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--no-blank-filter", action="store_true")
+    parser.add_argument("--strategy", nargs="+", choices=list(TILING_STRATEGIES), default=list(TILING_STRATEGIES))
+    args = parser.parse_args()
+
+    image_path = args.image
+    if not image_path:
+        image_path = os.path.join(tempfile.mkdtemp(), "synthetic.png")
+        with open(image_path, "wb") as f:
+            f.write(make_image_bytes(args.width, args.height))
+    for tiling_strategy in args.strategy:
+        print(json.dumps(bench_tiling(image_path, tiling_strategy, args.concurrency, args.latency, args.jitter, not args.no_blank_filter)))
+
+if __name__ == "__main__":
+    main()
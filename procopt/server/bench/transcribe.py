@@ -0,0 +1,65 @@
+"""Benchmark serial vs. concurrent tile transcription against a fake LLM backend.
+
+Usage:
+    python -m procopt.server.bench.transcribe --width 8000 --height 6000 --latency 0.5 --concurrency 1 4 8 16 --mode threads async
+"""
+import argparse
+import io
+import json
+import time
+from unittest import mock
+from PIL import Image, ImageDraw
+from procopt.server import pipeline
+from procopt.server.bench.fake_llm import FakeLLM
+from procopt.server.llm_utils import run_async
+from procopt.server.utils import split_image_into_blocks
+
+def make_image_bytes(width: int, height: int) -> bytes:
+    img = Image.new("RGB", (width, height), "white")
+    draw = ImageDraw.Draw(img)
+    for x in range(100, width - 400, 700):
+        for y in range(100, height - 200, 500):
+            draw.rectangle((x, y, x + 400, y + 200), outline="black", width=4)
+            draw.text((x + 20, y + 20), f"Step {x}-{y}", fill="black")
+    buffer = io.BytesIO()
+    img.save(buffer, format="PNG")
+    return buffer.getvalue()
+
+def bench_transcribe(image_bytes: bytes, mode: str, concurrency: int, latency: float, jitter: float, error_rate: float) -> dict:
+    blocks = list(split_image_into_blocks(image_bytes, block_size=pipeline.BLOCK_SIZE))
+    fake_llm = FakeLLM(latency=latency, jitter=jitter, error_rate=error_rate, seed=0)
+    with mock.patch.object(pipeline, "call_llm", fake_llm), mock.patch.object(pipeline, "acall_llm", fake_llm.acall):
+        start = time.perf_counter()
+        if mode == "async":
+            results = run_async(pipeline.atranscribe_blocks(blocks, max_concurrency=concurrency))
+        else:
+            results = pipeline.transcribe_blocks(blocks, max_workers=concurrency)
+        elapsed = time.perf_counter() - start
+    return {
+        "mode": mode,
+        "concurrency": concurrency,
+        "tiles": len(blocks),
+        "valid_tiles": len(results),
+        "llm_calls": fake_llm.calls,
+        "wall_time_s": round(elapsed, 3),
+        "tiles_per_s": round(len(blocks) / elapsed, 2) if elapsed else None,
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--width", type=int, default=8000)
+    parser.add_argument("--height", type=int, default=6000)
+    parser.add_argument("--latency", type=float, default=0.5, help="Seconds per fake LLM call")
+    parser.add_argument("--jitter", type=float, default=0.1)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 4, 8, 16])
+    parser.add_argument("--mode", nargs="+", choices=["threads", "async"], default=["threads"])
+    args = parser.parse_args()
+
+    image_bytes = make_image_bytes(args.width, args.height)
+    for mode in args.mode:
+        for concurrency in args.concurrency:
+            print(json.dumps(bench_transcribe(image_bytes, mode, concurrency, args.latency, args.jitter, args.error_rate)))
+
+if __name__ == "__main__":
+    main()
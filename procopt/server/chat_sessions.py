@@ -0,0 +1,178 @@
+import threading
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List, Optional, Set, Tuple
+import litellm
+from sqlalchemy import select
+from procopt.server.db import db
+from procopt.server.llm_utils import MODEL, call_llm, sys_prompt
+from procopt.server.models import ChatMessage, ChatSession, ProcessRun
+from procopt.server.prompts import prompt__summarize_chat
+from procopt.server.retrieval import BM25Index, Record, run_indexes
+
+########################################################
+# Chat sessions
+#
+# Conversations are stored per run, and each turn's prompt is built as:
+#   1. a stable prefix: system prompt + the run's process map, bottlenecks and
+#      improvements. It is identical across turns (and sessions) of a run, so
+#      provider prompt caching can reuse it. Maps larger than
+#      CHAT_FULL_CONTEXT_TOKENS only get an outline here (see retrieval.py);
+#   2. a rolling summary of older turns, which only changes when turns are folded in;
+#   3. a sliding window of the most recent turns that fits in CHAT_HISTORY_TOKENS;
+#   4. for large maps, the CHAT_RETRIEVAL_TOP_K records most relevant to the question;
+#   5. the new user message.
+# Once the unsummarized history exceeds CHAT_HISTORY_TOKENS, the oldest turns are
+# folded into the summary in the background until it is back under half the
+# budget, so the prompt size (and latency) per turn stays flat.
+########################################################
+
+CHAT_HISTORY_TOKENS: int = 3000 # Budget for the window of recent turns
+CHAT_MIN_WINDOW_MESSAGES: int = 2 # Always keep at least the last exchange verbatim
+CHAT_FULL_CONTEXT_TOKENS: int = 4000 # Maps up to this size are sent whole instead of outline + retrieval
+CHAT_RETRIEVAL_TOP_K: int = 8
+
+_summary_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="chat-summary")
+_summarizing: Set[int] = set()
+_summarizing_lock = threading.Lock()
+
+def count_tokens(text: str, model: str = MODEL) -> int:
+    return litellm.token_counter(model=model, text=text)
+
+def get_or_create_session(run_id: int, session_id: Optional[int] = None) -> Optional[ChatSession]:
+    """The run's session `session_id`, or a new session if no id is given. None if the id doesn't belong to the run"""
+    if session_id is not None:
+        session = db.session.get(ChatSession, session_id)
+        return session if session and session.run_id == run_id else None
+    session = ChatSession(run_id=run_id)
+    db.session.add(session)
+    db.session.commit()
+    return session
+
+def add_message(session: ChatSession, role: str, content: str, **fields) -> ChatMessage:
+    message = ChatMessage(session_id=session.id, role=role, content=content, tokens=count_tokens(content), **fields)
+    db.session.add(message)
+    db.session.commit()
+    return message
+
+def add_history(session: ChatSession, history: List[Dict[str, str]]) -> None:
+    """Store earlier turns (`{"role", "text"}` dicts) sent by a client, in one commit"""
+    db.session.add_all([
+        ChatMessage(session_id=session.id, role=message['role'], content=message['text'], tokens=count_tokens(message['text']))
+        for message in history
+        if message.get('text')
+    ])
+    db.session.commit()
+
+def unsummarized_messages(session: ChatSession) -> List[ChatMessage]:
+    query = select(ChatMessage).where(ChatMessage.session_id == session.id)
+    if session.summarized_through_id is not None:
+        query = query.where(ChatMessage.id > session.summarized_through_id)
+    return db.session.execute(query.order_by(ChatMessage.id)).scalars().all()
+
+def run_context(run: ProcessRun) -> str:
+    """The run's results, as the stable part of the system prompt"""
+    sections = [f"# Process Map\n\n{run.transcription}"]
+    if run.bottlenecks:
+        sections.append(f"# Bottlenecks\n\n{run.bottlenecks}")
+    if run.improvements:
+        sections.append(f"# Improvements\n\n{run.improvements}")
+    return " Here is the complete process map that you are analyzing, with the analysis so far.\n\n" + "\n\n".join(sections)
+
+def run_outline_context(index: BM25Index) -> str:
+    """Stable part of the system prompt for maps too large to send whole"""
+    return (
+        " The process map you are analyzing is large, so here is an outline of its steps and the analysis so far."
+        " With each question you will also be given the full details of the most relevant items.\n\n"
+        + index.outline()
+    )
+
+def build_chat_messages(run: ProcessRun, session: ChatSession, history_tokens: int = CHAT_HISTORY_TOKENS,
+                        full_context_tokens: int = CHAT_FULL_CONTEXT_TOKENS, top_k: int = CHAT_RETRIEVAL_TOP_K) -> Tuple[List[Dict[str, str]], Dict[str, Any]]:
+    """Prompt for the session's next reply (the new user message must already be stored), and its size stats"""
+    context = run_context(run)
+    index: Optional[BM25Index] = None
+    if count_tokens(context) > full_context_tokens:
+        index = run_indexes.get(run)
+        context = run_outline_context(index)
+    messages: List[Dict[str, str]] = [ sys_prompt(context) ]
+    if session.summary:
+        messages.append({ 'role' : 'system', 'content' : f"Summary of the earlier conversation:\n{session.summary}" })
+
+    # Newest messages that fit in the budget. Older ones are about to be folded into the summary
+    history = unsummarized_messages(session)
+    window: List[ChatMessage] = []
+    window_tokens = 0
+    for message in reversed(history):
+        if len(window) >= CHAT_MIN_WINDOW_MESSAGES and window_tokens + message.tokens > history_tokens:
+            break
+        window.insert(0, message)
+        window_tokens += message.tokens
+    messages.extend({ 'role' : message.role, 'content' : message.content } for message in window)
+
+    # Details relevant to the question go right before it, after everything cacheable
+    retrieved: List[Record] = []
+    if index is not None and window:
+        retrieved = [ record for _, record in index.search(window[-1].content, k=top_k) ]
+        if retrieved:
+            details = "\n\n".join(record.text for record in retrieved)
+            messages.insert(len(messages) - 1, { 'role' : 'system', 'content' : f"Details of the items most relevant to the next question:\n\n{details}" })
+
+    return messages, {
+        "full_context": index is None,
+        "retrieved_records": len(retrieved),
+        "prompt_tokens": litellm.token_counter(model=MODEL, messages=messages),
+        "window_messages": len(window),
+        "dropped_messages": len(history) - len(window),
+        "summarized": session.summary is not None,
+    }
+
+def summarize_session(session: ChatSession, history_tokens: int = CHAT_HISTORY_TOKENS) -> bool:
+    """Fold the oldest unsummarized turns into the rolling summary if the history is over budget.
+    Returns whether the summary changed"""
+    history = unsummarized_messages(session)
+    total = sum(message.tokens for message in history)
+    if total <= history_tokens:
+        return False
+
+    # Fold whole exchanges until the remaining history is under half the budget
+    folded: List[ChatMessage] = []
+    for message in history[:-CHAT_MIN_WINDOW_MESSAGES]:
+        if total <= history_tokens // 2 and message.role == 'user':
+            break
+        folded.append(message)
+        total -= message.tokens
+    if not folded:
+        return False
+
+    turns = "\n\n".join(f"{message.role.upper()}: {message.content}" for message in folded)
+    session.summary = call_llm(
+        messages=[ { 'role' : 'user', 'content' : prompt__summarize_chat(session.summary, turns) } ],
+        model=MODEL,
+    )
+    session.summarized_through_id = folded[-1].id
+    db.session.commit()
+    print(f"Folded {len(folded)} messages into the summary of chat session_id=`{session.id}`")
+    return True
+
+def schedule_summary(app, session_id: int) -> None:
+    """Summarize a session in the background, at most one summarization per session at a time"""
+    with _summarizing_lock:
+        if session_id in _summarizing:
+            return
+        _summarizing.add(session_id)
+
+    def _summarize() -> None:
+        try:
+            with app.app_context():
+                session = db.session.get(ChatSession, session_id)
+                if session:
+                    summarize_session(session, app.config.get("CHAT_HISTORY_TOKENS", CHAT_HISTORY_TOKENS))
+        except Exception as e:
+            traceback.print_exc()
+            print(f"Error summarizing chat session_id=`{session_id}`: {str(e)}")
+        finally:
+            with _summarizing_lock:
+                _summarizing.discard(session_id)
+
+    _summary_executor.submit(_summarize)
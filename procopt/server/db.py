@@ -1,3 +1,83 @@
+from typing import Any, Dict
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import MetaData, event, inspect, text
+from sqlalchemy.engine import Engine, make_url
 
-db = SQLAlchemy()
\ No newline at end of file
+db = SQLAlchemy()
+
+########################################################
+# Engine setup
+#
+# Job workers, their heartbeats and request handlers all write the same
+# database from different threads. SQLite runs in WAL mode so readers never
+# block the (single) writer, and a busy timeout makes writers queue behind
+# each other instead of failing with "database is locked". Other backends
+# (e.g. Postgres via SQLALCHEMY_DATABASE_URI) get a connection pool sized for
+# the worker threads.
+########################################################
+
+SQLITE_BUSY_TIMEOUT_SECONDS: float = 30.0
+DB_POOL_SIZE: int = 10 # Connections for request handlers, on top of the job workers'
+DB_POOL_CONNECTIONS_PER_WORKER: int = 2 # A job worker's session is open for its whole step, plus its lease heartbeat
+DB_MAX_OVERFLOW: int = 10
+DB_POOL_TIMEOUT_SECONDS: int = 30
+DB_POOL_RECYCLE_SECONDS: int = 1800 # Below typical server-side idle connection timeouts
+
+def engine_options(database_uri: str, config) -> Dict[str, Any]:
+    """SQLALCHEMY_ENGINE_OPTIONS for `database_uri`"""
+    url = make_url(database_uri)
+    if url.get_backend_name() == "sqlite" and url.database in (None, "", ":memory:"):
+        return {} # In-memory databases share a single connection
+    options: Dict[str, Any] = {
+        "pool_size": config.get("DB_POOL_SIZE", DB_POOL_SIZE) + DB_POOL_CONNECTIONS_PER_WORKER * config.get("JOB_WORKERS", 0),
+        "max_overflow": config.get("DB_MAX_OVERFLOW", DB_MAX_OVERFLOW),
+        "pool_timeout": config.get("DB_POOL_TIMEOUT_SECONDS", DB_POOL_TIMEOUT_SECONDS),
+    }
+    if url.get_backend_name() == "sqlite":
+        options["connect_args"] = {
+            "timeout": config.get("SQLITE_BUSY_TIMEOUT_SECONDS", SQLITE_BUSY_TIMEOUT_SECONDS),
+            "check_same_thread": False,
+        }
+    else:
+        options["pool_pre_ping"] = True
+        options["pool_recycle"] = config.get("DB_POOL_RECYCLE_SECONDS", DB_POOL_RECYCLE_SECONDS)
+    return options
+
+def configure_engine(engine: Engine) -> None:
+    """Per-connection SQLite settings. Call before the engine's first connection"""
+    if engine.dialect.name != "sqlite":
+        return
+
+    @event.listens_for(engine, "connect")
+    def _set_sqlite_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        cursor.execute("PRAGMA journal_mode=WAL")
+        cursor.execute("PRAGMA synchronous=NORMAL") # Durable across crashes in WAL mode, fsyncs only at checkpoints
+        cursor.close()
+
+def migrate_schema(engine: Engine, metadata: MetaData) -> None:
+    """Bring the database up to the models: create missing tables, then add missing columns and indexes.
+    Migrations are additive only, which is all schema changes so far have needed"""
+    metadata.create_all(engine)
+    add_missing_columns(engine, metadata)
+    add_missing_indexes(engine, metadata)
+
+def add_missing_columns(engine: Engine, metadata: MetaData) -> None:
+    """Add model columns that are missing from already-existing tables (create_all only creates new tables)"""
+    inspector = inspect(engine)
+    with engine.begin() as conn:
+        for table in metadata.sorted_tables:
+            if not inspector.has_table(table.name):
+                continue
+            existing = { column['name'] for column in inspector.get_columns(table.name) }
+            for column in table.columns:
+                if column.name not in existing:
+                    column_type = column.type.compile(dialect=engine.dialect)
+                    conn.execute(text(f'ALTER TABLE {table.name} ADD COLUMN {column.name} {column_type}'))
+
+def add_missing_indexes(engine: Engine, metadata: MetaData) -> None:
+    """Create model indexes that are missing from already-existing tables"""
+    with engine.begin() as conn:
+        for table in metadata.sorted_tables:
+            for index in table.indexes:
+                index.create(conn, checkfirst=True)
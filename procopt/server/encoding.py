@@ -0,0 +1,129 @@
+import io
+import math
+import threading
+import time
+from typing import Any, Dict, Optional, Tuple
+from PIL import Image
+
+########################################################
+# Tile encoding
+#
+# Tiles are downscaled to what the vision model actually looks at and encoded
+# in a configurable format, optionally shrinking further to fit a byte or
+# token budget per request.
+########################################################
+
+TILE_FORMATS = { "png": "PNG", "jpeg": "JPEG", "webp": "WEBP" }
+TILE_COLOR_MODES = ("rgb", "grayscale", "palette")
+DEFAULT_TILE_FORMAT: str = "webp" # ~3x smaller than PNG on scanned maps and keeps colour (pain points are often red)
+DEFAULT_TILE_QUALITY: int = 85
+
+# OpenAI "high detail" image handling: fit in 2048x2048, then shortest side <= 768,
+# billed as 85 tokens + 170 per 512px tile.
+MODEL_MAX_SIDE: int = 2048
+MODEL_MAX_SHORT_SIDE: int = 768
+MIN_LOSSY_QUALITY: int = 40
+DOWNSCALE_STEP: float = 0.85
+
+def effective_size(width: int, height: int) -> Tuple[int, int]:
+    """Size the vision model rescales an image to before looking at it"""
+    scale = min(1.0, MODEL_MAX_SIDE / max(width, height))
+    scale = min(scale, MODEL_MAX_SHORT_SIDE / max(1, min(width, height) * scale) * scale)
+    return max(1, round(width * scale)), max(1, round(height * scale))
+
+def estimate_image_tokens(width: int, height: int) -> int:
+    width, height = effective_size(width, height)
+    return 85 + 170 * math.ceil(width / 512) * math.ceil(height / 512)
+
+class TileEncoder:
+    """Encodes tiles for vision calls and records bytes/time per tile.
+
+    Thread-safe: one encoder is shared by all workers transcribing a run.
+    """
+    def __init__(self, image_format: str = DEFAULT_TILE_FORMAT, quality: int = DEFAULT_TILE_QUALITY, color_mode: str = "rgb",
+                 downscale_to_model: bool = True, max_bytes: Optional[int] = None, max_tokens: Optional[int] = None):
+        if image_format not in TILE_FORMATS:
+            raise ValueError(f"Unknown tile format `{image_format}`, expected one of {list(TILE_FORMATS)}")
+        if color_mode not in TILE_COLOR_MODES:
+            raise ValueError(f"Unknown tile color mode `{color_mode}`, expected one of {list(TILE_COLOR_MODES)}")
+        self.image_format = image_format
+        self.quality = quality
+        self.color_mode = color_mode
+        self.downscale_to_model = downscale_to_model
+        self.max_bytes = max_bytes
+        self.max_tokens = max_tokens
+        self.tiles = 0
+        self.total_bytes = 0
+        self.max_tile_bytes = 0
+        self.total_seconds = 0.0
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_config(cls, config) -> "TileEncoder":
+        return cls(
+            image_format=config.get("TILE_FORMAT", DEFAULT_TILE_FORMAT),
+            quality=config.get("TILE_QUALITY", DEFAULT_TILE_QUALITY),
+            color_mode=config.get("TILE_COLOR_MODE", "rgb"),
+            downscale_to_model=config.get("TILE_DOWNSCALE_TO_MODEL", True),
+            max_bytes=config.get("TILE_MAX_BYTES"),
+            max_tokens=config.get("TILE_MAX_TOKENS"),
+        )
+
+    def _convert(self, img: Image.Image) -> Image.Image:
+        if self.color_mode == "grayscale":
+            return img.convert("L")
+        if self.color_mode == "palette" and self.image_format != "jpeg":
+            # 16 colours picked from the tile itself, so red pain points stay red
+            return (img if img.mode == "RGB" else img.convert("RGB")).quantize(colors=16)
+        return img if img.mode == "RGB" else img.convert("RGB")
+
+    def _save(self, img: Image.Image, quality: int) -> bytes:
+        buffer = io.BytesIO()
+        if self.image_format == "png":
+            img.save(buffer, format="PNG", optimize=self.max_bytes is not None)
+        else:
+            img.save(buffer, format=TILE_FORMATS[self.image_format], quality=quality)
+        return buffer.getvalue()
+
+    def encode(self, block_image: Image.Image) -> Tuple[bytes, str]:
+        """Encode a tile, returning its bytes and image format (for the data URL)"""
+        start = time.perf_counter()
+        img = block_image
+        if self.downscale_to_model:
+            size = effective_size(img.width, img.height)
+            if size != img.size:
+                img = img.resize(size, Image.LANCZOS)
+        if self.max_tokens:
+            while estimate_image_tokens(img.width, img.height) > self.max_tokens and min(img.size) > 64:
+                img = img.resize((int(img.width * DOWNSCALE_STEP), int(img.height * DOWNSCALE_STEP)), Image.LANCZOS)
+        img = self._convert(img)
+
+        quality = self.quality
+        data = self._save(img, quality)
+        while self.max_bytes and len(data) > self.max_bytes and min(img.size) > 64:
+            # Lossy formats first trade quality, then resolution
+            if self.image_format != "png" and quality > MIN_LOSSY_QUALITY:
+                quality = max(MIN_LOSSY_QUALITY, quality - 10)
+            else:
+                img = img.resize((int(img.width * DOWNSCALE_STEP), int(img.height * DOWNSCALE_STEP)), Image.LANCZOS)
+            data = self._save(img, quality)
+
+        elapsed = time.perf_counter() - start
+        with self._lock:
+            self.tiles += 1
+            self.total_bytes += len(data)
+            self.max_tile_bytes = max(self.max_tile_bytes, len(data))
+            self.total_seconds += elapsed
+        return data, self.image_format
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "tile_format": self.image_format,
+                "tile_color_mode": self.color_mode,
+                "tile_bytes_total": self.total_bytes,
+                "tile_bytes_avg": round(self.total_bytes / self.tiles) if self.tiles else None,
+                "tile_bytes_max": self.max_tile_bytes,
+                "tile_encode_seconds_total": round(self.total_seconds, 3),
+                "tile_encode_ms_avg": round(1000 * self.total_seconds / self.tiles, 2) if self.tiles else None,
+            }
@@ -0,0 +1,79 @@
+import itertools
+import json
+import queue
+import threading
+from collections import OrderedDict, deque
+from typing import Any, Deque, Dict, List, Optional, Tuple
+
+########################################################
+# Run progress events
+#
+# In-process pub/sub that `run_pipeline` and the job workers publish to and
+# `/runs/<id>/events` streams to clients as server-sent events. Each run keeps
+# a short history so a client that (re)connects with `Last-Event-ID` catches up
+# on what it missed. Only works when the job workers run in the web process.
+########################################################
+
+# (event id, event type, payload)
+RunEvent = Tuple[int, str, Dict[str, Any]]
+
+RUN_EVENT_HISTORY: int = 500 # Events kept per run for reconnecting clients
+RUN_EVENT_HISTORY_RUNS: int = 256 # Runs whose history is kept, least recently published dropped first
+SUBSCRIBER_QUEUE_SIZE: int = 1000
+SSE_KEEPALIVE_SECONDS: float = 15.0
+
+class RunEventBus:
+    """Thread-safe fan-out of per-run events to any number of subscriber queues"""
+    def __init__(self, history: int = RUN_EVENT_HISTORY, history_runs: int = RUN_EVENT_HISTORY_RUNS):
+        self.history = history
+        self.history_runs = history_runs
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+        self._subscribers: Dict[int, List[queue.Queue]] = {}
+        self._history: "OrderedDict[int, Deque[RunEvent]]" = OrderedDict()
+
+    def publish(self, run_id: int, event: str, **data) -> None:
+        with self._lock:
+            run_event: RunEvent = (next(self._ids), event, data)
+            if run_id not in self._history:
+                self._history[run_id] = deque(maxlen=self.history)
+                while len(self._history) > self.history_runs:
+                    self._history.popitem(last=False)
+            self._history[run_id].append(run_event)
+            self._history.move_to_end(run_id)
+            for subscriber in self._subscribers.get(run_id, []):
+                try:
+                    subscriber.put_nowait(run_event)
+                except queue.Full:
+                    pass # A stalled client loses events rather than blocking the pipeline
+
+    def subscribe(self, run_id: int, last_event_id: Optional[int] = None) -> queue.Queue:
+        """Queue receiving the run's future events, pre-filled with those after `last_event_id`"""
+        subscriber: queue.Queue = queue.Queue(maxsize=SUBSCRIBER_QUEUE_SIZE)
+        with self._lock:
+            if last_event_id is not None:
+                for run_event in self._history.get(run_id, []):
+                    if run_event[0] > last_event_id:
+                        subscriber.put_nowait(run_event)
+            self._subscribers.setdefault(run_id, []).append(subscriber)
+        return subscriber
+
+    def unsubscribe(self, run_id: int, subscriber: queue.Queue) -> None:
+        with self._lock:
+            subscribers = self._subscribers.get(run_id, [])
+            if subscriber in subscribers:
+                subscribers.remove(subscriber)
+            if not subscribers:
+                self._subscribers.pop(run_id, None)
+
+    def num_subscribers(self) -> int:
+        with self._lock:
+            return sum(len(subscribers) for subscribers in self._subscribers.values())
+
+def format_sse(event: str, data: Dict[str, Any], event_id: Optional[int] = None) -> str:
+    lines = [f"event: {event}", f"data: {json.dumps(data)}"]
+    if event_id is not None:
+        lines.insert(0, f"id: {event_id}")
+    return "\n".join(lines) + "\n\n"
+
+run_events = RunEventBus()
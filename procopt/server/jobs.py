@@ -0,0 +1,276 @@
+import threading
+import time
+import traceback
+import uuid
+from datetime import datetime, timedelta
+from typing import Any, Dict, List, Optional, Tuple
+from flask import current_app
+from sqlalchemy import func, select, update
+from procopt.server.db import db
+from procopt.server.events import run_events
+from procopt.server.metrics import Gauge, job_retries, registry
+from procopt.server.models import Batch, Job, ProcessRun
+from procopt.server.pipeline import run_pipeline
+
+########################################################
+# Durable job queue
+#
+# Pipeline steps are persisted as `Job` rows and executed by a fixed pool of
+# worker threads. A worker leases a job (status=running + lease token + expiry)
+# and keeps the lease alive with heartbeats while the step runs. Jobs whose
+# lease expires (e.g. the server was restarted mid-run) go back to the queue,
+# and failed jobs are retried with exponential backoff.
+#
+# Claiming is fair across batches: the next job comes from the batch (or
+# standalone run) with the fewest running jobs, so a large batch only fills
+# workers nobody else is waiting for.
+########################################################
+
+JOB_WORKERS: int = 4
+JOB_MAX_ATTEMPTS: int = 3
+JOB_LEASE_SECONDS: int = 60
+JOB_HEARTBEAT_SECONDS: int = 15
+JOB_RETRY_BACKOFF_SECONDS: int = 10
+JOB_POLL_SECONDS: float = 1.0
+PIPELINE_STEPS: List[str] = ["transcribe", "bottlenecks", "improvements"]
+
+def enqueue_jobs(run_ids: List[int], step: str, bypass_cache: bool = False, max_attempts: Optional[int] = None, batch_id: Optional[int] = None) -> List[Job]:
+    """Persist a pipeline step for each run in one transaction and wake idle workers. Needs an app context.
+    Whatever else is pending in the session (e.g. the runs themselves) is committed with the jobs"""
+    now = datetime.utcnow()
+    jobs = [
+        Job(
+            run_id=run_id,
+            batch_id=batch_id,
+            step=step,
+            bypass_cache=bypass_cache,
+            max_attempts=max_attempts or current_app.config.get("JOB_MAX_ATTEMPTS", JOB_MAX_ATTEMPTS),
+            available_at=now,
+        )
+        for run_id in run_ids
+    ]
+    db.session.add_all(jobs)
+    db.session.commit()
+
+    workers: Optional[JobWorkerPool] = current_app.extensions.get("job_workers")
+    if workers:
+        workers.notify(all_workers=len(jobs) > 1)
+    return jobs
+
+def enqueue_job(run_id: int, step: str, bypass_cache: bool = False, max_attempts: Optional[int] = None, batch_id: Optional[int] = None) -> Job:
+    return enqueue_jobs([run_id], step, bypass_cache=bypass_cache, max_attempts=max_attempts, batch_id=batch_id)[0]
+
+def enqueue_next_batch_step(run_id: int, step: str) -> Optional[Job]:
+    """Queue the step after `step` for a run that belongs to a batch, if the batch runs it"""
+    run = db.session.get(ProcessRun, run_id)
+    batch = db.session.get(Batch, run.batch_id) if run and run.batch_id else None
+    if not batch:
+        return None
+    steps = batch.steps.split(",")
+    if step not in steps or steps.index(step) + 1 >= len(steps):
+        return None
+    return enqueue_job(run_id, steps[steps.index(step) + 1], batch_id=batch.id)
+
+def recover_expired_leases() -> int:
+    """Put `running` jobs whose lease has expired back in the queue. Returns the number recovered"""
+    result = db.session.execute(
+        update(Job)
+        .where(Job.status == "running", Job.lease_expires_at < datetime.utcnow())
+        .values(status="queued", lease_token=None, lease_expires_at=None, available_at=datetime.utcnow())
+    )
+    db.session.commit()
+    if result.rowcount:
+        print(f"Recovered {result.rowcount} jobs with expired leases")
+    return result.rowcount
+
+def claim_job(lease_seconds: int = JOB_LEASE_SECONDS) -> Optional[Tuple[int, str]]:
+    """Atomically lease the oldest available queued job of the least busy batch. Returns (job id, lease token) or None"""
+    now = datetime.utcnow()
+    # Standalone runs (no batch) count as their own group with nothing running
+    running = (
+        select(Job.batch_id, func.count(Job.id).label("running"))
+        .where(Job.status == "running", Job.batch_id.is_not(None))
+        .group_by(Job.batch_id)
+        .subquery()
+    )
+    job_id = db.session.execute(
+        select(Job.id)
+        .outerjoin(running, running.c.batch_id == Job.batch_id)
+        .where(Job.status == "queued", Job.available_at <= now)
+        .order_by(func.coalesce(running.c.running, 0), Job.available_at, Job.id)
+        .limit(1)
+    ).scalar()
+    if job_id is None:
+        db.session.commit()
+        return None
+
+    lease_token = str(uuid.uuid4())
+    result = db.session.execute(
+        update(Job)
+        .where(Job.id == job_id, Job.status == "queued")
+        .values(
+            status="running",
+            lease_token=lease_token,
+            lease_expires_at=now + timedelta(seconds=lease_seconds),
+            started_at=func.coalesce(Job.started_at, now),
+            attempts=Job.attempts + 1,
+        )
+    )
+    db.session.commit()
+    # Another worker (or process) may have claimed it between the select and the update
+    return (job_id, lease_token) if result.rowcount == 1 else None
+
+def queue_stats(window: int = 100) -> Dict[str, Any]:
+    """Queue depth by status and wait times (enqueue -> first start) in seconds"""
+    now = datetime.utcnow()
+    counts = dict(db.session.execute(select(Job.status, func.count(Job.id)).group_by(Job.status)).all())
+    oldest_queued = db.session.execute(select(func.min(Job.created_at)).where(Job.status == "queued")).scalar()
+    started: List[Tuple[datetime, datetime]] = db.session.execute(
+        select(Job.created_at, Job.started_at)
+        .where(Job.started_at.is_not(None))
+        .order_by(Job.started_at.desc())
+        .limit(window)
+    ).all()
+    waits = sorted((started_at - created_at).total_seconds() for created_at, started_at in started)
+    return {
+        "depth": counts.get("queued", 0),
+        "running": counts.get("running", 0),
+        "done": counts.get("done", 0),
+        "failed": counts.get("failed", 0),
+        "oldest_queued_wait_s": round((now - oldest_queued).total_seconds(), 3) if oldest_queued else None,
+        "recent_wait_avg_s": round(sum(waits) / len(waits), 3) if waits else None,
+        "recent_wait_p95_s": round(waits[min(len(waits) - 1, int(0.95 * len(waits)))], 3) if waits else None,
+    }
+
+def count_jobs_by_status() -> Dict[Tuple[str], float]:
+    return { (status,): count for status, count in db.session.execute(select(Job.status, func.count(Job.id)).group_by(Job.status)).all() }
+
+registry.register(Gauge("procopt_jobs", "Jobs in the queue by status (queued, running, done, failed)", ["status"], collect=count_jobs_by_status))
+
+class JobWorkerPool:
+    """Fixed-size pool of threads that lease and execute queued jobs"""
+    def __init__(self, app, num_workers: int = JOB_WORKERS):
+        self.app = app
+        self.num_workers = num_workers
+        self.lease_seconds: int = app.config.get("JOB_LEASE_SECONDS", JOB_LEASE_SECONDS)
+        self.heartbeat_seconds: int = app.config.get("JOB_HEARTBEAT_SECONDS", JOB_HEARTBEAT_SECONDS)
+        self.retry_backoff_seconds: int = app.config.get("JOB_RETRY_BACKOFF_SECONDS", JOB_RETRY_BACKOFF_SECONDS)
+        self.poll_seconds: float = app.config.get("JOB_POLL_SECONDS", JOB_POLL_SECONDS)
+        self._threads: List[threading.Thread] = []
+        self._stop = threading.Event()
+        self._wakeup = threading.Condition()
+
+    def start(self) -> None:
+        with self.app.app_context():
+            recover_expired_leases()
+        for idx in range(self.num_workers):
+            thread = threading.Thread(target=self._worker_loop, name=f"job-worker-{idx}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+        print(f"Started {self.num_workers} job workers")
+
+    def stop(self, timeout: Optional[float] = None) -> None:
+        self._stop.set()
+        self.notify(all_workers=True)
+        for thread in self._threads:
+            thread.join(timeout)
+
+    def notify(self, all_workers: bool = False) -> None:
+        with self._wakeup:
+            if all_workers:
+                self._wakeup.notify_all()
+            else:
+                self._wakeup.notify()
+
+    def _worker_loop(self) -> None:
+        last_recovery = time.monotonic()
+        while not self._stop.is_set():
+            try:
+                with self.app.app_context():
+                    if time.monotonic() - last_recovery > self.lease_seconds:
+                        recover_expired_leases()
+                        last_recovery = time.monotonic()
+                    claimed = claim_job(self.lease_seconds)
+                if claimed is None:
+                    with self._wakeup:
+                        self._wakeup.wait(self.poll_seconds)
+                    continue
+                self._execute(*claimed)
+            except Exception as e:
+                print(f"Error in job worker: {str(e)}")
+                traceback.print_exc()
+                self._stop.wait(self.poll_seconds)
+
+    def _heartbeat(self, job_id: int, lease_token: str, done: threading.Event) -> None:
+        while not done.wait(self.heartbeat_seconds):
+            with self.app.app_context():
+                try:
+                    result = db.session.execute(
+                        update(Job)
+                        .where(Job.id == job_id, Job.lease_token == lease_token)
+                        .values(lease_expires_at=datetime.utcnow() + timedelta(seconds=self.lease_seconds))
+                    )
+                    db.session.commit()
+                except Exception as e:
+                    # e.g. `database is locked`: the lease outlives a few missed beats, so try again next time
+                    db.session.rollback()
+                    print(f"Error renewing lease on job_id=`{job_id}`: {str(e)}")
+                    continue
+                if result.rowcount == 0:
+                    print(f"Lost lease on job_id=`{job_id}`")
+                    return
+
+    def _execute(self, job_id: int, lease_token: str) -> None:
+        with self.app.app_context():
+            job = db.session.get(Job, job_id)
+            run_id, step, bypass_cache, batch_id = job.run_id, job.step, job.bypass_cache, job.batch_id
+            final_attempt = job.attempts >= job.max_attempts
+            db.session.commit()
+
+        done = threading.Event()
+        heartbeat = threading.Thread(target=self._heartbeat, args=(job_id, lease_token, done), name=f"job-heartbeat-{job_id}", daemon=True)
+        heartbeat.start()
+        error: Optional[str] = None
+        try:
+            succeeded = run_pipeline(self.app, run_id, step, bypass_cache, final_attempt)
+        except Exception as e:
+            traceback.print_exc()
+            succeeded, error = False, str(e)
+        finally:
+            done.set()
+            heartbeat.join()
+
+        with self.app.app_context():
+            job = db.session.get(Job, job_id)
+            if job.lease_token != lease_token:
+                # The lease expired and the job was handed to someone else; leave it to them
+                db.session.commit()
+                return
+            job.lease_token = None
+            job.lease_expires_at = None
+            if succeeded:
+                job.status = "done"
+                job.finished_at = datetime.utcnow()
+            elif job.attempts < job.max_attempts:
+                delay = self.retry_backoff_seconds * 2 ** (job.attempts - 1)
+                job.status = "queued"
+                job.available_at = datetime.utcnow() + timedelta(seconds=delay)
+                job.error = error or f"{step} failed"
+                job_retries.inc(step=step)
+                print(f"Job job_id=`{job_id}` failed (attempt {job.attempts}/{job.max_attempts}), retrying in {delay}s")
+            else:
+                job.status = "failed"
+                job.finished_at = datetime.utcnow()
+                job.error = error or f"{step} failed"
+                print(f"Job job_id=`{job_id}` failed after {job.attempts} attempts")
+            db.session.commit()
+            if succeeded and batch_id is not None:
+                enqueue_next_batch_step(run_id, step)
+            if not succeeded:
+                run_events.publish(run_id, "job", job_id=job_id, step=step, status=job.status, attempts=job.attempts, max_attempts=job.max_attempts, error=job.error)
+
+def start_job_workers(app) -> JobWorkerPool:
+    workers = JobWorkerPool(app, num_workers=app.config.get("JOB_WORKERS", JOB_WORKERS))
+    app.extensions["job_workers"] = workers
+    workers.start()
+    return workers
@@ -0,0 +1,131 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from typing import Any, Dict, List, Optional
+from dotenv import load_dotenv
+from pydantic import BaseModel
+load_dotenv()
+
+class LLMCache:
+    """Content-addressed, SQLite-backed cache of structured LLM outputs.
+
+    Entries are keyed on a hash of the model, messages (including base64 image data),
+    `response_format` JSON schema and call kwargs, and hold the validated pydantic output
+    as JSON. Entries older than `ttl` seconds are treated as misses, and the least recently
+    used entries are evicted once the total stored size exceeds `max_bytes`.
+    """
+    def __init__(self, path: str, max_bytes: int = 512 * 1024 * 1024, ttl: Optional[float] = 30 * 24 * 3600, enabled: bool = True):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.enabled = enabled
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        self._conn: Optional[sqlite3.Connection] = None
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._conn is None:
+            self._conn = sqlite3.connect(self.path, check_same_thread=False, timeout=30)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("""
+                CREATE TABLE IF NOT EXISTS llm_cache (
+                    key TEXT PRIMARY KEY,
+                    value TEXT NOT NULL,
+                    size INTEGER NOT NULL,
+                    created_at REAL NOT NULL,
+                    accessed_at REAL NOT NULL
+                )
+            """)
+            self._conn.execute("CREATE INDEX IF NOT EXISTS ix_llm_cache_accessed_at ON llm_cache (accessed_at)")
+            self._conn.commit()
+        return self._conn
+
+    @staticmethod
+    def make_key(model: str, messages: List[Dict], response_format: Optional[BaseModel], kwargs: Dict[str, Any]) -> str:
+        """Stable hash of everything that determines the model's output"""
+        payload = {
+            "model": model,
+            "messages": messages,
+            "response_format": response_format.model_json_schema() if response_format else None,
+            "kwargs": kwargs,
+        }
+        return hashlib.sha256(json.dumps(payload, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+
+    def get(self, key: str, response_format: BaseModel) -> Optional[BaseModel]:
+        if not self.enabled:
+            return None
+        now = time.time()
+        with self._lock:
+            conn = self._connect()
+            row = conn.execute("SELECT value, created_at FROM llm_cache WHERE key = ?", (key,)).fetchone()
+            if row is not None and self.ttl is not None and row[1] + self.ttl < now:
+                conn.execute("DELETE FROM llm_cache WHERE key = ?", (key,))
+                conn.commit()
+                row = None
+            if row is None:
+                self.misses += 1
+                return None
+            conn.execute("UPDATE llm_cache SET accessed_at = ? WHERE key = ?", (now, key))
+            conn.commit()
+            self.hits += 1
+        return response_format(**json.loads(row[0]))
+
+    def set(self, key: str, value: BaseModel) -> None:
+        if not self.enabled:
+            return
+        data = value.model_dump_json()
+        now = time.time()
+        with self._lock:
+            conn = self._connect()
+            conn.execute(
+                "INSERT OR REPLACE INTO llm_cache (key, value, size, created_at, accessed_at) VALUES (?, ?, ?, ?, ?)",
+                (key, data, len(data), now, now)
+            )
+            self._evict(conn)
+            conn.commit()
+
+    def _evict(self, conn: sqlite3.Connection) -> None:
+        """Drop least recently used entries until the cache fits in `max_bytes`"""
+        total = conn.execute("SELECT COALESCE(SUM(size), 0) FROM llm_cache").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        for key, size in conn.execute("SELECT key, size FROM llm_cache ORDER BY accessed_at ASC").fetchall():
+            conn.execute("DELETE FROM llm_cache WHERE key = ?", (key,))
+            self.evictions += 1
+            total -= size
+            if total <= self.max_bytes:
+                break
+
+    def clear(self) -> None:
+        with self._lock:
+            conn = self._connect()
+            conn.execute("DELETE FROM llm_cache")
+            conn.commit()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            entries, size = (0, 0)
+            if self.enabled:
+                entries, size = self._connect().execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM llm_cache").fetchone()
+            lookups = self.hits + self.misses
+            return {
+                "enabled": self.enabled,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 4) if lookups else None,
+                "evictions": self.evictions,
+                "entries": entries,
+                "size_bytes": size,
+            }
+
+llm_cache = LLMCache(
+    path=os.getenv("LLM_CACHE_PATH", os.path.join(os.path.abspath(os.path.dirname(__file__)), "llm_cache.sqlite")),
+    max_bytes=int(os.getenv("LLM_CACHE_MAX_BYTES", 512 * 1024 * 1024)),
+    ttl=float(os.getenv("LLM_CACHE_TTL", 30 * 24 * 3600)),
+    enabled=os.getenv("LLM_CACHE_ENABLED", "true").lower() == "true",
+)
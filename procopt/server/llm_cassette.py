@@ -0,0 +1,161 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+import zlib
+from typing import Any, Dict, List, Optional, Tuple
+import litellm
+from dotenv import load_dotenv
+from pydantic import BaseModel
+load_dotenv()
+
+########################################################
+# LLM cassettes
+#
+# In `record` mode every provider response of `call_llm` / `acall_llm` is
+# written to a cassette (a SQLite file of zlib-compressed responses) under a
+# hash of the normalized request, along with how long the call took; streams
+# from `stream_llm` are stored as their deltas and the gaps between them. In
+# `replay` mode the same requests are answered from the cassette without
+# touching the network, so the Flask app and the pipeline can be load tested
+# offline and produce exactly the outputs that were recorded. A request missing
+# from the cassette raises `CassetteMissError` rather than reaching the provider.
+#
+# Replay timing: `instant` returns at once, `recorded` waits as long as the
+# recorded call took (or between deltas, as long as the provider did) and
+# `scaled` waits that long times `time_scale`.
+########################################################
+
+CASSETTE_MODES: Tuple[str, ...] = ("off", "record", "replay")
+REPLAY_TIMINGS: Tuple[str, ...] = ("instant", "recorded", "scaled")
+VOLATILE_KWARGS: Tuple[str, ...] = ("api_key", "api_base", "timeout", "num_retries", "metadata") # Don't change the output, left out of the key
+
+class CassetteMissError(LookupError):
+    """The request wasn't recorded in the cassette being replayed"""
+
+class LLMCassette:
+    def __init__(self, path: str, mode: str = "off", timing: str = "recorded", time_scale: float = 1.0):
+        if mode not in CASSETTE_MODES:
+            raise ValueError(f"Invalid cassette mode `{mode}`, expected one of {list(CASSETTE_MODES)}")
+        if timing not in REPLAY_TIMINGS:
+            raise ValueError(f"Invalid replay timing `{timing}`, expected one of {list(REPLAY_TIMINGS)}")
+        self.path = path
+        self.mode = mode
+        self.timing = timing
+        self.time_scale = time_scale
+        self.recorded = 0
+        self.replayed = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._conn: Optional[sqlite3.Connection] = None
+        self._entries: Optional[Dict[str, Tuple[bytes, float]]] = None # Replay reads the whole cassette once
+
+    @property
+    def recording(self) -> bool:
+        return self.mode == "record"
+
+    @property
+    def replaying(self) -> bool:
+        return self.mode == "replay"
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._conn is None:
+            self._conn = sqlite3.connect(self.path, check_same_thread=False, timeout=30)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("""
+                CREATE TABLE IF NOT EXISTS llm_cassette (
+                    key TEXT PRIMARY KEY,
+                    model TEXT NOT NULL,
+                    response BLOB NOT NULL,
+                    latency REAL NOT NULL,
+                    recorded_at REAL NOT NULL
+                )
+            """)
+            self._conn.commit()
+        return self._conn
+
+    @staticmethod
+    def make_key(model: str, messages: List[Dict], response_format: Optional[BaseModel], kwargs: Dict[str, Any]) -> str:
+        """Hash of the request with keys sorted and transport-only kwargs dropped, so the same prompt
+        recorded by one process is found by another"""
+        payload = {
+            "model": model,
+            "messages": messages,
+            "response_format": response_format.model_json_schema() if response_format else None,
+            "kwargs": { key: value for key, value in kwargs.items() if key not in VOLATILE_KWARGS },
+        }
+        return hashlib.sha256(json.dumps(payload, sort_keys=True, separators=(",", ":"), default=str).encode("utf-8")).hexdigest()
+
+    def record(self, key: str, model: str, response, latency: float) -> None:
+        """Store the provider's response to the request `key`, replacing an earlier recording"""
+        self._store(key, model, response.model_dump(), latency)
+
+    def record_stream(self, key: str, model: str, deltas: List[Tuple[float, str]], completion_tokens: Optional[int]) -> None:
+        """Store a completed stream as its (seconds since the previous delta, text) pairs"""
+        self._store(key, model, { "deltas": deltas, "completion_tokens": completion_tokens }, sum(gap for gap, _ in deltas))
+
+    def _store(self, key: str, model: str, payload: Dict[str, Any], latency: float) -> None:
+        data = zlib.compress(json.dumps(payload, default=str).encode("utf-8"))
+        with self._lock:
+            conn = self._connect()
+            conn.execute(
+                "INSERT OR REPLACE INTO llm_cassette (key, model, response, latency, recorded_at) VALUES (?, ?, ?, ?, ?)",
+                (key, model, data, latency, time.time())
+            )
+            conn.commit()
+            self.recorded += 1
+
+    def replay(self, key: str) -> Tuple[litellm.ModelResponse, float]:
+        """The recorded response to the request `key` and how long to wait before returning it"""
+        payload, latency = self._load(key)
+        return litellm.ModelResponse(**payload), self.delay(latency)
+
+    def replay_stream(self, key: str) -> Tuple[List[Tuple[float, str]], Optional[int]]:
+        """The recorded stream for the request `key`: (seconds to wait, text) per delta, and its completion tokens"""
+        payload, _ = self._load(key)
+        return [ (self.delay(gap), text) for gap, text in payload["deltas"] ], payload["completion_tokens"]
+
+    def _load(self, key: str) -> Tuple[Dict[str, Any], float]:
+        with self._lock:
+            if self._entries is None:
+                rows = self._connect().execute("SELECT key, response, latency FROM llm_cassette").fetchall()
+                self._entries = { row[0]: (row[1], row[2]) for row in rows }
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                raise CassetteMissError(f"No recorded response for request {key[:12]} in cassette `{self.path}`")
+            self.replayed += 1
+        data, latency = entry
+        return json.loads(zlib.decompress(data)), latency
+
+    def delay(self, latency: float) -> float:
+        if self.timing == "instant":
+            return 0.0
+        if self.timing == "scaled":
+            return latency * self.time_scale
+        return latency
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            entries, size = (0, 0)
+            if self.mode != "off":
+                entries, size = self._connect().execute("SELECT COUNT(*), COALESCE(SUM(LENGTH(response)), 0) FROM llm_cassette").fetchone()
+            return {
+                "mode": self.mode,
+                "timing": self.timing,
+                "time_scale": self.time_scale,
+                "recorded": self.recorded,
+                "replayed": self.replayed,
+                "misses": self.misses,
+                "entries": entries,
+                "size_bytes": size,
+            }
+
+llm_cassette = LLMCassette(
+    path=os.getenv("LLM_CASSETTE_PATH", os.path.join(os.path.abspath(os.path.dirname(__file__)), "llm_cassette.sqlite")),
+    mode=os.getenv("LLM_CASSETTE_MODE", "off").lower(),
+    timing=os.getenv("LLM_REPLAY_TIMING", "recorded").lower(),
+    time_scale=float(os.getenv("LLM_REPLAY_TIME_SCALE", 1.0)),
+)
@@ -1,24 +1,35 @@
+import asyncio
+import contextvars
+import threading
+import time
 import traceback
-from PIL import Image
-import io
+from collections import deque
+import httpx
 import re
 import json
 import litellm
-import numpy as np
 from openai import OpenAI
 import base64
-from typing import Union, List, Optional
+from typing import Any, Deque, Dict, Iterator, List, Optional, Tuple, Union
 from dotenv import load_dotenv
 import os
-from typing import Union, Dict
 from pydantic import BaseModel
-from procopt.server.utils import encode_image, remove_markdown
-from procopt.server.prompt_models import TranscriptionOutputModel
+from procopt.server import tracing
+from procopt.server.llm_cache import llm_cache
+from procopt.server.llm_cassette import llm_cassette
+from procopt.server.metrics import llm_cost, llm_errors, llm_request_seconds, llm_requests, llm_tokens
+from procopt.server.utils import encode_image
+from procopt.server.prompt_models import BottleneckOutputModel, ImprovementOutputModel, TranscriptionOutputModel
 load_dotenv()
 
 IS_TEST: bool = False
 SYSTEM_PROMPT: str = "You are a process optimization consultant. Your client has provided you with a process map and your job is to analyze it."
 MODEL: str = "gpt-4o-mini"
+LLM_MAX_CONNECTIONS: int = int(os.getenv("LLM_MAX_CONNECTIONS", 256)) # Size of the shared async HTTP connection pool
+LLM_TIMEOUT: float = float(os.getenv("LLM_TIMEOUT", 600))
+
+_async_loop: Optional[asyncio.AbstractEventLoop] = None
+_async_loop_lock = threading.Lock()
 
 def sys_prompt(additional_context: str = '') -> Dict[str, str]:
     return { 
@@ -54,7 +65,7 @@ def get_image_prompt(image_bytes_or_path: Union[str, bytes] = None,
     if isinstance(image_bytes_or_path, str):
         image_bytes = encode_image(image_bytes_or_path)
     else:
-        image_bytes = base64.b64encode(image_bytes_or_path).decode('utf-8')
+        image_bytes = base64.b64encode(image_bytes_or_path).decode('ascii')
     return {
         "type": "image_url",
         "image_url": {
@@ -62,24 +73,269 @@ def get_image_prompt(image_bytes_or_path: Union[str, bytes] = None,
         },
     }
 
-def call_llm(messages: List[Dict[str, str]], model: str = MODEL, response_format: Optional[BaseModel] = None, **kwargs) -> Union[BaseModel, str]:
+def parse_llm_response(response, response_format: Optional[BaseModel] = None) -> Union[BaseModel, str]:
+    if response_format:
+        return response_format(**json.loads(response.choices[0].message.content))
+    return response.choices[0].message.content
+
+def record_llm_call(model: str, response, seconds: float, outcome: str = "ok") -> Dict[str, Any]:
+    """Record latency, token usage and estimated cost of a completed provider (or replayed) call. Returns the usage"""
+    llm_requests.inc(model=model, outcome=outcome)
+    llm_request_seconds.observe(seconds, model=model)
+    usage = getattr(response, "usage", None)
+    prompt_tokens = (usage.prompt_tokens or 0) if usage else 0
+    completion_tokens = (usage.completion_tokens or 0) if usage else 0
+    llm_tokens.inc(prompt_tokens, model=model, kind="prompt")
+    llm_tokens.inc(completion_tokens, model=model, kind="completion")
+    try:
+        cost = litellm.completion_cost(completion_response=response)
+        llm_cost.inc(cost, model=model)
+    except Exception:
+        cost = None # Models missing from litellm's price list
+    return { "prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens, "cost_usd": cost }
+
+def record_llm_error(model: str, error: Exception) -> None:
+    llm_requests.inc(model=model, outcome="error")
+    llm_errors.inc(model=model, error=type(error).__name__)
+
+def _completion(model: str, messages: List[Dict[str, str]], response_format: Optional[BaseModel], kwargs: Dict[str, Any]) -> Tuple[Any, str]:
+    """The provider's response, or its recording when replaying a cassette. Returns (response, outcome)"""
+    if llm_cassette.mode == "off":
+        return litellm.completion(model=model, response_format=response_format, messages=messages, **kwargs), "ok"
+    key = llm_cassette.make_key(model, messages, response_format, kwargs)
+    if llm_cassette.replaying:
+        response, delay = llm_cassette.replay(key)
+        time.sleep(delay)
+        return response, "replayed"
+    start = time.perf_counter()
+    response = litellm.completion(model=model, response_format=response_format, messages=messages, **kwargs)
+    llm_cassette.record(key, model, response, time.perf_counter() - start)
+    return response, "ok"
+
+def call_llm(messages: List[Dict[str, str]], model: str = MODEL, response_format: Optional[BaseModel] = None, bypass_cache: bool = False, **kwargs) -> Union[BaseModel, str]:
+    """Call the LLM. Structured (`response_format`) outputs are served from / stored in `llm_cache`;
+    `bypass_cache=True` skips the lookup (forced reprocessing) but still refreshes the stored entry.
+    Provider calls are recorded to / replayed from `llm_cassette` when LLM_CASSETTE_MODE is set."""
     try:
-        response = litellm.completion(
-            model=model,
-            response_format=response_format,
-            messages=messages,
-            **kwargs
-        )
-        
-        if response_format:
-            return response_format(**json.loads(response.choices[0].message.content))
-        return response.choices[0].message.content
+        with tracing.span("llm_call", model=model, response_format=getattr(response_format, "__name__", None)) as llm_span:
+            cache_key: Optional[str] = llm_cache.make_key(model, messages, response_format, kwargs) if response_format else None
+            # While recording a cassette every call goes to the provider, so the cassette holds them all
+            if cache_key and not bypass_cache and not llm_cassette.recording:
+                cached = llm_cache.get(cache_key, response_format)
+                if cached is not None:
+                    llm_requests.inc(model=model, outcome="cached")
+                    llm_span.set(cached=True)
+                    return cached
+
+            start = time.perf_counter()
+            response, outcome = _completion(model, messages, response_format, kwargs)
+            llm_span.set(cached=False, replayed=outcome == "replayed", **record_llm_call(model, response, time.perf_counter() - start, outcome))
+            
+            result = parse_llm_response(response, response_format)
+            if cache_key:
+                llm_cache.set(cache_key, result)
+            return result
     except Exception as e:
         traceback.print_exc()
         print(f"Error in call_llm: {str(e)}")
+        record_llm_error(model, e)
+        raise e
+
+########################################################
+# Async LLM calls
+#
+# All async calls share one event loop (running in a daemon thread) and one
+# pooled httpx client, so a single thread can keep hundreds of requests in flight.
+# Synchronous code (pipeline steps, Flask handlers) submits coroutines with `run_async()`.
+########################################################
+
+def get_async_loop() -> asyncio.AbstractEventLoop:
+    """Return the process-wide event loop used for async LLM calls, starting it on first use"""
+    global _async_loop
+    with _async_loop_lock:
+        if _async_loop is None:
+            loop = asyncio.new_event_loop()
+            litellm.aclient_session = httpx.AsyncClient(
+                limits=httpx.Limits(max_connections=LLM_MAX_CONNECTIONS, max_keepalive_connections=LLM_MAX_CONNECTIONS),
+                timeout=LLM_TIMEOUT,
+            )
+            threading.Thread(target=loop.run_forever, name="llm-event-loop", daemon=True).start()
+            _async_loop = loop
+    return _async_loop
+
+def run_async(coro):
+    """Run a coroutine on the shared LLM event loop and block until it finishes.
+    The coroutine sees the caller's context variables (e.g. its trace span)"""
+    context = contextvars.copy_context()
+    async def _in_context():
+        for var, value in context.items():
+            var.set(value)
+        return await coro
+    return asyncio.run_coroutine_threadsafe(_in_context(), get_async_loop()).result()
+
+async def _acompletion(model: str, messages: List[Dict[str, str]], response_format: Optional[BaseModel], kwargs: Dict[str, Any]) -> Tuple[Any, str]:
+    """Async counterpart of `_completion`"""
+    if llm_cassette.mode == "off":
+        return await litellm.acompletion(model=model, response_format=response_format, messages=messages, **kwargs), "ok"
+    key = llm_cassette.make_key(model, messages, response_format, kwargs)
+    if llm_cassette.replaying:
+        response, delay = await asyncio.to_thread(llm_cassette.replay, key)
+        await asyncio.sleep(delay)
+        return response, "replayed"
+    start = time.perf_counter()
+    response = await litellm.acompletion(model=model, response_format=response_format, messages=messages, **kwargs)
+    await asyncio.to_thread(llm_cassette.record, key, model, response, time.perf_counter() - start)
+    return response, "ok"
+
+async def acall_llm(messages: List[Dict[str, str]], model: str = MODEL, response_format: Optional[BaseModel] = None, bypass_cache: bool = False, **kwargs) -> Union[BaseModel, str]:
+    """Async counterpart of `call_llm`. Must run on the shared loop (see `run_async`)"""
+    try:
+        with tracing.span("llm_call", model=model, response_format=getattr(response_format, "__name__", None)) as llm_span:
+            cache_key: Optional[str] = llm_cache.make_key(model, messages, response_format, kwargs) if response_format else None
+            if cache_key and not bypass_cache and not llm_cassette.recording:
+                cached = await asyncio.to_thread(llm_cache.get, cache_key, response_format)
+                if cached is not None:
+                    llm_requests.inc(model=model, outcome="cached")
+                    llm_span.set(cached=True)
+                    return cached
+
+            start = time.perf_counter()
+            response, outcome = await _acompletion(model, messages, response_format, kwargs)
+            llm_span.set(cached=False, replayed=outcome == "replayed", **record_llm_call(model, response, time.perf_counter() - start, outcome))
+
+            result = parse_llm_response(response, response_format)
+            if cache_key:
+                await asyncio.to_thread(llm_cache.set, cache_key, result)
+            return result
+    except Exception as e:
+        traceback.print_exc()
+        print(f"Error in acall_llm: {str(e)}")
+        record_llm_error(model, e)
         raise e
 
 
+########################################################
+# Streaming LLM calls
+#
+# Text completions (chat) can be streamed so the user sees the first tokens
+# instead of waiting for the whole generation. Time-to-first-token and
+# throughput of each stream are recorded in `stream_stats`.
+########################################################
+
+class StreamStats:
+    """Rolling time-to-first-token / tokens-per-second stats of recent completed streams"""
+    def __init__(self, window: int = 200):
+        self.streams = 0
+        self.cancelled = 0
+        self.errors = 0
+        self._recent: Deque[Dict[str, Any]] = deque(maxlen=window)
+        self._lock = threading.Lock()
+
+    def record(self, outcome: str, **stats) -> None:
+        with self._lock:
+            self.streams += 1
+            self.cancelled += outcome == "cancelled"
+            self.errors += outcome == "error"
+            if outcome == "completed" and stats.get("ttft_seconds") is not None:
+                self._recent.append(stats)
+
+    def summary(self) -> Dict[str, Any]:
+        with self._lock:
+            ttfts = sorted(stats["ttft_seconds"] for stats in self._recent)
+            rates = [ stats["tokens_per_second"] for stats in self._recent if stats.get("tokens_per_second") ]
+            return {
+                "streams": self.streams,
+                "cancelled": self.cancelled,
+                "errors": self.errors,
+                "ttft_avg_s": round(sum(ttfts) / len(ttfts), 3) if ttfts else None,
+                "ttft_p95_s": round(ttfts[min(len(ttfts) - 1, int(0.95 * len(ttfts)))], 3) if ttfts else None,
+                "tokens_per_second_avg": round(sum(rates) / len(rates), 1) if rates else None,
+            }
+
+stream_stats = StreamStats()
+
+def _stream_chunks(response) -> Iterator[Tuple[Optional[str], Optional[int]]]:
+    """(content delta, completion tokens if reported) of each chunk of a litellm stream"""
+    for chunk in response:
+        usage = getattr(chunk, "usage", None)
+        yield (chunk.choices[0].delta.content if chunk.choices else None), (usage.completion_tokens if usage else None)
+
+def _replay_chunks(key: str) -> Iterator[Tuple[Optional[str], Optional[int]]]:
+    """`_stream_chunks` of a stream recorded in `llm_cassette`, paced by its replay timing"""
+    deltas, completion_tokens = llm_cassette.replay_stream(key)
+    for delay, delta in deltas:
+        if delay:
+            time.sleep(delay)
+        yield delta, None
+    yield None, completion_tokens
+
+def stream_llm(messages: List[Dict[str, str]], model: str = MODEL, stats: Optional[Dict[str, Any]] = None, **kwargs) -> Iterator[str]:
+    """Stream a text completion, yielding content deltas as they arrive.
+
+    Closing the generator early (e.g. the client disconnected) closes the upstream
+    connection. Timing and token counts are written into `stats` (if given) when the
+    stream ends, and recorded in `stream_stats`. Completed streams are recorded to /
+    replayed from `llm_cassette` when LLM_CASSETTE_MODE is set.
+    """
+    start = time.perf_counter()
+    first_token_at: Optional[float] = None
+    completion_tokens: Optional[int] = None
+    parts: List[str] = []
+    gaps: List[Tuple[float, str]] = [] # (seconds since the previous delta, delta) for the cassette
+    outcome = "cancelled"
+    response = None
+    cassette_key: Optional[str] = llm_cassette.make_key(model, messages, None, { **kwargs, "stream": True }) if llm_cassette.mode != "off" else None
+    try:
+        # Opening the stream is inside the `try` so connection, auth and rate limit errors are counted too
+        if llm_cassette.replaying:
+            chunks = _replay_chunks(cassette_key)
+        else:
+            response = litellm.completion(model=model, messages=messages, stream=True, stream_options={"include_usage": True}, **kwargs)
+            chunks = _stream_chunks(response)
+        previous_at = start
+        for delta, chunk_tokens in chunks:
+            if chunk_tokens:
+                completion_tokens = chunk_tokens
+            if delta:
+                now = time.perf_counter()
+                if first_token_at is None:
+                    first_token_at = now
+                gaps.append((round(now - previous_at, 4), delta))
+                previous_at = now
+                parts.append(delta)
+                yield delta
+        if llm_cassette.recording:
+            llm_cassette.record_stream(cassette_key, model, gaps, completion_tokens)
+        outcome = "completed"
+    except Exception as e:
+        outcome = "error"
+        llm_errors.inc(model=model, error=type(e).__name__)
+        print(f"Error in stream_llm: {str(e)}")
+        raise e
+    finally:
+        if outcome != "completed":
+            # Stop the provider from generating (and billing) tokens nobody will read
+            close = getattr(getattr(response, "completion_stream", None), "close", None)
+            if close:
+                close()
+        end = time.perf_counter()
+        if completion_tokens is None and parts:
+            completion_tokens = litellm.token_counter(model=model, text="".join(parts))
+        generation_seconds = end - first_token_at if first_token_at is not None else None
+        result = {
+            "outcome": outcome,
+            "ttft_seconds": round(first_token_at - start, 3) if first_token_at is not None else None,
+            "total_seconds": round(end - start, 3),
+            "completion_tokens": completion_tokens or 0,
+            "tokens_per_second": round(completion_tokens / generation_seconds, 1) if completion_tokens and generation_seconds else None,
+        }
+        stream_stats.record(**result)
+        llm_requests.inc(model=model, outcome={ "completed": "replayed" if llm_cassette.replaying else "ok" }.get(outcome, outcome))
+        llm_request_seconds.observe(end - start, model=model)
+        llm_tokens.inc(completion_tokens or 0, model=model, kind="completion")
+        if stats is not None:
+            stats.update(result)
+
 def generate_chat_history(image_bytes: Union[str, bytes] = None, 
                           image_format: str = None, 
                           transcription: str = None, 
@@ -125,10 +381,8 @@ def generate_chat_history(image_bytes: Union[str, bytes] = None,
         ]
     return content
 
-def transcribe_process_map_from_image(**kwargs) -> str:
-    """Use VLM to generate a textual version from an image of a process map"""
-    if IS_TEST: return "QUICK TEST RESPONSE"
-    messages = [
+def _transcribe_process_map_from_image_messages(**kwargs) -> List[Dict[str, str]]:
+    return [
         sys_prompt(),
         { 
             "role": "user",
@@ -140,13 +394,21 @@ def transcribe_process_map_from_image(**kwargs) -> str:
             ]
         }
     ]
-    response = call_llm(messages=messages, model=MODEL, response_format=TranscriptionOutputModel)
+
+def transcribe_process_map_from_image(**kwargs) -> str:
+    """Use VLM to generate a textual version from an image of a process map"""
+    if IS_TEST: return "QUICK TEST RESPONSE"
+    response = call_llm(messages=_transcribe_process_map_from_image_messages(**kwargs), model=MODEL, response_format=TranscriptionOutputModel)
     return response
 
-def identify_bottlenecks(**kwargs) -> str:
-    """Use VLM to identify bottlenecks in a process map"""
+async def atranscribe_process_map_from_image(**kwargs) -> str:
+    """Async version of `transcribe_process_map_from_image`"""
     if IS_TEST: return "QUICK TEST RESPONSE"
-    messages = [
+    response = await acall_llm(messages=_transcribe_process_map_from_image_messages(**kwargs), model=MODEL, response_format=TranscriptionOutputModel)
+    return response
+
+def _identify_bottlenecks_messages(**kwargs) -> List[Dict[str, str]]:
+    return [
         sys_prompt(),
         { 
             "role": "user",
@@ -158,13 +420,21 @@ def identify_bottlenecks(**kwargs) -> str:
             ]
         }
     ]
-    response = call_llm(messages=messages, model=MODEL, response_format=TranscriptionOutputModel)
+
+def identify_bottlenecks(**kwargs) -> str:
+    """Use VLM to identify bottlenecks in a process map"""
+    if IS_TEST: return "QUICK TEST RESPONSE"
+    response = call_llm(messages=_identify_bottlenecks_messages(**kwargs), model=MODEL, response_format=TranscriptionOutputModel)
     return response
 
-def generate_improvements(**kwargs) -> str:
-    """Use VLM to suggest improvements to a process map"""
+async def aidentify_bottlenecks(**kwargs) -> BottleneckOutputModel:
+    """Async version of `identify_bottlenecks`, parsed as bottlenecks"""
     if IS_TEST: return "QUICK TEST RESPONSE"
-    messages = [
+    response = await acall_llm(messages=_identify_bottlenecks_messages(**kwargs), model=MODEL, response_format=BottleneckOutputModel)
+    return response
+
+def _generate_improvements_messages(**kwargs) -> List[Dict[str, str]]:
+    return [
         { 
             "role" : "system",
             "content" : SYSTEM_PROMPT,
@@ -179,7 +449,17 @@ def generate_improvements(**kwargs) -> str:
             ]
         }
     ]
-    response = call_llm(messages=messages, model=MODEL, response_format=TranscriptionOutputModel)
+
+def generate_improvements(**kwargs) -> str:
+    """Use VLM to suggest improvements to a process map"""
+    if IS_TEST: return "QUICK TEST RESPONSE"
+    response = call_llm(messages=_generate_improvements_messages(**kwargs), model=MODEL, response_format=TranscriptionOutputModel)
+    return response
+
+async def agenerate_improvements(**kwargs) -> ImprovementOutputModel:
+    """Async version of `generate_improvements`, parsed as improvements"""
+    if IS_TEST: return "QUICK TEST RESPONSE"
+    response = await acall_llm(messages=_generate_improvements_messages(**kwargs), model=MODEL, response_format=ImprovementOutputModel)
     return response
 
 def sort_improvements(**kwargs) -> str:
@@ -202,106 +482,3 @@ def sort_improvements(**kwargs) -> str:
     ]
     response = call_llm(messages=messages, model=MODEL, response_format=TranscriptionOutputModel)
     return response
-
-
-def process_blocks_with_sliding_window(blocks: List[Image.Image]) -> List[str]:
-    """Process blocks using 2x2 grid sliding window approach"""
-    results = []
-    num_blocks = len(blocks)
-    num_cols = int(np.ceil(np.sqrt(num_blocks)))  
-    
-    print(f"Processing {num_blocks} blocks in {num_cols}x{num_cols} grid")
-    
-    def combine_grid_blocks(grid_blocks):
-        if not grid_blocks or len(grid_blocks) < 4:
-            return None
-            
-        
-        block_width = grid_blocks[0].width
-        block_height = grid_blocks[0].height
-        combined_image = Image.new('RGB', (block_width * 2, block_height * 2))
-        
-        
-        positions = [
-            (0, 0),      # top left
-            (block_width, 0),  # top right
-            (0, block_height),  # bottom left
-            (block_width, block_height)  # bottom right
-        ]
-        
-        for block, pos in zip(grid_blocks[:4], positions):
-            combined_image.paste(block, pos)
-            
-        return combined_image
-    
-    
-    for row in range(0, num_cols - 1, 2):
-        for col in range(0, num_cols - 1, 2):
-            
-            indices = [
-                row * num_cols + col,          
-                row * num_cols + col + 1,       
-                (row + 1) * num_cols + col,     
-                (row + 1) * num_cols + col + 1  
-            ]
-
-            grid_blocks = [blocks[i] for i in indices if i < num_blocks]
-            
-            if len(grid_blocks) < 4:
-                continue  # Skip incomplete grids
-                
-            print(f"Processing grid at row {row}, col {col}")
-            combined_image = combine_grid_blocks(grid_blocks)
-            
-            if combined_image:
-                buffer = io.BytesIO()
-                combined_image.save(buffer, format="PNG")
-                block_bytes = buffer.getvalue()
-                
-                try:
-                    result = transcribe_process_map_from_image(
-                        image_bytes=block_bytes,
-                        image_format="png"
-                    )
-                    print(f"Successfully processed grid at ({row}, {col})")
-                    results.append(remove_markdown(result))
-                except Exception as e:
-                    print(f"Error processing grid at ({row}, {col}): {str(e)}")
-
-    remaining_blocks = []
-    last_full_grid = ((num_cols - 1) // 2) * 2
-    
-    for row in range(last_full_grid, num_cols):
-        for col in range(num_cols):
-            idx = row * num_cols + col
-            if idx < num_blocks:
-                remaining_blocks.append(blocks[idx])
-    
-    if remaining_blocks:
-        print(f"Processing {len(remaining_blocks)} remaining blocks")
-        # Combine remaining blocks horizontally
-        total_width = sum(block.width for block in remaining_blocks)
-        max_height = max(block.height for block in remaining_blocks)
-        combined_image = Image.new('RGB', (total_width, max_height))
-        
-        x_offset = 0
-        for block in remaining_blocks:
-            combined_image.paste(block, (x_offset, 0))
-            x_offset += block.width
-            
-        buffer = io.BytesIO()
-        combined_image.save(buffer, format="PNG")
-        block_bytes = buffer.getvalue()
-        
-        try:
-            result = transcribe_process_map_from_image(
-                image_bytes=block_bytes,
-                image_format="png"
-            )
-            print("Successfully processed remaining blocks")
-            results.append(remove_markdown(result))
-        except Exception as e:
-            print(f"Error processing remaining blocks: {str(e)}")
-    
-    return results
-
@@ -0,0 +1,370 @@
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from difflib import SequenceMatcher
+from typing import Callable, Dict, List, NamedTuple, Optional, Set, Tuple
+import litellm
+from procopt.server import tracing
+from procopt.server.llm_utils import MODEL, call_llm, get_user_text_prompt, sys_prompt
+from procopt.server.prompt_models import MergeTranscriptionOutputModel, StepModel
+from procopt.server.prompts import prompt__resolve_merge_conflicts
+from procopt.server.utils import Box, TranscriptionOutputModel
+
+########################################################
+# Merging tile transcriptions
+#
+# Steps from all tiles are merged locally: copies of a step (same number,
+# compatible names and fields) are combined, and transitions pointing at a
+# truncated or misspelled step name are pointed at the step they clearly mean.
+# Only what can't be settled locally goes to the model, one call per conflict:
+#   - a step number transcribed with divergent names or field values,
+#   - the same step under two numbers in neighbouring tiles (a misread number
+#     across a tile boundary),
+#   - a transition that could refer to more than one step.
+# A map whose tiles agree is merged without any LLM call.
+#
+# `merge_hierarchically` bounds the work per LLM call on large maps: tiles are
+# split into spatial neighbourhoods (a k-d split of their boxes), each small
+# neighbourhood is merged by the model, and neighbourhoods are then merged
+# pairwise up the tree, where only steps that conflict across the seam go to
+# the model. Every level runs in parallel, so latency grows with the depth of
+# the tree (log of the number of tiles) rather than the size of the map.
+########################################################
+
+MERGE_NAME_SIMILARITY: float = 0.85 # Names/values at least this similar are the same text transcribed differently
+MERGE_DUPLICATE_SIMILARITY: float = 0.9 # Stricter bar for the same step under two numbers
+MERGE_MAX_TOKEN_STEPS: int = 50 # Words shared by more steps than this don't suggest duplicates
+MERGE_CONCURRENCY: int = 8 # Max conflict-resolution calls at once
+MERGE_TILE_MARGIN: int = 50 # Tiles this close (in pixels) count as neighbours
+MERGE_OUTLINE_STEPS: int = 60 # Agreed steps listed as context with each conflict, nearest numbers first
+MERGE_GROUP_TILES: int = 4 # Max tiles merged by one LLM call in hierarchical merges
+MERGE_MAX_PROMPT_TOKENS: int = 12000 # Max transcription tokens merged by one LLM call
+
+SCALAR_FIELDS = ("operator", "system", "material", "timing", "frequency")
+LIST_FIELDS = ("pain_points", "transitions")
+
+class Conflict(NamedTuple):
+    description: str
+    steps: List[StepModel] # Every version of the steps involved, as transcribed
+
+def normalize_text(text: Optional[str]) -> str:
+    return " ".join(re.findall(r"[a-z0-9]+", (text or "").lower()))
+
+def normalize_name(name: Optional[str]) -> str:
+    """Lowercase alphanumeric words of a step name, without a leading "Step 3:" label"""
+    return normalize_text(re.sub(r"^\s*step\s*#?\s*\d+\s*[:.)\-]?\s*", "", name or "", flags=re.IGNORECASE))
+
+def texts_match(a: str, b: str, threshold: float = MERGE_NAME_SIMILARITY) -> bool:
+    """Whether two normalized texts are the same text, allowing for OCR noise and truncation at a tile edge"""
+    if not a or not b or a == b:
+        return True
+    if min(len(a), len(b)) >= 4 and (a.startswith(b) or b.startswith(a)):
+        return True
+    matcher = SequenceMatcher(None, a, b)
+    return matcher.real_quick_ratio() >= threshold and matcher.quick_ratio() >= threshold and matcher.ratio() >= threshold
+
+def combine_steps(steps: List[StepModel], strict: bool = True) -> Tuple[Optional[StepModel], Optional[str]]:
+    """Merge copies of one step. With `strict`, returns (None, why) if the copies disagree; otherwise
+    the first non-empty value of each field wins"""
+    first = steps[0]
+    if strict:
+        names = [ normalize_name(step.name) for step in steps ]
+        if not all(texts_match(names[0], name) for name in names[1:]):
+            return None, f"Step {first.step_number} was transcribed with different names: " + ", ".join(f'"{step.name}"' for step in steps)
+
+    merged = first.model_copy(deep=True)
+    if strict:
+        # Copies cut off at a tile edge are shorter, so the longest version is the most complete
+        merged.name = max((step.name for step in steps), key=len)
+    for field in SCALAR_FIELDS:
+        values = [ getattr(step, field) for step in steps if getattr(step, field) ]
+        if not values:
+            continue
+        if strict:
+            normalized = [ normalize_text(value) for value in values ]
+            if not all(texts_match(normalized[0], value) for value in normalized[1:]):
+                return None, f"Step {first.step_number} has different {field} values: " + ", ".join(f'"{value}"' for value in dict.fromkeys(values))
+            setattr(merged, field, max(values, key=len))
+        else:
+            setattr(merged, field, values[0])
+    for field in LIST_FIELDS:
+        items: Dict[str, str] = {}
+        for step in steps:
+            for item in getattr(step, field):
+                items.setdefault(normalize_text(item), item)
+        setattr(merged, field, list(items.values()))
+    return merged, None
+
+def combine_by_number(steps: List[StepModel]) -> List[StepModel]:
+    """Combine steps that share a number without checking for conflicts, sorted by number"""
+    by_number: Dict[int, List[StepModel]] = {}
+    for step in steps:
+        by_number.setdefault(step.step_number, []).append(step)
+    return [ combine_steps(by_number[number], strict=False)[0] for number in sorted(by_number) ]
+
+def tiles_adjacent(a: Optional[Box], b: Optional[Box], margin: int = MERGE_TILE_MARGIN) -> bool:
+    """Whether two tiles overlap or touch. Results without a box (the page's text layer) neighbour every tile"""
+    if a is None or b is None:
+        return True
+    return a[0] - margin <= b[2] and b[0] - margin <= a[2] and a[1] - margin <= b[3] and b[1] - margin <= a[3]
+
+def format_conflict(conflict: Conflict) -> str:
+    """The conflict's description, then each version of its steps in the StepModel format"""
+    versions = "\n".join(step.model_dump_json(exclude_none=True) for step in conflict.steps)
+    return f"{conflict.description}\n\nAs transcribed in the chunks:\n{versions}"
+
+class _UnionFind:
+    def __init__(self, size: int):
+        self.parent = list(range(size))
+
+    def find(self, idx: int) -> int:
+        while self.parent[idx] != idx:
+            self.parent[idx] = self.parent[self.parent[idx]]
+            idx = self.parent[idx]
+        return idx
+
+    def union(self, a: int, b: int) -> None:
+        self.parent[self.find(a)] = self.find(b)
+
+def merge_locally(block_results: List[TranscriptionOutputModel], boxes: Optional[List[Optional[Box]]] = None) -> Tuple[List[StepModel], List[Conflict], Dict]:
+    """Merge everything the tiles agree on. Returns the merged steps (sorted by number), the conflicts
+    left for the model, and stats. `boxes[i]` is the tile `block_results[i]` was transcribed from"""
+    boxes = boxes if boxes is not None else [ None ] * len(block_results)
+
+    # 1. Combine copies of each step number
+    copies: Dict[int, List[StepModel]] = {}
+    sources: Dict[int, Set[int]] = {}
+    for block_idx, result in enumerate(block_results):
+        if not result.is_valid:
+            continue
+        for step in result.steps:
+            copies.setdefault(step.step_number, []).append(step)
+            sources.setdefault(step.step_number, set()).add(block_idx)
+
+    merged: Dict[int, StepModel] = {}
+    descriptions: Dict[int, List[str]] = {} # step number -> why it's in conflict
+    num_divergent = 0
+    for number in sorted(copies):
+        step, reason = combine_steps(copies[number])
+        if step is None:
+            num_divergent += 1
+            descriptions.setdefault(number, []).append(reason)
+            step, _ = combine_steps(copies[number], strict=False)
+        merged[number] = step
+    numbers = sorted(merged)
+    names = { number: normalize_name(merged[number].name) for number in numbers }
+
+    # 2. The same step under two numbers: matching names, never seen in the same tile, in neighbouring tiles
+    linked = _UnionFind(len(numbers))
+    position = { number: idx for idx, number in enumerate(numbers) }
+    by_word: Dict[str, List[int]] = {}
+    for number in numbers:
+        for word in set(names[number].split()):
+            if len(word) >= 3:
+                by_word.setdefault(word, []).append(number)
+    candidate_pairs: Set[Tuple[int, int]] = set()
+    for group in by_word.values():
+        if len(group) <= MERGE_MAX_TOKEN_STEPS:
+            candidate_pairs.update((a, b) for i, a in enumerate(group) for b in group[i + 1:])
+    num_duplicates = 0
+    for a, b in sorted(candidate_pairs):
+        if sources[a] & sources[b] or SequenceMatcher(None, names[a], names[b]).ratio() < MERGE_DUPLICATE_SIMILARITY:
+            continue
+        if not any(tiles_adjacent(boxes[i], boxes[j]) for i in sources[a] for j in sources[b]):
+            continue
+        num_duplicates += 1
+        linked.union(position[a], position[b])
+        descriptions.setdefault(a, []).append(f'Steps {a} and {b} may be the same step "{merged[a].name}" transcribed with different numbers in neighbouring chunks')
+
+    # 3. Transitions: exact step names or "Step N" are fine, a unique close match is repaired, several are ambiguous
+    by_name: Dict[str, int] = { name: number for number, name in names.items() if name }
+    num_repaired, num_unresolved = 0, 0
+    for number in numbers:
+        step = merged[number]
+        transitions: List[str] = []
+        for transition in step.transitions:
+            reference = re.match(r"^\s*(?:step\s*)?#?\s*(\d+)\b", transition, flags=re.IGNORECASE)
+            target = normalize_name(transition)
+            if (reference and int(reference.group(1)) in merged) or target in by_name:
+                transitions.append(transition)
+                continue
+            matches = sorted({ other for name, other in by_name.items() if other != number and texts_match(target, name) }) if target else []
+            if len(matches) == 1:
+                transitions.append(merged[matches[0]].name)
+                num_repaired += 1
+            else:
+                transitions.append(transition)
+                if len(matches) > 1:
+                    descriptions.setdefault(number, []).append(
+                        f'Step {number} transitions to "{transition}", which could be any of: ' + ", ".join(f'"{merged[other].name}"' for other in matches))
+                else:
+                    num_unresolved += 1 # Usually a target outside the map (e.g. "End") or in a tile that failed
+        step.transitions = transitions
+
+    # Group linked conflicts, so each step is resolved in a single call
+    conflict_roots = { linked.find(position[number]) for number in descriptions }
+    groups: Dict[int, List[int]] = {}
+    for number in numbers:
+        root = linked.find(position[number])
+        if root in conflict_roots:
+            groups.setdefault(root, []).append(number)
+    conflicts = [
+        Conflict(
+            description="\n".join(reason for number in group for reason in descriptions.get(number, [])),
+            steps=[ copy for number in group for copy in copies[number] ],
+        )
+        for group in groups.values()
+    ]
+    in_conflict = { number for group in groups.values() for number in group }
+    steps = [ merged[number] for number in numbers if number not in in_conflict ]
+    return steps, conflicts, {
+        "merge_steps_in": sum(len(group) for group in copies.values()),
+        "merge_divergent_steps": num_divergent,
+        "merge_duplicate_conflicts": num_duplicates,
+        "merge_transitions_repaired": num_repaired,
+        "merge_transitions_unresolved": num_unresolved,
+        "merge_conflicts": len(conflicts),
+    }
+
+def conflict_outline(steps: List[StepModel], conflict: Conflict, limit: int = MERGE_OUTLINE_STEPS) -> str:
+    """The `limit` agreed steps numbered closest to the conflict's, so the prompt stays bounded on large maps"""
+    numbers = { step.step_number for step in conflict.steps }
+    nearest = sorted(steps, key=lambda step: min(abs(step.step_number - number) for number in numbers))[:limit]
+    return "\n".join(f"- Step {step.step_number}: {step.name}" for step in sorted(nearest, key=lambda step: step.step_number))
+
+def resolve_conflict(conflict: Conflict, outline: str, llm: Callable = call_llm, bypass_cache: bool = False) -> List[StepModel]:
+    """Ask the model what the steps in `conflict` should be"""
+    response: MergeTranscriptionOutputModel = llm(
+        messages=[
+            sys_prompt(),
+            get_user_text_prompt(prompt__resolve_merge_conflicts(format_conflict(conflict), outline)),
+        ],
+        model=MODEL,
+        response_format=MergeTranscriptionOutputModel,
+        bypass_cache=bypass_cache
+    )
+    return response.steps
+
+def merge_steps(block_results: List[TranscriptionOutputModel], boxes: Optional[List[Optional[Box]]] = None, llm: Callable = call_llm,
+                bypass_cache: bool = False, max_workers: int = MERGE_CONCURRENCY, stats: Optional[Dict] = None) -> List[StepModel]:
+    """Merge tile transcriptions into one list of steps sorted by number, calling `llm` only for conflicts.
+    Merge stats are written into `stats` if given"""
+    start = time.perf_counter()
+    steps, conflicts, merge_stats = merge_locally(block_results, boxes)
+
+    resolved: List[List[StepModel]] = []
+    num_failed = 0
+    if conflicts:
+        def _resolve(conflict: Conflict) -> Optional[List[StepModel]]:
+            try:
+                return resolve_conflict(conflict, conflict_outline(steps, conflict), llm=llm, bypass_cache=bypass_cache)
+            except Exception as e:
+                print(f"Error resolving merge conflict, merging it locally instead: {str(e)}")
+                return None
+
+        with ThreadPoolExecutor(max_workers=max(1, max_workers), thread_name_prefix="merge") as executor:
+            for conflict, result in zip(conflicts, executor.map(tracing.in_current_context(_resolve), conflicts)):
+                if result is None:
+                    num_failed += 1
+                    result = combine_by_number(conflict.steps)
+                resolved.append(result)
+
+    # Resolved steps that reuse the number of an agreed step are folded into it
+    merged = combine_by_number(steps + [ step for result in resolved for step in result ])
+
+    print(f"Merged {merge_stats['merge_steps_in']} transcribed steps into {len(merged)} steps with {len(conflicts)} conflicts sent to the model")
+    if stats is not None:
+        stats.update(merge_stats, merge_llm_calls=len(conflicts), merge_llm_failed=num_failed, merge_seconds=round(time.perf_counter() - start, 3))
+    return merged
+
+class MergeNode:
+    """A spatial neighbourhood of tiles in a hierarchical merge. Leaves hold up to MERGE_GROUP_TILES tiles"""
+    def __init__(self, tiles: List[int], box: Optional[Box], children: Tuple["MergeNode", ...] = ()):
+        self.tiles = tiles # Indices of the block results covered
+        self.box = box # Bounding box of the tiles, None if it includes the page's text layer
+        self.children = children
+        self.height: int = 1 + max(child.height for child in children) if children else 0
+        self.steps: List[StepModel] = []
+
+def bounding_box(boxes: List[Optional[Box]]) -> Optional[Box]:
+    if not boxes or any(box is None for box in boxes):
+        return None
+    return (min(box[0] for box in boxes), min(box[1] for box in boxes), max(box[2] for box in boxes), max(box[3] for box in boxes))
+
+def build_merge_tree(boxes: List[Optional[Box]], tokens: List[int], group_tiles: int = MERGE_GROUP_TILES, max_tokens: int = MERGE_MAX_PROMPT_TOKENS) -> MergeNode:
+    """Split tiles in half along their wider axis until each group has at most `group_tiles` tiles
+    and `max_tokens` tokens of transcription. Results without a box (the text layer) join at the root"""
+    def _split(indices: List[int]) -> MergeNode:
+        box = bounding_box([ boxes[idx] for idx in indices ])
+        if len(indices) <= 1 or (len(indices) <= group_tiles and sum(tokens[idx] for idx in indices) <= max_tokens):
+            return MergeNode(indices, box)
+        axis = 0 if box[2] - box[0] >= box[3] - box[1] else 1
+        ordered = sorted(indices, key=lambda idx: boxes[idx][axis] + boxes[idx][axis + 2])
+        half = len(ordered) // 2
+        return MergeNode(indices, box, (_split(ordered[:half]), _split(ordered[half:])))
+
+    tiled = [ idx for idx, box in enumerate(boxes) if box is not None ]
+    untiled = [ idx for idx, box in enumerate(boxes) if box is None ]
+    root = _split(tiled) if tiled else None
+    if untiled:
+        page = MergeNode(untiled, None)
+        root = MergeNode(tiled + untiled, None, (root, page)) if root else page
+    return root
+
+def merge_hierarchically(block_results: List[TranscriptionOutputModel], boxes: Optional[List[Optional[Box]]], merge_group: Callable[[List[TranscriptionOutputModel]], List[StepModel]],
+                         llm: Callable = call_llm, bypass_cache: bool = False, group_tiles: int = MERGE_GROUP_TILES, max_tokens: int = MERGE_MAX_PROMPT_TOKENS,
+                         max_workers: int = MERGE_CONCURRENCY, stats: Optional[Dict] = None) -> MergeTranscriptionOutputModel:
+    """Map-reduce merge: `merge_group` merges each leaf neighbourhood (e.g. with one LLM call), then
+    sibling neighbourhoods are merged with `merge_steps`, one tree level at a time, each level in parallel"""
+    start = time.perf_counter()
+    boxes = boxes if boxes is not None else [ None ] * len(block_results)
+    tokens = [ litellm.token_counter(model=MODEL, text=result.model_dump_json()) for result in block_results ]
+    root = build_merge_tree(boxes, tokens, group_tiles, max_tokens)
+
+    levels: Dict[int, List[MergeNode]] = {}
+    pending = [ root ] if root else []
+    while pending:
+        node = pending.pop()
+        levels.setdefault(node.height, []).append(node)
+        pending.extend(node.children)
+
+    totals: Dict[str, int] = { "merge_llm_calls": 0, "merge_conflicts": 0, "merge_llm_failed": 0 }
+    totals_lock = threading.Lock()
+
+    def _merge_node(node: MergeNode) -> None:
+        with tracing.span("merge_node", level=node.height, tiles=len(node.tiles)):
+            _merge_node_steps(node)
+
+    def _merge_node_steps(node: MergeNode) -> None:
+        node_stats: Dict = { "merge_llm_calls": 0, "merge_conflicts": 0, "merge_llm_failed": 0 }
+        if node.children:
+            node.steps = merge_steps(
+                [ TranscriptionOutputModel(thinking="", is_valid=True, steps=child.steps) for child in node.children ],
+                boxes=[ child.box for child in node.children ], llm=llm, bypass_cache=bypass_cache, stats=node_stats,
+            )
+        elif len(node.tiles) == 1:
+            node.steps = combine_by_number(block_results[node.tiles[0]].steps)
+        else:
+            try:
+                node.steps = merge_group([ block_results[idx] for idx in node.tiles ])
+                node_stats["merge_llm_calls"] = 1
+            except Exception as e:
+                print(f"Error merging tiles {node.tiles}, merging them locally instead: {str(e)}")
+                node.steps = merge_steps([ block_results[idx] for idx in node.tiles ], boxes=[ boxes[idx] for idx in node.tiles ],
+                                         llm=llm, bypass_cache=bypass_cache, stats=node_stats)
+                node_stats["merge_llm_failed"] += 1
+        with totals_lock:
+            for key in totals:
+                totals[key] += node_stats.get(key, 0)
+
+    with ThreadPoolExecutor(max_workers=max(1, max_workers), thread_name_prefix="merge-tree") as executor:
+        for height in sorted(levels):
+            list(executor.map(tracing.in_current_context(_merge_node), levels[height]))
+
+    steps = root.steps if root else []
+    print(f"Merged {len(block_results)} blocks into {len(steps)} steps over {len(levels)} levels with {totals['merge_llm_calls']} LLM calls")
+    if stats is not None:
+        group_tokens = [ sum(tokens[idx] for idx in node.tiles) for node in levels.get(0, []) if len(node.tiles) > 1 ]
+        stats.update(totals, merge_levels=len(levels), merge_max_group_tokens=max(group_tokens, default=0), merge_seconds=round(time.perf_counter() - start, 3))
+    return MergeTranscriptionOutputModel(thinking=f"Merged {len(block_results)} blocks hierarchically over {len(levels)} levels", steps=steps)
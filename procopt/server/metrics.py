@@ -0,0 +1,165 @@
+import abc
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterator, List, Optional, Sequence, Tuple
+
+########################################################
+# Metrics
+#
+# Process-wide counters and histograms, rendered in the Prometheus text format
+# on /metrics. Recording a sample is a dict lookup and an add under a lock, so
+# instrumenting every LLM call and tile costs nothing next to the calls
+# themselves. Values are per process and reset on restart, which Prometheus'
+# rate()/increase() handle.
+########################################################
+
+LabelValues = Tuple[str, ...]
+
+LATENCY_BUCKETS: Tuple[float, ...] = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120, 300)
+STAGE_BUCKETS: Tuple[float, ...] = (0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+def _format_labels(names: Sequence[str], values: Sequence[str]) -> str:
+    if not names:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(str(value))}"' for name, value in zip(names, values)) + "}"
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value))
+
+class Metric(abc.ABC):
+    kind = "untyped"
+
+    def __init__(self, name: str, help: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+
+    def _key(self, labels: Dict[str, str]) -> LabelValues:
+        return tuple(str(labels.get(name, "")) for name in self.labelnames)
+
+    @abc.abstractmethod
+    def samples(self) -> List[Tuple[str, str, float]]:
+        """(name suffix, formatted labels, value) of every sample"""
+
+    def render(self) -> str:
+        lines = [ f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}" ]
+        lines.extend(f"{self.name}{suffix}{labels} {_format_value(value)}" for suffix, labels, value in self.samples())
+        return "\n".join(lines)
+
+class Counter(Metric):
+    kind = "counter"
+
+    def __init__(self, name: str, help: str, labelnames: Sequence[str] = ()):
+        super().__init__(name, help, labelnames)
+        self._values: Dict[LabelValues, float] = {}
+
+    def inc(self, amount: float = 1.0, **labels) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def samples(self) -> List[Tuple[str, str, float]]:
+        with self._lock:
+            values = sorted(self._values.items())
+        return [ ("", _format_labels(self.labelnames, key), value) for key, value in values ]
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, help: str, labelnames: Sequence[str] = (), buckets: Sequence[float] = LATENCY_BUCKETS):
+        super().__init__(name, help, labelnames)
+        self.buckets = tuple(sorted(buckets))
+        self._counts: Dict[LabelValues, List[int]] = {} # Per bucket (not cumulative), the last one is +Inf
+        self._sums: Dict[LabelValues, float] = {}
+
+    def observe(self, value: float, **labels) -> None:
+        key = self._key(labels)
+        idx = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            counts = self._counts.get(key)
+            if counts is None:
+                counts = self._counts[key] = [0] * (len(self.buckets) + 1)
+                self._sums[key] = 0.0
+            counts[idx] += 1
+            self._sums[key] += value
+
+    @contextmanager
+    def time(self, **labels) -> Iterator[None]:
+        """Observe the duration of the `with` block, also when it raises"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def samples(self) -> List[Tuple[str, str, float]]:
+        with self._lock:
+            series = sorted((key, list(counts), self._sums[key]) for key, counts in self._counts.items())
+        samples: List[Tuple[str, str, float]] = []
+        for key, counts, total in series:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                samples.append(("_bucket", _format_labels(self.labelnames + ("le",), key + (_format_value(bound),)), cumulative))
+            samples.append(("_sum", _format_labels(self.labelnames, key), total))
+            samples.append(("_count", _format_labels(self.labelnames, key), cumulative))
+        return samples
+
+class Gauge(Metric):
+    """Value(s) computed when scraped: `collect()` returns {label values: value}"""
+    kind = "gauge"
+
+    def __init__(self, name: str, help: str, labelnames: Sequence[str] = (), collect: Optional[Callable[[], Dict[LabelValues, float]]] = None):
+        super().__init__(name, help, labelnames)
+        self.collect = collect
+
+    def samples(self) -> List[Tuple[str, str, float]]:
+        values = self.collect() if self.collect else {}
+        return [ ("", _format_labels(self.labelnames, key), value) for key, value in sorted(values.items()) ]
+
+class MetricsRegistry:
+    def __init__(self):
+        self._metrics: Dict[str, Metric] = {}
+        self._lock = threading.Lock()
+
+    def register(self, metric: Metric) -> Metric:
+        with self._lock:
+            self._metrics[metric.name] = metric
+        return metric
+
+    def render(self) -> str:
+        """All metrics in the Prometheus text exposition format (version 0.0.4)"""
+        with self._lock:
+            metrics = list(self._metrics.values())
+        blocks = []
+        for metric in metrics:
+            try:
+                blocks.append(metric.render())
+            except Exception as e:
+                # A failing gauge callback shouldn't take the other metrics down with it
+                print(f"Error rendering metric `{metric.name}`: {str(e)}")
+        return "\n".join(blocks) + "\n"
+
+registry = MetricsRegistry()
+
+llm_requests = registry.register(Counter("procopt_llm_requests_total", "LLM calls by model and outcome (ok, cached, replayed, error)", ["model", "outcome"]))
+llm_errors = registry.register(Counter("procopt_llm_errors_total", "Failed LLM calls by model and exception type", ["model", "error"]))
+llm_request_seconds = registry.register(Histogram("procopt_llm_request_duration_seconds", "Latency of LLM calls that reached the provider", ["model"]))
+llm_tokens = registry.register(Counter("procopt_llm_tokens_total", "Tokens used by LLM calls, by model and kind (prompt, completion)", ["model", "kind"]))
+llm_cost = registry.register(Counter("procopt_llm_cost_usd_total", "Estimated cost of LLM calls in USD", ["model"]))
+stage_seconds = registry.register(Histogram(
+    "procopt_pipeline_stage_duration_seconds",
+    "Duration of pipeline stages: split, encode and tile (per tile), transcribe, merge, bottlenecks, improvements",
+    ["stage"], buckets=STAGE_BUCKETS,
+))
+pipeline_steps = registry.register(Counter("procopt_pipeline_steps_total", "Pipeline steps run, by step and outcome (ok, failed)", ["step", "outcome"]))
+tiles_total = registry.register(Counter("procopt_tiles_total", "Tiles by outcome (transcribed, failed, reused, blank)", ["outcome"]))
+job_retries = registry.register(Counter("procopt_job_retries_total", "Failed jobs put back in the queue for another attempt, by step", ["step"]))
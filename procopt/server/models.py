@@ -1,18 +1,137 @@
 from datetime import datetime
-from sqlalchemy import Column, Integer, String, Text, DateTime
+from sqlalchemy import Boolean, Column, DateTime, Float, ForeignKey, Index, Integer, String, Text
 from sqlalchemy.orm import DeclarativeBase
 
 class Base(DeclarativeBase):
     pass
 
+class Batch(Base):
+    """A group of runs uploaded together via /batches"""
+    __tablename__ = 'batch'
+
+    id = Column(Integer, primary_key=True)
+    steps = Column(String(100), nullable=False, default="transcribe") # Comma-separated pipeline steps each run goes through
+    num_files = Column(Integer, default=0)
+    total_bytes = Column(Integer, default=0)
+    created_at = Column(DateTime, default=datetime.utcnow)
+
 class ProcessRun(Base):
     __tablename__ = 'process_run'
+    __table_args__ = (
+        # Keyset pagination of /runs, newest first, optionally filtered by status
+        Index('ix_process_run_created_at_id', 'created_at', 'id'),
+        Index('ix_process_run_status_created_at_id', 'status', 'created_at', 'id'),
+    )
     
     id = Column(Integer, primary_key=True)
     image_path = Column(String(255), nullable=False)
-    transcription = Column(Text, nullable=True)
-    bottlenecks = Column(Text, nullable=True)
-    improvements = Column(Text, nullable=True)
+    transcription = Column(Text, nullable=True) # Markdown of the run's RunStep rows, cached (see results.py)
+    bottlenecks = Column(Text, nullable=True) # Markdown of the run's RunBottleneck rows, cached
+    improvements = Column(Text, nullable=True) # Markdown of the run's RunImprovement rows, cached
     status = Column(String(50), default="uploaded")
+    stats = Column(Text, nullable=True) # JSON-encoded per-run processing stats
+    tiling_strategy = Column(String(50), nullable=True) # One of tiling.TILING_STRATEGIES, app default if unset
+    source_path = Column(String(255), nullable=True) # Uploaded PDF this run's page is rasterized from
+    page_number = Column(Integer, nullable=True) # 0-indexed page of `source_path`
+    batch_id = Column(Integer, ForeignKey('batch.id'), nullable=True, index=True)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+class RunStep(Base):
+    """A transcribed step of a run's process map (prompt_models.StepModel)"""
+    __tablename__ = 'run_step'
+    __table_args__ = (Index('ix_run_step_run_id_step_number', 'run_id', 'step_number'),)
+
+    id = Column(Integer, primary_key=True)
+    run_id = Column(Integer, ForeignKey('process_run.id'), nullable=False)
+    position = Column(Integer, nullable=False) # Order within the run
+    step_number = Column(Integer, nullable=False)
+    name = Column(String(255), nullable=False)
+    operator = Column(Text, nullable=True)
+    system = Column(Text, nullable=True)
+    material = Column(Text, nullable=True)
+    timing = Column(Text, nullable=True)
+    frequency = Column(Text, nullable=True)
+    pain_points = Column(Text, nullable=False, default="[]") # JSON-encoded list of strings
+    transitions = Column(Text, nullable=False, default="[]") # JSON-encoded list of step names
+
+class RunBottleneck(Base):
+    """A bottleneck identified in a run (prompt_models.BottleneckModel)"""
+    __tablename__ = 'run_bottleneck'
+    __table_args__ = (Index('ix_run_bottleneck_run_id_step_number', 'run_id', 'step_number'),)
+
+    id = Column(Integer, primary_key=True)
+    run_id = Column(Integer, ForeignKey('process_run.id'), nullable=False)
+    position = Column(Integer, nullable=False)
+    step_number = Column(Integer, nullable=False)
+    description = Column(Text, nullable=False)
+    impact = Column(Text, nullable=False)
+
+class RunImprovement(Base):
+    """An improvement suggested for a run's bottleneck (prompt_models.ImprovementModel)"""
+    __tablename__ = 'run_improvement'
+
+    id = Column(Integer, primary_key=True)
+    run_id = Column(Integer, ForeignKey('process_run.id'), nullable=False, index=True)
+    position = Column(Integer, nullable=False)
+    bottleneck_id = Column(Integer, nullable=False)
+    description = Column(Text, nullable=False)
+    impacted_steps = Column(Text, nullable=False, default="[]") # JSON-encoded list of step numbers
+    impact = Column(Text, nullable=False)
+    timeline = Column(Text, nullable=False)
+
+class Job(Base):
+    """A queued pipeline step, leased by one worker at a time (see jobs.py)"""
+    __tablename__ = 'job'
+    __table_args__ = (Index('ix_job_status_available_at', 'status', 'available_at'),)
+
+    id = Column(Integer, primary_key=True)
+    run_id = Column(Integer, ForeignKey('process_run.id'), nullable=False, index=True)
+    batch_id = Column(Integer, nullable=True) # Copied from the run; jobs are claimed fairly across batches
+    step = Column(String(50), nullable=False)
+    bypass_cache = Column(Boolean, default=False)
+    status = Column(String(20), default="queued") # queued, running, done, failed
+    attempts = Column(Integer, default=0)
+    max_attempts = Column(Integer, default=3)
+    lease_token = Column(String(36), nullable=True)
+    lease_expires_at = Column(DateTime, nullable=True)
+    available_at = Column(DateTime, default=datetime.utcnow)
+    error = Column(Text, nullable=True)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    started_at = Column(DateTime, nullable=True)
+    finished_at = Column(DateTime, nullable=True)
+
+class TileResult(Base):
+    """Transcription of one tile of a run, keyed by a fingerprint of the tile's pixels (see tile_results.py)"""
+    __tablename__ = 'tile_result'
+
+    id = Column(Integer, primary_key=True)
+    run_id = Column(Integer, ForeignKey('process_run.id'), nullable=False, index=True)
+    tile_index = Column(Integer, nullable=False)
+    box = Column(String(100), nullable=False) # JSON-encoded [left, upper, right, lower]
+    fingerprint = Column(String(64), nullable=False, index=True)
+    result = Column(Text, nullable=False) # JSON-encoded TranscriptionOutputModel
+    created_at = Column(DateTime, default=datetime.utcnow)
+
+class ChatSession(Base):
+    """A chat about one run. Older turns are folded into `summary` (see chat_sessions.py)"""
+    __tablename__ = 'chat_session'
+
+    id = Column(Integer, primary_key=True)
+    run_id = Column(Integer, ForeignKey('process_run.id'), nullable=False, index=True)
+    summary = Column(Text, nullable=True) # Rolling summary of the messages up to `summarized_through_id`
+    summarized_through_id = Column(Integer, nullable=True) # Last ChatMessage.id folded into `summary`
+    created_at = Column(DateTime, default=datetime.utcnow)
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+class ChatMessage(Base):
+    __tablename__ = 'chat_message'
+
+    id = Column(Integer, primary_key=True)
+    session_id = Column(Integer, ForeignKey('chat_session.id'), nullable=False, index=True)
+    role = Column(String(20), nullable=False) # user, assistant
+    content = Column(Text, nullable=False)
+    tokens = Column(Integer, nullable=False, default=0) # Token count of `content`
+    prompt_tokens = Column(Integer, nullable=True) # Assistant turns: input tokens sent to produce this reply
+    latency_seconds = Column(Float, nullable=True) # Assistant turns: time to complete the reply
     created_at = Column(DateTime, default=datetime.utcnow)
-    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
\ No newline at end of file
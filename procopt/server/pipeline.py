@@ -1,17 +1,50 @@
+import asyncio
+import json
+import time
 import traceback
-from typing import List, Tuple
-import io
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, as_completed, wait
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+import litellm
+from PIL import Image
 from tqdm import tqdm
 from procopt.server.db import db
 from procopt.server.llm_utils import MODEL, get_user_text_prompt
 from procopt.server.models import ProcessRun
-from procopt.server.prompt_models import BottleneckModel, BottleneckOutputModel, ImprovementModel, ImprovementOutputModel, MergeTranscriptionOutputModel, StepModel
+from procopt.server.prompt_models import BottleneckOutputModel, ImprovementOutputModel, MergeTranscriptionOutputModel, StepModel
+from procopt.server.encoding import TileEncoder
+from procopt.server import tracing
+from procopt.server.metrics import pipeline_steps, stage_seconds, tiles_total
+from procopt.server.merging import MERGE_GROUP_TILES, MERGE_MAX_PROMPT_TOKENS, merge_hierarchically, merge_steps
+from procopt.server.events import run_events
+from procopt.server.results import format_step_as_markdown, save_bottlenecks, save_improvements, save_steps
+from procopt.server.retrieval import run_indexes
+from procopt.server.tile_results import TileResults
+from procopt.server.tiling import DEFAULT_TILING_STRATEGY, get_tiling_strategy
+from procopt.server.vector_text import VECTOR_TEXT_MIN_CHARS, PageLayout, TextBlock, extract_page_layout, format_text_layout, has_text_layer, vision_boxes
 from procopt.server.utils import (
-    split_image_into_blocks,
+    BLANK_INK_THRESHOLD,
+    BLANK_MIN_INK_RATIO,
+    BLANK_MIN_STD,
+    GRAYSCALE_BYTES_PER_PIXEL,
+    PDF_MAX_DPI,
+    PDF_PIXEL_BUDGET,
+    Box,
+    decode_peak_bytes,
+    decoded_bytes_per_pixel,
+    find_blank_boxes,
+    get_rasterize_pool,
+    image_memory_budget,
+    iter_blocks,
+    open_image_reduced,
+    rasterize_pdf_page,
+    reduction_factor,
+    to_grayscale,
     TranscriptionOutputModel
 )
 from procopt.server.llm_utils import (
+    acall_llm,
     call_llm,
+    run_async,
     sys_prompt,
     get_text_prompt,
     get_image_prompt,
@@ -20,58 +53,97 @@ from procopt.server.prompts import (
     prompt__identify_bottlenecks,
     prompt__generate_improvements,
     prompt__merge_transcribed_process_map_blocks,
-    prompt__transcribe_process_map
+    prompt__transcribe_process_map,
+    prompt__transcribe_process_map_text_layout,
 )
 
 BLOCK_SIZE = 1000  
+TRANSCRIBE_MAX_TOKENS: int = 4000 # Output tokens per tile transcription
+TEXT_LAYOUT_MAX_TOKENS: int = 16000 # Cap on the text layer transcription, below gpt-4o-mini's 16384 output tokens
+TRANSCRIBE_CONCURRENCY = 8 # Max number of tiles sent to the vision model at once
+TRANSCRIBE_MODE = "threads" # "threads" (thread pool + call_llm) or "async" (shared event loop + acall_llm)
+MERGE_MODE = "local" # "local" (deterministic merge, LLM only for conflicts), "llm" (one merge call over every step) or "hierarchical"
 
-def format_improvement_as_markdown(improvement: ImprovementModel) -> str:
-    """Given an ImprovementModel, format it as a markdown string"""
-    improvement_desc: List[str] = [f"#### Improvement for Bottleneck #{improvement.bottleneck_id}"]
-    improvement_desc.append(f"- Description: {improvement.description}")
-    improvement_desc.append(f"- Impacted Steps: {improvement.impacted_steps}")
-    improvement_desc.append(f"- Impact: {improvement.impact}")
-    improvement_desc.append(f"- Timeline: {improvement.timeline}")
-    return "\n".join(improvement_desc)
-
-def format_bottleneck_as_markdown(bottleneck: BottleneckModel) -> str:
-    """Given a BottleneckModel, format it as a markdown string"""
-    bottleneck_desc: List[str] = [f"#### Bottleneck for Step #{bottleneck.step_number}"]
-    bottleneck_desc.append(f"- Description: {bottleneck.description}")
-    bottleneck_desc.append(f"- Impact: {bottleneck.impact}")
-    return "\n".join(bottleneck_desc)
-
-def format_step_as_markdown(step: StepModel) -> str:
-    """Given a StepModel, format it as a markdown string"""
-    step_desc = [f"#### Step {step.step_number}: {step.name}"]
-    step_desc.append(f"Number: {step.step_number}")
-
-    # Only include fields that have values
-    if step.operator:
-        step_desc.append(f"- Operator: {step.operator}")
-    if step.system:
-        step_desc.append(f"- System: {step.system}")
-    if step.material:
-        step_desc.append(f"- Material: {step.material}")
-    if step.timing:
-        step_desc.append(f"- Timing: {step.timing}")
-    if step.frequency:
-        step_desc.append(f"- Frequency: {step.frequency}")
-    
-    if step.pain_points:
-        step_desc.append("- Pain Points:")
-        for point in step.pain_points:
-            step_desc.append(f"  - {point}")
-    
-    if step.transitions:
-        step_desc.append("- Transitions:")
-        for transition in step.transitions:
-            step_desc.append(f"  - {transition}")
+# Called with (tile index, number of tiles, result or None if the call failed) as each tile finishes.
+# Results the model marked invalid are passed too, so they can be stored and reused
+TileCallback = Callable[[int, int, Optional[TranscriptionOutputModel]], None]
+
+def plan_tiles(config, gray, tiling_strategy: str = DEFAULT_TILING_STRATEGY) -> Tuple[List[Box], int]:
+    """Compute the boxes to transcribe with the given tiling strategy, dropping blank ones
+    if BLANK_TILE_FILTER is enabled. Returns the kept boxes and the number of boxes before filtering."""
+    boxes = get_tiling_strategy(tiling_strategy)(gray, config.get("BLOCK_SIZE", BLOCK_SIZE))
+    num_tiles = len(boxes)
+    if config.get("BLANK_TILE_FILTER", True):
+        blank_mask = find_blank_boxes(
+            gray, boxes,
+            ink_threshold=config.get("BLANK_TILE_INK_THRESHOLD", BLANK_INK_THRESHOLD),
+            min_ink_ratio=config.get("BLANK_TILE_MIN_INK_RATIO", BLANK_MIN_INK_RATIO),
+            min_std=config.get("BLANK_TILE_MIN_STD", BLANK_MIN_STD),
+        )
+        boxes = [ box for box, is_blank in zip(boxes, blank_mask) if not is_blank ]
+    return boxes, num_tiles
+
+def update_run_stats(run: ProcessRun, **stats) -> None:
+    """Merge `stats` into the run's JSON-encoded stats"""
+    current = json.loads(run.stats) if run.stats else {}
+    current.update(stats)
+    run.stats = json.dumps(current)
+
+def set_run_status(run: ProcessRun, status: str) -> None:
+    """Commit a status transition and publish it to the run's event stream"""
+    run.status = status
+    db.session.commit()
+    run_events.publish(run.id, "status", status=status)
+
+def render_page_image(config, run: ProcessRun) -> None:
+    """Rasterize the run's PDF page in the shared process pool. The page is re-rendered on every
+    transcription, so it always matches the PDF its text layer is read from"""
+    if not run.source_path:
+        return
+    raster_stats = get_rasterize_pool().submit(
+        rasterize_pdf_page,
+        run.source_path,
+        run.page_number or 0,
+        run.image_path,
+        config.get("PDF_PIXEL_BUDGET", PDF_PIXEL_BUDGET),
+        config.get("PDF_MAX_DPI", PDF_MAX_DPI),
+    ).result()
+    print(f"Rasterized page {raster_stats['page_number'] + 1}/{raster_stats['page_count']} at {raster_stats['dpi']} DPI in {raster_stats['rasterize_seconds']}s")
+    update_run_stats(run, **raster_stats)
+
+def merge_block_results(block_results: List[TranscriptionOutputModel], bypass_cache: bool = False, boxes: Optional[List[Optional[Box]]] = None,
+                        mode: str = MERGE_MODE, stats: Optional[Dict] = None, max_prompt_tokens: int = MERGE_MAX_PROMPT_TOKENS,
+                        group_tiles: int = MERGE_GROUP_TILES) -> List[StepModel]:
+    """Synthesize results from blocks into a coherent process description.
+
+    In "local" mode steps are merged deterministically and only conflicts between tiles go to the
+    model (see merging.py); `boxes[i]` is the tile `block_results[i]` came from. "llm" mode rewrites
+    the whole map in one merge call, or hierarchically once that call's prompt would exceed
+    `max_prompt_tokens`. "hierarchical" mode always merges neighbourhoods of `group_tiles` tiles
+    with the model, then merges their results pairwise. Merge stats are written into `stats` if given.
+    """
+    if mode == "local":
+        return merge_steps(block_results, boxes=boxes, llm=call_llm, bypass_cache=bypass_cache, stats=stats)
+
+    if mode == "llm":
+        start = time.perf_counter()
+        markdown = merge_blocks_markdown(block_results)
+        prompt_tokens = litellm.token_counter(model=MODEL, text=markdown)
+        if prompt_tokens <= max_prompt_tokens:
+            steps = llm_merge_markdown(markdown, bypass_cache=bypass_cache)
+            if stats is not None:
+                stats.update(merge_llm_calls=1, merge_seconds=round(time.perf_counter() - start, 3))
+            return steps
+        print(f"Merge prompt of {prompt_tokens} tokens is over the {max_prompt_tokens} token limit, merging hierarchically")
 
-    return "\n".join(step_desc)
+    return merge_hierarchically(
+        block_results, boxes,
+        merge_group=lambda blocks: llm_merge_markdown(merge_blocks_markdown(blocks), bypass_cache=bypass_cache),
+        llm=call_llm, bypass_cache=bypass_cache, group_tiles=group_tiles, max_tokens=max_prompt_tokens, stats=stats,
+    ).steps
 
-def merge_block_results(block_results: List[TranscriptionOutputModel]) -> List[StepModel]:
-    """Synthesize results from blocks into a coherent process description"""
+def merge_blocks_markdown(block_results: List[TranscriptionOutputModel]) -> str:
+    """Steps of all blocks with duplicate step numbers combined, as markdown for the merge prompt"""
     all_steps = []
     for result in block_results:
         if result.is_valid:
@@ -101,116 +173,426 @@ def merge_block_results(block_results: List[TranscriptionOutputModel]) -> List[S
         format_step_as_markdown(seen_steps[step_num])
         for step_num in sorted(seen_steps.keys())
     ]
-    
-    print(f"Merging {len(markdown_lines)} chunks together...")
+    return '\n'.join(markdown_lines)
+
+def llm_merge_markdown(markdown: str, bypass_cache: bool = False) -> List[StepModel]:
+    """Merge the steps in `markdown` (see `merge_blocks_markdown`) with one LLM call"""
+    print(f"Merging {markdown.count('#### Step')} chunks together...")
     merged_transcription = call_llm(
         messages=[
             sys_prompt(),
-            get_user_text_prompt(prompt__merge_transcribed_process_map_blocks('\n'.join(markdown_lines))),
+            get_user_text_prompt(prompt__merge_transcribed_process_map_blocks(markdown)),
         ],
         model=MODEL,
-        response_format=MergeTranscriptionOutputModel
+        response_format=MergeTranscriptionOutputModel,
+        bypass_cache=bypass_cache
     )
     print(f"Merged transcription: # steps={len(merged_transcription.steps)}")
 
     return merged_transcription.steps
 
-def run_pipeline(app, run_id: int, pipeline_step: str) -> Tuple[str, str]:
-    """Process a task based on its type"""
+def transcribe_block_messages(block_bytes: bytes, image_format: str = "png") -> List[Dict]:
+    return [
+        sys_prompt(),
+        {
+            "role": "user",
+            "content": [
+                get_text_prompt(prompt__transcribe_process_map()),
+                get_image_prompt(block_bytes, image_format),
+            ]
+        }
+    ]
+
+def encode_tile(block_image: Image.Image, encoder: Optional[TileEncoder] = None) -> Tuple[bytes, str]:
+    with stage_seconds.time(stage="encode"), tracing.span("encode", width=block_image.width, height=block_image.height) as encode_span:
+        block_bytes, image_format = (encoder or TileEncoder()).encode(block_image)
+        encode_span.set(bytes=len(block_bytes), format=image_format)
+        return block_bytes, image_format
+
+def transcribe_block(block_image: Image.Image, encoder: Optional[TileEncoder] = None, bypass_cache: bool = False) -> TranscriptionOutputModel:
+    """Encode a single tile and transcribe it with the vision model"""
+    block_bytes, image_format = encode_tile(block_image, encoder)
+    return call_llm(
+        messages=transcribe_block_messages(block_bytes, image_format),
+        model=MODEL,
+        max_tokens=TRANSCRIBE_MAX_TOKENS,
+        response_format=TranscriptionOutputModel,
+        bypass_cache=bypass_cache
+    )
+
+async def atranscribe_block(block_image: Image.Image, encoder: Optional[TileEncoder] = None, bypass_cache: bool = False) -> TranscriptionOutputModel:
+    """Async version of `transcribe_block`. Encoding runs in a worker thread to keep the loop free"""
+    block_bytes, image_format = await asyncio.to_thread(encode_tile, block_image, encoder)
+    return await acall_llm(
+        messages=transcribe_block_messages(block_bytes, image_format),
+        model=MODEL,
+        max_tokens=TRANSCRIBE_MAX_TOKENS,
+        response_format=TranscriptionOutputModel,
+        bypass_cache=bypass_cache
+    )
+
+def transcribe_text_layout(text_blocks: List[TextBlock], bypass_cache: bool = False) -> TranscriptionOutputModel:
+    """Transcribe a vector PDF page from its text layer in a single text-only call"""
+    layout = format_text_layout(text_blocks)
+    # The answer restates every text block with structure around it, so it grows with the layout
+    max_tokens = min(TEXT_LAYOUT_MAX_TOKENS, max(TRANSCRIBE_MAX_TOKENS, 2 * litellm.token_counter(model=MODEL, text=layout)))
+    return call_llm(
+        messages=[
+            sys_prompt(),
+            get_user_text_prompt(prompt__transcribe_process_map_text_layout(layout)),
+        ],
+        model=MODEL,
+        max_tokens=max_tokens,
+        response_format=TranscriptionOutputModel,
+        bypass_cache=bypass_cache
+    )
+
+def transcribe_blocks(blocks: Iterable[Image.Image], num_blocks: Optional[int] = None, max_workers: int = TRANSCRIBE_CONCURRENCY, encoder: Optional[TileEncoder] = None, bypass_cache: bool = False,
+                      on_tile: Optional[TileCallback] = None) -> List[TranscriptionOutputModel]:
+    """Transcribe tiles with up to `max_workers` concurrent vision calls.
+    
+    `blocks` may be a lazy iterator: a new tile is only pulled once a worker is free, so at most
+    `max_workers` tiles are held in memory. Results are returned in tile order so that
+    `merge_block_results` sees the same sequence as the serial loop. Tiles that fail or come back
+    invalid are dropped without affecting the other tiles. `max_workers <= 1` runs the tiles serially.
+    `on_tile(idx, num_blocks, result)` is called as each tile finishes, with `None` for tiles whose call failed.
+    """
+    num_blocks = len(blocks) if num_blocks is None else num_blocks
+    results: Dict[int, Optional[TranscriptionOutputModel]] = {}
+
+    def _transcribe(idx: int, block_image: Image.Image) -> Optional[TranscriptionOutputModel]:
+        try:
+            with stage_seconds.time(stage="tile"), tracing.span("tile", tile_index=idx) as tile_span:
+                response = transcribe_block(block_image, encoder=encoder, bypass_cache=bypass_cache)
+                tile_span.set(is_valid=response.is_valid, steps=len(response.steps))
+        except Exception as e:
+            print(f"Direct API call error for block {idx + 1}/{num_blocks}: {str(e)}")
+            return None
+        if not response.is_valid:
+            print(f"Invalid transcription for block {idx + 1}/{num_blocks}")
+        else:
+            print(f"Successfully transcribed block {idx + 1}/{num_blocks}")
+        return response
+
+    with tqdm(desc="Transcribing blocks", total=num_blocks) as progress:
+        if max_workers <= 1:
+            for idx, block_image in enumerate(blocks):
+                results[idx] = _transcribe(idx, block_image)
+                progress.update(1)
+                if on_tile:
+                    on_tile(idx, num_blocks, results[idx])
+        else:
+            with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="transcribe") as executor:
+                pending: Dict[Future, int] = {}
+
+                def _collect(futures) -> None:
+                    for future in futures:
+                        idx = pending.pop(future)
+                        results[idx] = future.result()
+                        progress.update(1)
+                        if on_tile:
+                            on_tile(idx, num_blocks, results[idx])
+
+                for idx, block_image in enumerate(blocks):
+                    if len(pending) >= max_workers:
+                        done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                        _collect(done)
+                    pending[executor.submit(tracing.in_current_context(_transcribe), idx, block_image)] = idx
+                _collect(list(as_completed(pending)))
+
+    return [ results[idx] for idx in sorted(results) if results[idx] is not None and results[idx].is_valid ]
+
+async def atranscribe_blocks(blocks: Iterable[Image.Image], num_blocks: Optional[int] = None, max_concurrency: int = TRANSCRIBE_CONCURRENCY, encoder: Optional[TileEncoder] = None, bypass_cache: bool = False,
+                             on_tile: Optional[TileCallback] = None) -> List[TranscriptionOutputModel]:
+    """Async version of `transcribe_blocks`: tiles are scheduled on the shared LLM event loop,
+    with at most `max_concurrency` requests (and tiles) in flight at once"""
+    num_blocks = len(blocks) if num_blocks is None else num_blocks
+    semaphore = asyncio.Semaphore(max(1, max_concurrency))
+    progress = tqdm(desc="Transcribing blocks", total=num_blocks)
+
+    async def _transcribe_one(idx: int, block_image: Image.Image) -> Optional[TranscriptionOutputModel]:
+        try:
+            with stage_seconds.time(stage="tile"), tracing.span("tile", tile_index=idx) as tile_span:
+                response = await atranscribe_block(block_image, encoder=encoder, bypass_cache=bypass_cache)
+                tile_span.set(is_valid=response.is_valid, steps=len(response.steps))
+        except Exception as e:
+            print(f"Direct API call error for block {idx + 1}/{num_blocks}: {str(e)}")
+            return None
+        finally:
+            progress.update(1)
+            semaphore.release()
+        if not response.is_valid:
+            print(f"Invalid transcription for block {idx + 1}/{num_blocks}")
+        else:
+            print(f"Successfully transcribed block {idx + 1}/{num_blocks}")
+        return response
+
+    async def _transcribe(idx: int, block_image: Image.Image) -> Optional[TranscriptionOutputModel]:
+        result = await _transcribe_one(idx, block_image)
+        if on_tile:
+            on_tile(idx, num_blocks, result)
+        return result
+
+    try:
+        tasks = []
+        for idx, block_image in enumerate(blocks):
+            await semaphore.acquire()
+            tasks.append(asyncio.create_task(_transcribe(idx, block_image)))
+        results = await asyncio.gather(*tasks)
+    finally:
+        progress.close()
+    return [ result for result in results if result is not None and result.is_valid ]
+
+def transcribe_image(config, image_path: str, tiling_strategy: str = DEFAULT_TILING_STRATEGY, bypass_cache: bool = False,
+                     page_layout: Optional[PageLayout] = None, on_tile: Optional[TileCallback] = None,
+                     tile_results: Optional[TileResults] = None) -> Tuple[List[TranscriptionOutputModel], List[Optional[Box]], Dict]:
+    """Tile the image at `image_path` and transcribe the tiles, streaming them one at a time.
+
+    The decoded image, its grayscale copy and the in-flight tiles are reserved against the
+    process-wide `image_memory_budget`; images too large for the budget are decoded at reduced
+    resolution. If `page_layout` (the page's vector text layer) is given, it is transcribed in one
+    text-only call and only tiles it doesn't cover go to the vision model; should that call fail or
+    come back invalid, the tiles it covers are transcribed with the vision model after all. Returns the valid
+    results (text layer first, then tiles in tile order), the tile each came from (None for the
+    text layer) and tiling stats for the run.
+    `on_tile` is passed through to `transcribe_blocks` for per-tile progress. If `tile_results` is
+    given, tiles it already has a result for are reused instead of transcribed, and new results are
+    recorded in it.
+    """
+    block_size: int = config.get("BLOCK_SIZE", BLOCK_SIZE)
+    max_workers: int = config.get("TRANSCRIBE_CONCURRENCY", TRANSCRIBE_CONCURRENCY)
+    tiles_bytes = max(1, max_workers) * block_size * block_size * 3 * 2 # RGB tile + its PNG buffer
+
+    with Image.open(image_path) as header:
+        width, height = header.size
+        mode, image_format = header.mode, header.format
+    # The reduced image and its grayscale copy are held for the whole step; the decode may briefly take more
+    factor = reduction_factor(width, height, decoded_bytes_per_pixel(mode) + GRAYSCALE_BYTES_PER_PIXEL,
+                              max(image_memory_budget.limit - tiles_bytes, image_memory_budget.limit // 2))
+    reserved = decode_peak_bytes(width, height, mode, image_format, factor) + tiles_bytes
+
+    with image_memory_budget.reserve(reserved):
+        with stage_seconds.time(stage="split"), tracing.span("split", tiling_strategy=tiling_strategy, width=width, height=height, reduction_factor=factor) as split_span:
+            img = open_image_reduced(image_path, factor)
+            tiles, num_tiles = plan_tiles(config, to_grayscale(img), tiling_strategy)
+            split_span.set(tiles=num_tiles, tiles_blank=num_tiles - len(tiles))
+        num_blank = num_tiles - len(tiles)
+        tiles_total.inc(num_blank, outcome="blank")
+        print(f"Split {width}x{height} image (1/{factor} resolution) into {num_tiles} blocks with `{tiling_strategy}` tiling, skipped {num_blank} blank blocks")
+
+        encoder = TileEncoder.from_config(config)
+        boxes: List[Box] = [] # Tiles planned for the vision model, in the order they were planned
+        tile_outputs: Dict[int, TranscriptionOutputModel] = {} # Result of each tile (valid or not), by index in `boxes`
+        todo: List[int] = [] # Indices in `boxes` sent to the vision model
+
+        def _plan(new_boxes: List[Box]) -> List[int]:
+            """Append `new_boxes` to the tiles and return the indices of those that need transcribing"""
+            start = len(boxes)
+            boxes.extend(new_boxes)
+            if tile_results is None:
+                return list(range(start, len(boxes)))
+            num_reused = tile_results.num_reused
+            with tracing.span("plan_reuse", tiles=len(new_boxes)) as plan_span:
+                indices = tile_results.plan(img, new_boxes, encoder)
+                plan_span.set(tiles_reused=tile_results.num_reused - num_reused)
+            tile_outputs.update(tile_results.results)
+            tiles_total.inc(tile_results.num_reused - num_reused, outcome="reused")
+            print(f"Reusing {tile_results.num_reused - num_reused} unchanged blocks, {len(indices)} blocks left for the vision model")
+            return indices
+
+        def _transcribe(indices: List[int]) -> None:
+            def _on_tile(idx: int, num_blocks: int, result: Optional[TranscriptionOutputModel]) -> None:
+                tiles_total.inc(outcome="transcribed" if result is not None and result.is_valid else "failed")
+                if result is not None:
+                    tile_outputs[indices[idx]] = result
+                if tile_results is not None:
+                    tile_results.add(indices[idx], result)
+                if on_tile:
+                    on_tile(idx, num_blocks, result)
+
+            todo.extend(indices)
+            blocks = iter_blocks(img, [ boxes[idx] for idx in indices ])
+            if config.get("TRANSCRIBE_MODE", TRANSCRIBE_MODE) == "async":
+                run_async(atranscribe_blocks(blocks, num_blocks=len(indices), max_concurrency=max_workers, encoder=encoder, bypass_cache=bypass_cache, on_tile=_on_tile))
+            else:
+                transcribe_blocks(blocks, num_blocks=len(indices), max_workers=max_workers, encoder=encoder, bypass_cache=bypass_cache, on_tile=_on_tile)
+
+        text_result: Optional[TranscriptionOutputModel] = None
+        text_fallback = False
+        with ThreadPoolExecutor(max_workers=1) as text_executor:
+            planned = tiles
+            text_boxes: List[Box] = []
+            text_future: Optional[Future] = None
+            if page_layout:
+                # The text-only call runs alongside the vision calls for the remaining tiles
+                text_future = text_executor.submit(tracing.in_current_context(transcribe_text_layout), page_layout.text_blocks, bypass_cache)
+                covered = set(planned) - set(vision_boxes(planned, page_layout, img.width, img.height))
+                text_boxes = [ box for box in planned if box in covered ]
+                planned = [ box for box in planned if box not in covered ]
+                print(f"Transcribing {len(page_layout.text_blocks)} vector text blocks directly, {len(planned)} blocks left for the vision model")
+
+            _transcribe(_plan(planned))
+
+            if text_future is not None:
+                try:
+                    text_result = text_future.result()
+                except Exception as e:
+                    print(f"Text layer transcription failed: {str(e)}")
+                if text_result is None or not text_result.is_valid:
+                    # Like a failed tile, but one that covers many: fall back to the vision model for them
+                    text_result, text_fallback = None, True
+                    print(f"Sending the {len(text_boxes)} blocks covered by the text layer to the vision model")
+                    _transcribe(_plan(text_boxes))
+        img.close()
+
+        # In tile order, with tiles from a text layer fallback back in their place
+        tile_order = { box: position for position, box in enumerate(dict.fromkeys(tiles)) }
+        valid = sorted((idx for idx in tile_outputs if tile_outputs[idx].is_valid), key=lambda idx: tile_order[boxes[idx]])
+        block_results = [ tile_outputs[idx] for idx in valid ]
+        block_boxes: List[Optional[Box]] = [ boxes[idx] for idx in valid ]
+        if text_result is not None:
+            block_results.insert(0, text_result)
+            block_boxes.insert(0, None)
+
+    num_text_covered = num_tiles - num_blank - len(boxes)
+    num_reused = len(boxes) - len(todo)
+    return block_results, block_boxes, {
+        "tiling_strategy": tiling_strategy,
+        "image_size": [width, height],
+        "decode_reduction_factor": factor,
+        "memory_reserved_bytes": reserved,
+        "pixels_sent": sum((right - left) * (lower - upper) for left, upper, right, lower in (boxes[idx] for idx in todo)),
+        "tiles_total": num_tiles,
+        "tiles_blank_skipped": num_blank,
+        "tiles_text_covered": num_text_covered,
+        "tiles_reused": num_reused,
+        "tiles_transcribed": len(todo),
+        "tiles_valid": len(block_results),
+        "vector_text_blocks": len(page_layout.text_blocks) if page_layout else 0,
+        "vector_text_fallback": text_fallback,
+        "llm_calls_saved": num_blank + num_text_covered + num_reused - (1 if page_layout else 0),
+        **encoder.stats(),
+    }
+
+def run_pipeline(app, run_id: int, pipeline_step: str, bypass_cache: bool = False, final_attempt: bool = True) -> bool:
+    """Process a task based on its type. `bypass_cache` forces fresh LLM calls instead of cached responses.
+    Returns True if the step completed, False if it failed. A failed run is marked `<step>_failed`, or
+    `<step>_retrying` if this isn't its `final_attempt` (the job queue will run the step again).
+    The step is traced into the run's trace file if TRACING is enabled"""
+    with tracing.start_trace("run_pipeline", enabled=app.config.get("TRACING", True), run_id=run_id, step=pipeline_step, bypass_cache=bypass_cache) as trace:
+        succeeded = _run_pipeline_step(app, run_id, pipeline_step, bypass_cache, final_attempt)
+    if trace is not None:
+        try:
+            tracing.save_trace(app.config["TRACE_FOLDER"], run_id, trace)
+        except Exception as e:
+            print(f"Error saving trace for run_id=`{run_id}`: {str(e)}")
+    return succeeded
+
+def _run_pipeline_step(app, run_id: int, pipeline_step: str, bypass_cache: bool = False, final_attempt: bool = True) -> bool:
     with app.app_context():
         run = db.session.get(ProcessRun, run_id)
         
         if not run:
             print(f"Run not found for run_id=`{run_id}`")
-            return
+            return False
 
         try:
             print(f"Starting run_pipeline() for run_id=`{run_id}`, pipeline_step=`{pipeline_step}`")
 
-            with open(run.image_path, "rb") as f:
-                image_bytes = f.read()
-            
             if pipeline_step == "transcribe":
-                run.status = "transcribing"
-                db.session.commit()
+                if run.source_path:
+                    set_run_status(run, "rasterizing")
+                    render_page_image(app.config, run)
+
+                set_run_status(run, "transcribing")
                 print("Starting transcription process")
                 
-                blocks = split_image_into_blocks(image_bytes, block_size=BLOCK_SIZE)
-                print(f"Split image into {len(blocks)} blocks")
-                
-                block_results: List[TranscriptionOutputModel] = []
-
-                for block_image in tqdm(blocks, desc="Transcribing blocks", total=len(blocks)):
-                    buffer = io.BytesIO()
-                    block_image.save(buffer, format="PNG")
-                    block_bytes = buffer.getvalue()
-                    
-                    try:
-                        response = call_llm(
-                            messages=[
-                                sys_prompt(),
-                                {
-                                    "role": "user",
-                                    "content": [
-                                        get_text_prompt(prompt__transcribe_process_map()),
-                                        get_image_prompt(block_bytes, "png"),
-                                    ]
-                                }
-                            ],
-                            model=MODEL,
-                            max_tokens=4000,
-                            response_format=TranscriptionOutputModel
-                        )
-                        print(f"Response received from {MODEL}: {response}...")
-                        if response.is_valid:
-                            block_results.append(response)
-                            print(f"Successfully transcribed block {len(block_results)}/{len(blocks)}")
-                        else:
-                            print(f"Invalid transcription for block {len(block_results)}/{len(blocks)}")
-                    except Exception as e:
-                        print(f"Direct API call error: {str(e)}")
-
-                merged_steps: List[StepModel] = merge_block_results(block_results)
-                run.transcription = '\n'.join(format_step_as_markdown(step) for step in merged_steps)
+                transcribe_start = time.perf_counter()
+                tiling_strategy: str = run.tiling_strategy or app.config.get("TILING_STRATEGY", DEFAULT_TILING_STRATEGY)
+                page_layout: Optional[PageLayout] = None
+                if run.source_path and app.config.get("VECTOR_TEXT_FAST_PATH", True):
+                    page_layout = extract_page_layout(run.source_path, run.page_number or 0)
+                    if not has_text_layer(page_layout, app.config.get("VECTOR_TEXT_MIN_CHARS", VECTOR_TEXT_MIN_CHARS)):
+                        page_layout = None
+                steps_seen = [0]
+                def _on_tile(idx: int, num_blocks: int, result: Optional[TranscriptionOutputModel]) -> None:
+                    ok = result is not None and result.is_valid
+                    steps_seen[0] += len(result.steps) if ok else 0
+                    run_events.publish(run_id, "tile", index=idx, total=num_blocks, ok=ok, steps_so_far=steps_seen[0])
+
+                # A forced re-transcription (bypass_cache) redoes every tile
+                tile_results = TileResults(reuse=app.config.get("TILE_REUSE", True) and not bypass_cache)
+                try:
+                    with stage_seconds.time(stage="transcribe"), tracing.span("transcribe", tiling_strategy=tiling_strategy):
+                        block_results, block_boxes, tile_stats = transcribe_image(app.config, run.image_path, tiling_strategy, bypass_cache=bypass_cache, page_layout=page_layout, on_tile=_on_tile,
+                                                                     tile_results=tile_results)
+                finally:
+                    # Tiles already paid for are kept even if the step fails, and reused when it's retried
+                    tile_results.save(run_id)
+                update_run_stats(run, tiles_seconds=round(time.perf_counter() - transcribe_start, 3), **tile_stats)
+
+                run_events.publish(run_id, "merging", tiles_valid=len(block_results), steps_so_far=steps_seen[0])
+                merge_stats: Dict = {}
+                merge_mode = app.config.get("MERGE_MODE", MERGE_MODE)
+                with stage_seconds.time(stage="merge"), tracing.span("merge", mode=merge_mode, tiles=len(block_results)) as merge_span:
+                    merged_steps: List[StepModel] = merge_block_results(
+                        block_results, bypass_cache=bypass_cache, boxes=block_boxes, mode=merge_mode, stats=merge_stats,
+                        max_prompt_tokens=app.config.get("MERGE_MAX_PROMPT_TOKENS", MERGE_MAX_PROMPT_TOKENS),
+                        group_tiles=app.config.get("MERGE_GROUP_TILES", MERGE_GROUP_TILES),
+                    )
+                    merge_span.set(steps=len(merged_steps), llm_calls=merge_stats.get("merge_llm_calls"))
+                update_run_stats(run, **merge_stats)
+                run_events.publish(run_id, "steps", count=len(merged_steps))
+                save_steps(run, merged_steps)
+                update_run_stats(run, transcribe_seconds=round(time.perf_counter() - transcribe_start, 3))
                 run.status = "transcribed"
                 
             elif pipeline_step == "bottlenecks":
-                run.status = "bottlenecks"
-                db.session.commit()
+                set_run_status(run, "bottlenecks")
                 
-                bottleneck_output: BottleneckOutputModel = call_llm(
-                    messages=[
-                        sys_prompt(),
-                        get_user_text_prompt(prompt__identify_bottlenecks(run.transcription)),
-                    ],
-                    model=MODEL,
-                    response_format=BottleneckOutputModel
-                )
-                run.bottlenecks = '\n'.join([ format_bottleneck_as_markdown(bottleneck) for bottleneck in bottleneck_output.bottlenecks ])
+                with stage_seconds.time(stage="bottlenecks"), tracing.span("bottlenecks"):
+                    bottleneck_output: BottleneckOutputModel = call_llm(
+                        messages=[
+                            sys_prompt(),
+                            get_user_text_prompt(prompt__identify_bottlenecks(run.transcription)),
+                        ],
+                        model=MODEL,
+                        response_format=BottleneckOutputModel,
+                        bypass_cache=bypass_cache
+                    )
+                save_bottlenecks(run, bottleneck_output.bottlenecks)
                 run.status = "bottlenecks_complete"
                 
             elif pipeline_step == "improvements":
-                run.status = "improvements"
-                db.session.commit()
+                set_run_status(run, "improvements")
                 
                 print(f"Generating improvements for run_id=`{run_id}`")
-                raw_improvements = call_llm(
-                    messages=[
-                        sys_prompt(),
-                        get_user_text_prompt(prompt__generate_improvements( run.transcription, run.bottlenecks ))
-                    ],
-                    model=MODEL,
-                    response_format=ImprovementOutputModel
-                )
+                with stage_seconds.time(stage="improvements"), tracing.span("improvements"):
+                    raw_improvements = call_llm(
+                        messages=[
+                            sys_prompt(),
+                            get_user_text_prompt(prompt__generate_improvements( run.transcription, run.bottlenecks ))
+                        ],
+                        model=MODEL,
+                        response_format=ImprovementOutputModel,
+                        bypass_cache=bypass_cache
+                    )
                 print(f"Generated {len(raw_improvements.improvements)} improvements for run_id=`{run_id}`")
 
-                run.improvements = '\n'.join([ format_improvement_as_markdown(improvement) for improvement in raw_improvements.improvements ])
+                save_improvements(run, raw_improvements.improvements)
                 run.status = "complete"
             
             db.session.commit()
+            run_indexes.update(run)
+            run_events.publish(run_id, "status", status=run.status)
+            pipeline_steps.inc(step=pipeline_step, outcome="ok")
+            return True
             
         except Exception as e:
             print(f"Error in run_pipeline: {str(e)}")
             traceback.print_exc()
-            run.status = f"{pipeline_step}_failed"
-            db.session.commit()
+            db.session.rollback()
+            run_events.publish(run_id, "step_error", step=pipeline_step, message=str(e))
+            set_run_status(run, f"{pipeline_step}_failed" if final_attempt else f"{pipeline_step}_retrying")
+            pipeline_steps.inc(step=pipeline_step, outcome="failed")
+            return False
@@ -76,6 +76,70 @@ Format your response as a list of steps, formatted as follows:
 
 """
 
+def prompt__transcribe_process_map_text_layout(layout: str) -> str:
+    return f"""You are given the text layer of a process map exported as a vector PDF.
+Each line is one block of text on the page, prefixed with its position as percentages of the page width (x) and height (y). Blocks are listed in reading order.
+
+# Text Layout
+
+{layout}
+
+# Instructions
+
+Reconstruct the steps of the process map from the text blocks. Use the positions to group labels that belong to the same step (they are usually stacked close together inside the step's box) and to infer the order of and transitions between steps (process maps usually flow left to right or top to bottom).
+
+If the text does not describe any steps, please respond with "is_valid" set to false.
+
+Otherwise, set "is_valid" to true and for each step:
+    1. Identify the step number (as labeled) and name.
+    2. Look for labels that indicate:
+        - Op/Operator: Who performs the step
+        - Sys/System: What system or equipment is used
+        - Mat/Material: What materials are involved
+        - T/Time/Timing: How long the step takes
+        - F/Freq/Frequency: How often the step occurs
+    3. Note any pain points or issues associated with the step
+    4. Identify transitions/connections to other steps.
+
+You must copy the text EXACTLY as it appears VERBATIM. Do not add any additional information.
+
+Format your response in the same format as for an image of the process map:
+
+{{
+    "thinking": "Your analysis of the process map",
+    "is_valid" : bool <Whether the text contains steps>,
+    "steps": List[StepModel] <The steps, formatted as in the prompt__transcribe_process_map function.>
+}}
+"""
+
+def prompt__resolve_merge_conflicts(conflicts: str, outline: str) -> str:
+    return f"""Previously, you transcribed a process map one subsection (i.e. "chunk") at a time. The transcriptions of the chunks were merged automatically, but some steps could not be merged with confidence because the chunks disagree about them.
+
+# Steps in the Merged Process Map
+
+{outline}
+
+# Conflicts
+
+{conflicts}
+
+# Instructions
+
+Resolve the conflicts above and return the steps they should become.
+
+Rules:
+- If the conflicting steps are the same step (e.g. transcribed twice across a chunk boundary, or with a misread step number), merge them into a single step and combine their information as completely as possible.
+- If they are different steps, keep them as separate steps with distinct step numbers.
+- Transitions must use the names of steps in the process map.
+- Only return the steps involved in the conflicts, not the rest of the process map.
+
+Format your response as follows:
+{{
+    "thinking" : str <First, think step-by-step about how to resolve each conflict, and explain your reasoning.>,
+    "steps" : List[StepModel] <The resolved steps, formatted as in the prompt__transcribe_process_map function.>,
+}}
+"""
+
 def prompt__identify_bottlenecks(transcription: str) -> str:
     return f"""You are given a process map.
 
@@ -169,3 +233,20 @@ For each improvement, include:
 4. Dependencies on other improvements
 
 Structure your response using the TranscriptionOutputModel format."""
+
+def prompt__summarize_chat(summary: str, turns: str) -> str:
+    return f"""You are maintaining a running summary of a conversation between a user and a process optimization consultant about a process map.
+
+# Summary So Far
+
+{summary or "(empty)"}
+
+# New Messages
+
+{turns}
+
+# Instructions
+
+Update the summary so that it also covers the new messages. Keep every question the user asked, every conclusion or recommendation given, and any facts, numbers or step references that later questions might depend on. Drop pleasantries and repetition.
+
+Respond with the updated summary only, in at most a few short paragraphs."""
@@ -0,0 +1,267 @@
+import ast
+import json
+import re
+from typing import Callable, Dict, Iterable, List, Optional, Tuple, TypeVar
+from sqlalchemy import delete, exists, select
+from procopt.server.db import db
+from procopt.server.models import ProcessRun, RunBottleneck, RunImprovement, RunStep
+from procopt.server.prompt_models import BottleneckModel, ImprovementModel, StepModel
+
+########################################################
+# Run results
+#
+# A run's steps, bottlenecks and improvements are stored as rows (RunStep,
+# RunBottleneck, RunImprovement), indexed by run id and step number, so chat,
+# export and cross-run queries load only the rows they need. The markdown shown
+# in the UI and sent to the LLM is rendered from the rows and cached in the
+# run's `transcription` / `bottlenecks` / `improvements` columns whenever rows
+# are saved. Edited markdown is parsed back into rows.
+#
+# Runs saved before the tables existed only have markdown; their rows are
+# parsed from it the first time they're loaded.
+########################################################
+
+Model = TypeVar("Model")
+
+def format_improvement_as_markdown(improvement: ImprovementModel) -> str:
+    """Given an ImprovementModel, format it as a markdown string"""
+    improvement_desc: List[str] = [f"#### Improvement for Bottleneck #{improvement.bottleneck_id}"]
+    improvement_desc.append(f"- Description: {improvement.description}")
+    improvement_desc.append(f"- Impacted Steps: {improvement.impacted_steps}")
+    improvement_desc.append(f"- Impact: {improvement.impact}")
+    improvement_desc.append(f"- Timeline: {improvement.timeline}")
+    return "\n".join(improvement_desc)
+
+def format_bottleneck_as_markdown(bottleneck: BottleneckModel) -> str:
+    """Given a BottleneckModel, format it as a markdown string"""
+    bottleneck_desc: List[str] = [f"#### Bottleneck for Step #{bottleneck.step_number}"]
+    bottleneck_desc.append(f"- Description: {bottleneck.description}")
+    bottleneck_desc.append(f"- Impact: {bottleneck.impact}")
+    return "\n".join(bottleneck_desc)
+
+def format_step_as_markdown(step: StepModel) -> str:
+    """Given a StepModel, format it as a markdown string"""
+    step_desc = [f"#### Step {step.step_number}: {step.name}"]
+    step_desc.append(f"Number: {step.step_number}")
+
+    # Only include fields that have values
+    if step.operator:
+        step_desc.append(f"- Operator: {step.operator}")
+    if step.system:
+        step_desc.append(f"- System: {step.system}")
+    if step.material:
+        step_desc.append(f"- Material: {step.material}")
+    if step.timing:
+        step_desc.append(f"- Timing: {step.timing}")
+    if step.frequency:
+        step_desc.append(f"- Frequency: {step.frequency}")
+
+    if step.pain_points:
+        step_desc.append("- Pain Points:")
+        for point in step.pain_points:
+            step_desc.append(f"  - {point}")
+
+    if step.transitions:
+        step_desc.append("- Transitions:")
+        for transition in step.transitions:
+            step_desc.append(f"  - {transition}")
+
+    return "\n".join(step_desc)
+
+########################################################
+# Parsing markdown back into models
+########################################################
+
+def split_markdown_records(markdown: Optional[str]) -> List[str]:
+    """Split markdown produced by the `format_*_as_markdown` helpers into one chunk per item"""
+    if not markdown:
+        return []
+    return [ chunk.strip() for chunk in re.split(r"\n(?=#### )", markdown.strip()) if chunk.strip() ]
+
+def _parse_fields(lines: Iterable[str]) -> Dict[str, object]:
+    """`- Key: value` lines into {"key": value}; `- Key:` followed by `  - item` lines into {"key": [items]}.
+    Lines that match neither continue the previous value"""
+    fields: Dict[str, object] = {}
+    key: Optional[str] = None
+    for line in lines:
+        item = re.match(r"^\s+- (.*)$", line)
+        field = re.match(r"^- ([A-Za-z ]+):\s*(.*)$", line)
+        if item and key and isinstance(fields.get(key), list):
+            fields[key].append(item.group(1).strip())
+        elif field:
+            key = field.group(1).strip().lower().replace(" ", "_")
+            fields[key] = field.group(2).strip() or []
+        elif key and isinstance(fields.get(key), str) and line.strip():
+            fields[key] += "\n" + line.strip()
+    return fields
+
+def _text(fields: Dict[str, object], key: str) -> Optional[str]:
+    value = fields.get(key)
+    return value if isinstance(value, str) and value else None
+
+def _parse_records(markdown: Optional[str], header: str, build: Callable[[re.Match, Dict[str, object]], Model]) -> List[Model]:
+    records: List[Model] = []
+    for chunk in split_markdown_records(markdown):
+        lines = chunk.splitlines()
+        match = re.match(header, lines[0])
+        if match:
+            records.append(build(match, _parse_fields(lines[1:])))
+    return records
+
+def parse_steps_markdown(markdown: Optional[str]) -> List[StepModel]:
+    return _parse_records(markdown, r"^#### Step (-?\d+):\s*(.*)$", lambda match, fields: StepModel(
+        step_number=int(match.group(1)),
+        name=match.group(2).strip(),
+        operator=_text(fields, "operator"),
+        system=_text(fields, "system"),
+        material=_text(fields, "material"),
+        timing=_text(fields, "timing"),
+        frequency=_text(fields, "frequency"),
+        pain_points=fields.get("pain_points") if isinstance(fields.get("pain_points"), list) else [],
+        transitions=fields.get("transitions") if isinstance(fields.get("transitions"), list) else [],
+    ))
+
+def parse_bottlenecks_markdown(markdown: Optional[str]) -> List[BottleneckModel]:
+    return _parse_records(markdown, r"^#### Bottleneck for Step #(-?\d+)", lambda match, fields: BottleneckModel(
+        step_number=int(match.group(1)),
+        description=_text(fields, "description") or "",
+        impact=_text(fields, "impact") or "",
+    ))
+
+def _parse_step_numbers(value: Optional[str]) -> List[int]:
+    try:
+        numbers = ast.literal_eval(value or "[]")
+        return [ int(number) for number in (numbers if isinstance(numbers, (list, tuple)) else [numbers]) ]
+    except (ValueError, SyntaxError, TypeError):
+        return [ int(number) for number in re.findall(r"-?\d+", value or "") ]
+
+def parse_improvements_markdown(markdown: Optional[str]) -> List[ImprovementModel]:
+    return _parse_records(markdown, r"^#### Improvement for Bottleneck #(-?\d+)", lambda match, fields: ImprovementModel(
+        bottleneck_id=int(match.group(1)),
+        description=_text(fields, "description") or "",
+        impacted_steps=_parse_step_numbers(_text(fields, "impacted_steps")),
+        impact=_text(fields, "impact") or "",
+        timeline=_text(fields, "timeline") or "",
+    ))
+
+########################################################
+# Rows
+########################################################
+
+def _step_row(run_id: int, position: int, step: StepModel) -> RunStep:
+    return RunStep(
+        run_id=run_id, position=position, step_number=step.step_number, name=step.name[:255],
+        operator=step.operator, system=step.system, material=step.material, timing=step.timing, frequency=step.frequency,
+        pain_points=json.dumps(step.pain_points), transitions=json.dumps(step.transitions),
+    )
+
+def _step_model(row: RunStep) -> StepModel:
+    return StepModel(
+        step_number=row.step_number, name=row.name,
+        operator=row.operator, system=row.system, material=row.material, timing=row.timing, frequency=row.frequency,
+        pain_points=json.loads(row.pain_points), transitions=json.loads(row.transitions),
+    )
+
+def _bottleneck_model(row: RunBottleneck) -> BottleneckModel:
+    return BottleneckModel(step_number=row.step_number, description=row.description, impact=row.impact)
+
+def _improvement_model(row: RunImprovement) -> ImprovementModel:
+    return ImprovementModel(bottleneck_id=row.bottleneck_id, description=row.description, impacted_steps=json.loads(row.impacted_steps),
+                            impact=row.impact, timeline=row.timeline)
+
+def save_steps(run: ProcessRun, steps: List[StepModel], markdown: Optional[str] = None) -> None:
+    """Replace the run's steps and refresh its cached markdown (`markdown` if given, e.g. the user's
+    edited text, otherwise rendered from `steps`). Committed by the caller"""
+    db.session.execute(delete(RunStep).where(RunStep.run_id == run.id))
+    db.session.add_all([ _step_row(run.id, position, step) for position, step in enumerate(steps) ])
+    run.transcription = markdown if markdown is not None else '\n'.join(format_step_as_markdown(step) for step in steps)
+
+def save_bottlenecks(run: ProcessRun, bottlenecks: List[BottleneckModel], markdown: Optional[str] = None) -> None:
+    """Replace the run's bottlenecks and refresh its cached markdown. Committed by the caller"""
+    db.session.execute(delete(RunBottleneck).where(RunBottleneck.run_id == run.id))
+    db.session.add_all([
+        RunBottleneck(run_id=run.id, position=position, step_number=bottleneck.step_number, description=bottleneck.description, impact=bottleneck.impact)
+        for position, bottleneck in enumerate(bottlenecks)
+    ])
+    run.bottlenecks = markdown if markdown is not None else '\n'.join(format_bottleneck_as_markdown(bottleneck) for bottleneck in bottlenecks)
+
+def save_improvements(run: ProcessRun, improvements: List[ImprovementModel], markdown: Optional[str] = None) -> None:
+    """Replace the run's improvements and refresh its cached markdown. Committed by the caller"""
+    db.session.execute(delete(RunImprovement).where(RunImprovement.run_id == run.id))
+    db.session.add_all([
+        RunImprovement(run_id=run.id, position=position, bottleneck_id=improvement.bottleneck_id, description=improvement.description,
+                       impacted_steps=json.dumps(improvement.impacted_steps), impact=improvement.impact, timeline=improvement.timeline)
+        for position, improvement in enumerate(improvements)
+    ])
+    run.improvements = markdown if markdown is not None else '\n'.join(format_improvement_as_markdown(improvement) for improvement in improvements)
+
+def ensure_rows(run: ProcessRun) -> None:
+    """Parse rows from the cached markdown of sections saved before the tables existed"""
+    backfilled = False
+    for row_model, markdown, parse, save in (
+        (RunStep, run.transcription, parse_steps_markdown, save_steps),
+        (RunBottleneck, run.bottlenecks, parse_bottlenecks_markdown, save_bottlenecks),
+        (RunImprovement, run.improvements, parse_improvements_markdown, save_improvements),
+    ):
+        if markdown and not db.session.execute(select(exists().where(row_model.run_id == run.id))).scalar():
+            save(run, parse(markdown), markdown=markdown)
+            backfilled = True
+    if backfilled:
+        db.session.commit()
+
+def load_steps(run: ProcessRun, step_numbers: Optional[Iterable[int]] = None) -> List[StepModel]:
+    """The run's steps in order, or only those numbered `step_numbers`"""
+    ensure_rows(run)
+    query = select(RunStep).where(RunStep.run_id == run.id)
+    if step_numbers is not None:
+        query = query.where(RunStep.step_number.in_(list(step_numbers)))
+    return [ _step_model(row) for row in db.session.execute(query.order_by(RunStep.position)).scalars() ]
+
+def load_bottlenecks(run: ProcessRun, step_numbers: Optional[Iterable[int]] = None) -> List[BottleneckModel]:
+    """The run's bottlenecks in order, or only those on `step_numbers`"""
+    ensure_rows(run)
+    query = select(RunBottleneck).where(RunBottleneck.run_id == run.id)
+    if step_numbers is not None:
+        query = query.where(RunBottleneck.step_number.in_(list(step_numbers)))
+    return [ _bottleneck_model(row) for row in db.session.execute(query.order_by(RunBottleneck.position)).scalars() ]
+
+def load_improvements(run: ProcessRun) -> List[ImprovementModel]:
+    ensure_rows(run)
+    rows = db.session.execute(select(RunImprovement).where(RunImprovement.run_id == run.id).order_by(RunImprovement.position)).scalars()
+    return [ _improvement_model(row) for row in rows ]
+
+def section_markdown(run: ProcessRun, section: str) -> Optional[str]:
+    """The run's cached markdown for `section`, rendered from its rows if the cache is empty"""
+    markdown = getattr(run, section)
+    if markdown is None:
+        load, save = {
+            "transcription": (load_steps, save_steps),
+            "bottlenecks": (load_bottlenecks, save_bottlenecks),
+            "improvements": (load_improvements, save_improvements),
+        }[section]
+        rows = load(run)
+        if rows:
+            save(run, rows)
+            db.session.commit()
+            markdown = getattr(run, section)
+    return markdown
+
+def escape_like(text: str, escape: str = "\\") -> str:
+    """`text` with LIKE wildcards escaped, to match it literally"""
+    return text.replace(escape, escape * 2).replace("%", escape + "%").replace("_", escape + "_")
+
+def find_bottlenecks(step_name: str, limit: int = 100, before_id: Optional[int] = None) -> List[Tuple[RunBottleneck, str]]:
+    """Bottlenecks across all runs on steps whose name contains `step_name` (literally, `%` and `_` included),
+    newest first, with the step name.
+
+    No index can serve a substring match: bottlenecks are walked newest first by primary key, each one's step
+    looked up through ix_run_step_run_id_step_number, until `limit` match. A name that matches nothing
+    therefore reads every bottleneck (older than `before_id`)."""
+    query = (
+        select(RunBottleneck, RunStep.name)
+        .join(RunStep, (RunStep.run_id == RunBottleneck.run_id) & (RunStep.step_number == RunBottleneck.step_number))
+        .where(RunStep.name.ilike(f"%{escape_like(step_name)}%", escape="\\"))
+    )
+    if before_id is not None:
+        query = query.where(RunBottleneck.id < before_id)
+    return db.session.execute(query.order_by(RunBottleneck.id.desc()).limit(limit)).all()
@@ -0,0 +1,129 @@
+import hashlib
+import math
+import re
+import threading
+from collections import Counter, OrderedDict
+from typing import Dict, List, NamedTuple, Optional, Tuple
+from procopt.server.models import ProcessRun
+from procopt.server.results import (
+    format_bottleneck_as_markdown,
+    format_improvement_as_markdown,
+    format_step_as_markdown,
+    load_bottlenecks,
+    load_improvements,
+    load_steps,
+    split_markdown_records,
+)
+
+########################################################
+# Retrieval over a run's results
+#
+# Large maps are too big to send whole with every chat turn. Each run's
+# steps, bottlenecks and improvements are rendered as one markdown record per
+# row ("#### Step 3: ...", "#### Bottleneck ...") and indexed with BM25, so
+# chat can send a compact outline plus the records relevant to the question.
+# Indexes live in memory, are rebuilt when a pipeline step finishes or a
+# section is edited, and are rebuilt lazily if the run's content changed.
+########################################################
+
+BM25_K1: float = 1.5
+BM25_B: float = 0.75
+RUN_INDEX_CACHE_SIZE: int = 128 # Runs whose index is kept in memory
+
+class Record(NamedTuple):
+    kind: str # step, bottleneck, improvement
+    title: str # The record's heading, e.g. "Step 3: Approve invoice"
+    text: str # The full markdown record
+
+def tokenize(text: str) -> List[str]:
+    return re.findall(r"\w+", text.lower())
+
+def split_records(markdown: Optional[str], kind: str) -> List[Record]:
+    """One record per item of a markdown section"""
+    return [ Record(kind, chunk.splitlines()[0].lstrip("# ").strip(), chunk) for chunk in split_markdown_records(markdown) ]
+
+def run_records(run: ProcessRun) -> List[Record]:
+    """One record per step, bottleneck and improvement row. A section edited into markdown
+    that doesn't parse into rows is split as-is"""
+    records: List[Record] = []
+    for kind, markdown, rows, render in (
+        ("step", run.transcription, load_steps(run), format_step_as_markdown),
+        ("bottleneck", run.bottlenecks, load_bottlenecks(run), format_bottleneck_as_markdown),
+        ("improvement", run.improvements, load_improvements(run), format_improvement_as_markdown),
+    ):
+        records.extend(split_records("\n".join(render(row) for row in rows) if rows else markdown, kind))
+    return records
+
+def content_hash(run: ProcessRun) -> str:
+    return hashlib.sha256("\0".join([run.transcription or "", run.bottlenecks or "", run.improvements or ""]).encode("utf-8")).hexdigest()
+
+class BM25Index:
+    """Okapi BM25 over a fixed list of records"""
+    def __init__(self, records: List[Record], k1: float = BM25_K1, b: float = BM25_B):
+        self.records = records
+        self.k1 = k1
+        self.b = b
+        self.doc_lens: List[int] = []
+        self.postings: Dict[str, List[Tuple[int, int]]] = {} # term -> [(record idx, term frequency)]
+        for idx, record in enumerate(records):
+            terms = Counter(tokenize(record.text))
+            self.doc_lens.append(sum(terms.values()))
+            for term, freq in terms.items():
+                self.postings.setdefault(term, []).append((idx, freq))
+        self.avg_doc_len = sum(self.doc_lens) / len(self.doc_lens) if self.doc_lens else 0.0
+        num_docs = len(records)
+        self.idf: Dict[str, float] = {
+            term: math.log(1 + (num_docs - len(docs) + 0.5) / (len(docs) + 0.5))
+            for term, docs in self.postings.items()
+        }
+
+    def search(self, query: str, k: int = 8) -> List[Tuple[float, Record]]:
+        """Top `k` records for `query`, best first. Records sharing no term with the query are left out"""
+        scores: Dict[int, float] = {}
+        for term in set(tokenize(query)):
+            idf = self.idf.get(term)
+            if idf is None:
+                continue
+            for idx, freq in self.postings[term]:
+                norm = self.k1 * (1 - self.b + self.b * self.doc_lens[idx] / self.avg_doc_len)
+                scores[idx] = scores.get(idx, 0.0) + idf * freq * (self.k1 + 1) / (freq + norm)
+        best = sorted(scores.items(), key=lambda item: (-item[1], item[0]))[:k]
+        return [ (score, self.records[idx]) for idx, score in best ]
+
+    def outline(self) -> str:
+        """One line per record heading, grouped by kind"""
+        sections = []
+        for kind, heading in (("step", "Steps"), ("bottleneck", "Bottlenecks"), ("improvement", "Improvements")):
+            titles = [ record.title for record in self.records if record.kind == kind ]
+            if titles:
+                sections.append(f"{heading}:\n" + "\n".join(f"- {title}" for title in titles))
+        return "\n\n".join(sections)
+
+class RunIndexes:
+    """In-memory BM25 indexes of the most recently used runs"""
+    def __init__(self, max_runs: int = RUN_INDEX_CACHE_SIZE):
+        self.max_runs = max_runs
+        self._indexes: "OrderedDict[int, Tuple[str, BM25Index]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def update(self, run: ProcessRun) -> BM25Index:
+        """(Re)build the run's index from its current content"""
+        index = BM25Index(run_records(run))
+        with self._lock:
+            self._indexes[run.id] = (content_hash(run), index)
+            self._indexes.move_to_end(run.id)
+            while len(self._indexes) > self.max_runs:
+                self._indexes.popitem(last=False)
+        return index
+
+    def get(self, run: ProcessRun) -> BM25Index:
+        """The run's index, rebuilt if missing or out of date"""
+        with self._lock:
+            entry = self._indexes.get(run.id)
+            if entry is not None:
+                self._indexes.move_to_end(run.id)
+        if entry is not None and entry[0] == content_hash(run):
+            return entry[1]
+        return self.update(run)
+
+run_indexes = RunIndexes()
@@ -2,5 +2,7 @@ from .main import main
 from .runs import runs
 from .uploads import uploads
 from .chat import chat
+from .jobs import jobs
+from .batches import batches
 
-__all__ = ['main', 'runs', 'uploads', 'chat']
\ No newline at end of file
+__all__ = ['main', 'runs', 'uploads', 'chat', 'jobs', 'batches']
\ No newline at end of file
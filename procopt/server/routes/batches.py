@@ -0,0 +1,187 @@
+from flask import Blueprint, jsonify, request, current_app
+from werkzeug.utils import secure_filename
+from datetime import datetime
+from sqlalchemy import select
+from typing import Dict, List, Tuple
+import json
+import os
+import shutil
+import zipfile
+from procopt.server.db import db
+from procopt.server.jobs import PIPELINE_STEPS, enqueue_jobs
+from procopt.server.models import Batch, Job, ProcessRun
+from procopt.server.routes.uploads import build_runs
+from procopt.server.tiling import TILING_STRATEGIES
+
+batches = Blueprint('batches', __name__)
+
+BATCH_FILE_EXTENSIONS = { ".png", ".jpg", ".jpeg", ".webp", ".tif", ".tiff", ".bmp", ".pdf" }
+BATCH_MAX_FILES: int = 500
+BATCH_MAX_ZIP_MEMBERS: int = 5000 # Entries per archive, including folders and skipped files
+BATCH_MAX_EXTRACTED_BYTES: int = 4 * 1024 ** 3 # Uncompressed size of all archives in a batch
+COPY_CHUNK_BYTES: int = 1024 * 1024
+STEP_DONE_STATUS = { "transcribe": "transcribed", "bottlenecks": "bottlenecks_complete", "improvements": "complete" }
+
+def _extract_member(archive: zipfile.ZipFile, member: zipfile.ZipInfo, path: str, budget: int) -> int:
+    """Copy an archive member to `path`, failing once more than `budget` bytes come out. Returns the bytes written"""
+    written = 0
+    with archive.open(member) as source, open(path, "wb") as target:
+        while chunk := source.read(COPY_CHUNK_BYTES):
+            written += len(chunk)
+            if written > budget:
+                raise ValueError(f"Archives extract to more than {BATCH_MAX_EXTRACTED_BYTES} bytes")
+            target.write(chunk)
+    return written
+
+def _save_batch_files(files, batch_dir: str) -> Tuple[List[str], List[Dict[str, str]]]:
+    """Stream uploaded files (and the members of uploaded zip archives) into `batch_dir`.
+    Returns the saved paths and the entries that were skipped, with why.
+    Raises ValueError for archives over BATCH_MAX_ZIP_MEMBERS entries or BATCH_MAX_EXTRACTED_BYTES in total"""
+    saved: List[str] = []
+    skipped: List[Dict[str, str]] = []
+    extracted = 0
+
+    def _target(name: str) -> str:
+        # Prefixed with a counter: archives often hold files with the same name in different folders
+        return os.path.join(batch_dir, f"{len(saved):04d}_{secure_filename(os.path.basename(name))}")
+
+    for file in files:
+        if file.filename.lower().endswith('.zip'):
+            try:
+                with zipfile.ZipFile(file.stream) as archive:
+                    members = archive.infolist()
+                    # Reject zip bombs from the central directory before writing anything
+                    if len(members) > BATCH_MAX_ZIP_MEMBERS:
+                        raise ValueError(f"`{file.filename}` has more than {BATCH_MAX_ZIP_MEMBERS} entries")
+                    if extracted + sum(member.file_size for member in members) > BATCH_MAX_EXTRACTED_BYTES:
+                        raise ValueError(f"Archives extract to more than {BATCH_MAX_EXTRACTED_BYTES} bytes")
+                    for member in members:
+                        name = member.filename
+                        if member.is_dir() or name.startswith("__MACOSX/") or os.path.basename(name).startswith("."):
+                            continue
+                        if os.path.splitext(name)[1].lower() not in BATCH_FILE_EXTENSIONS:
+                            skipped.append({ "file": f"{file.filename}:{name}", "error": "Unsupported file type" })
+                            continue
+                        if len(saved) >= BATCH_MAX_FILES:
+                            skipped.append({ "file": f"{file.filename}:{name}", "error": f"More than {BATCH_MAX_FILES} files" })
+                            continue
+                        path = _target(name)
+                        saved.append(path) # Before extracting, so a partial file is still counted and cleaned up
+                        extracted += _extract_member(archive, member, path, BATCH_MAX_EXTRACTED_BYTES - extracted)
+            except zipfile.BadZipFile:
+                skipped.append({ "file": file.filename, "error": "Not a valid zip archive" })
+        elif os.path.splitext(file.filename)[1].lower() not in BATCH_FILE_EXTENSIONS:
+            skipped.append({ "file": file.filename, "error": "Unsupported file type" })
+        elif len(saved) >= BATCH_MAX_FILES:
+            skipped.append({ "file": file.filename, "error": f"More than {BATCH_MAX_FILES} files" })
+        else:
+            path = _target(file.filename)
+            file.save(path, COPY_CHUNK_BYTES)
+            saved.append(path)
+    return saved, skipped
+
+@batches.route("/batches", methods=['POST'])
+def create_batch():
+    """Upload many process maps at once, as multiple `files` and/or zip archives.
+
+    Form fields: `tiling_strategy` (optional) and `steps`: "all" (default) to run the whole
+    pipeline on every map, or "transcribe" to only transcribe them.
+    """
+    files = [ file for file in request.files.getlist('files') + request.files.getlist('file') if file.filename ]
+    if not files:
+        return jsonify({"error": "No files sent"}), 400
+
+    tiling_strategy = request.form.get('tiling_strategy')
+    if tiling_strategy and tiling_strategy not in TILING_STRATEGIES:
+        return jsonify({"error": f"Invalid tiling strategy, expected one of {list(TILING_STRATEGIES)}"}), 400
+    steps = request.form.get('steps', 'all')
+    if steps not in ("all", "transcribe"):
+        return jsonify({"error": "Invalid steps, expected `all` or `transcribe`"}), 400
+
+    batch = Batch(steps=",".join(PIPELINE_STEPS if steps == "all" else ["transcribe"]))
+    db.session.add(batch)
+    db.session.flush()
+    batch_dir = os.path.join(current_app.config['UPLOAD_FOLDER'], f"batch_{batch.id}")
+    os.makedirs(batch_dir, exist_ok=True)
+
+    try:
+        saved, skipped = _save_batch_files(files, batch_dir)
+
+        # Smallest maps first, so most results arrive early instead of queueing behind a huge one
+        new_runs: List[ProcessRun] = []
+        for path in sorted(saved, key=os.path.getsize):
+            try:
+                new_runs.extend(build_runs(path, tiling_strategy, batch_id=batch.id))
+            except ValueError as e:
+                skipped.append({ "file": os.path.basename(path), "error": str(e) })
+        if not new_runs:
+            raise ValueError("No processable files in the upload")
+
+        batch.num_files = len(saved)
+        batch.total_bytes = sum(os.path.getsize(path) for path in saved)
+        db.session.add_all(new_runs)
+        db.session.flush()
+        # Commits the runs and their jobs together, so no run is left without a job
+        enqueue_jobs([new_run.id for new_run in new_runs], "transcribe", batch_id=batch.id)
+    except Exception as e:
+        db.session.rollback()
+        shutil.rmtree(batch_dir, ignore_errors=True)
+        return jsonify({"error": str(e), "skipped": skipped if 'skipped' in locals() else []}), 400
+
+    return jsonify({
+        "status": "success",
+        "batch_id": batch.id,
+        "num_files": batch.num_files,
+        "run_ids": [new_run.id for new_run in new_runs],
+        "skipped": skipped,
+    })
+
+@batches.route("/batches/<int:batch_id>", methods=['GET'])
+def get_batch(batch_id):
+    """Aggregate progress and throughput of a batch, plus the status of each run"""
+    batch = db.session.get(Batch, batch_id)
+    if not batch:
+        return jsonify({"error": "Batch not found"}), 404
+
+    runs = db.session.execute(
+        select(ProcessRun.id, ProcessRun.status, ProcessRun.image_path, ProcessRun.page_number, ProcessRun.stats, ProcessRun.updated_at)
+        .where(ProcessRun.batch_id == batch_id)
+        .order_by(ProcessRun.id)
+    ).all()
+    pending_run_ids = set(db.session.execute(
+        select(Job.run_id).where(Job.batch_id == batch_id, Job.status.in_(["queued", "running"]))
+    ).scalars().all())
+
+    done_status = STEP_DONE_STATUS[batch.steps.split(",")[-1]]
+    num_done, num_failed, tiles = 0, 0, 0
+    last_finished = None
+    for run in runs:
+        finished = run.status == done_status or (run.status.endswith("_failed") and run.id not in pending_run_ids)
+        num_done += run.status == done_status
+        num_failed += finished and run.status != done_status
+        if finished:
+            last_finished = max(last_finished or run.updated_at, run.updated_at)
+        if run.stats:
+            tiles += json.loads(run.stats).get("tiles_transcribed", 0)
+
+    all_finished = num_done + num_failed == len(runs)
+    elapsed = ((last_finished if all_finished and last_finished else datetime.utcnow()) - batch.created_at).total_seconds()
+    return jsonify({
+        "id": batch.id,
+        "steps": batch.steps.split(","),
+        "num_files": batch.num_files,
+        "total_bytes": batch.total_bytes,
+        "created_at": batch.created_at,
+        "runs_total": len(runs),
+        "runs_done": num_done,
+        "runs_failed": num_failed,
+        "runs_in_progress": len(runs) - num_done - num_failed,
+        "finished": all_finished,
+        "elapsed_seconds": round(elapsed, 3),
+        "runs_per_minute": round(60 * (num_done + num_failed) / elapsed, 2) if elapsed > 0 else None,
+        "tiles_per_second": round(tiles / elapsed, 2) if elapsed > 0 else None,
+        "runs": [
+            { "id": run.id, "file": os.path.basename(run.image_path), "page_number": run.page_number, "status": run.status }
+            for run in runs
+        ],
+    })
@@ -1,43 +1,125 @@
-from flask import Blueprint, jsonify, request
+from flask import Blueprint, Response, current_app, jsonify, request
+from procopt.server.chat_sessions import CHAT_FULL_CONTEXT_TOKENS, CHAT_HISTORY_TOKENS, CHAT_RETRIEVAL_TOP_K, add_history, add_message, build_chat_messages, get_or_create_session, schedule_summary
 from procopt.server.db import db
-from procopt.server.models import ProcessRun
-from procopt.server.llm_utils import MODEL, sys_prompt, call_llm
-from typing import List, Dict
+from procopt.server.events import format_sse
+from procopt.server.models import ChatMessage, ChatSession, ProcessRun
+from procopt.server.llm_utils import MODEL, call_llm, stream_llm, stream_stats
+from typing import Dict, Iterator, List
+import time
 
 chat = Blueprint('chat', __name__)
 
 @chat.route("/chat_response", methods=['POST'])
 def chat_response():
-    """Chat with the LLM"""
-    conversation: List[Dict[str, str]] = request.json['conversation']
+    """Chat with the LLM about a run. The conversation is kept server-side: send the new `message`
+    and the `sessionId` returned by the first turn (omit it to start a new session). Older clients
+    that send the whole `conversation` instead start their new session with its earlier turns."""
     run_id: int = request.json['runId']
-    
+    session_id: int = request.json.get('sessionId')
+    text: str = request.json.get('message')
+    history: List[Dict[str, str]] = []
+    if text is None and request.json.get('conversation'):
+        # Older clients send the whole conversation; only its last message is new
+        conversation: List[Dict[str, str]] = request.json['conversation']
+        last_message: Dict[str, str] = conversation[-1]
+        if last_message['role'] != 'user':
+            return jsonify({"error": f"Last message must be from user, but was `{last_message['role']}`"}), 200
+        text = last_message['text']
+        if session_id is None:
+            # No session to hold the earlier turns yet, so the new session starts with them
+            history = conversation[:-1]
+            invalid_roles = { message.get('role') for message in history } - { 'user', 'assistant' }
+            if invalid_roles:
+                return jsonify({"error": f"Conversation roles must be `user` or `assistant`, got {sorted(map(str, invalid_roles))}"}), 200
+
     # Confirm job exists
     run = db.session.get(ProcessRun, run_id)
     if not run:
         return jsonify({"error": "Run not found"}), 200
-    
-    # Confirm conversation has messages
-    if not conversation:
-        return jsonify({"error": "No conversation messages sent."}), 200
-    if conversation[-1]['role'] != 'user':
-        return jsonify({"error": f"Last message must be from user, but was `{conversation[-1]['role']}`"}), 200
-    if conversation[-1]['text'] == '':
+    if not run.transcription:
+        return jsonify({"error": "The process map hasn't been transcribed yet."}), 200
+
+    # Confirm there is a message
+    if not text or text.strip() == '':
         return jsonify({"error": "Last message cannot be empty."}), 200
-    
-    # Get transcribed process map
-    transcription = run.transcription # TODO -- fix db lookup
-    transcription = '1. Start; 2. Stop; 3. Repeat' # TODO -- dummy
-
-    # Convert conversation to messages
-    messages = [
-        sys_prompt(' Here is the complete process map that you are analyzing: ' + transcription),
-    ] + [
-        { 'role' : message['role'], 'content' : message['text'] }
-        for message in conversation
-    ]
-    
+
+    session = get_or_create_session(run_id, session_id)
+    if not session:
+        return jsonify({"error": "Chat session not found"}), 200
+    if history:
+        add_history(session, history)
+    add_message(session, 'user', text)
+
+    messages, context_stats = build_chat_messages(
+        run, session,
+        history_tokens=current_app.config.get("CHAT_HISTORY_TOKENS", CHAT_HISTORY_TOKENS),
+        full_context_tokens=current_app.config.get("CHAT_FULL_CONTEXT_TOKENS", CHAT_FULL_CONTEXT_TOKENS),
+        top_k=current_app.config.get("CHAT_RETRIEVAL_TOP_K", CHAT_RETRIEVAL_TOP_K),
+    )
+
+    # Stream tokens to the client as they're generated
+    if request.json.get('stream'):
+        return Response(_stream_chat(current_app._get_current_object(), session.id, messages, context_stats), mimetype="text/event-stream", headers={
+            "Cache-Control": "no-cache",
+            "X-Accel-Buffering": "no",
+        })
+
     # Call LLM
+    start = time.perf_counter()
     response = call_llm(messages=messages, model=MODEL)
-    
-    return jsonify({ 'text' : response })
\ No newline at end of file
+    add_message(session, 'assistant', response, prompt_tokens=context_stats["prompt_tokens"], latency_seconds=round(time.perf_counter() - start, 3))
+    schedule_summary(current_app._get_current_object(), session.id)
+
+    return jsonify({ 'text' : response, 'sessionId' : session.id, 'stats' : context_stats })
+
+def _stream_chat(app, session_id: int, messages: List[Dict], context_stats: Dict) -> Iterator[str]:
+    """SSE body: `session` with the session id, a `delta` event per chunk of text, then `done` with
+    timing and prompt stats (or `error`). If the client disconnects, Werkzeug closes this generator
+    and the LLM stream with it; the unfinished reply isn't stored."""
+    yield format_sse("session", { 'sessionId' : session_id })
+    stats: Dict = {}
+    parts: List[str] = []
+    deltas = stream_llm(messages=messages, model=MODEL, stats=stats)
+    try:
+        for delta in deltas:
+            parts.append(delta)
+            yield format_sse("delta", { 'text' : delta })
+    except Exception as e:
+        yield format_sse("error", { 'error' : str(e) })
+        return
+    finally:
+        deltas.close()
+
+    with app.app_context():
+        session = db.session.get(ChatSession, session_id)
+        add_message(session, 'assistant', "".join(parts), prompt_tokens=context_stats["prompt_tokens"], latency_seconds=stats.get("total_seconds"))
+    schedule_summary(app, session_id)
+    yield format_sse("done", { **stats, **context_stats })
+
+@chat.route("/chat_sessions/<int:session_id>", methods=['GET'])
+def get_chat_session(session_id):
+    """A session's summary and full message history"""
+    session = db.session.get(ChatSession, session_id)
+    if not session:
+        return jsonify({"error": "Chat session not found"}), 404
+    messages = db.session.query(ChatMessage).filter(ChatMessage.session_id == session_id).order_by(ChatMessage.id).all()
+    return jsonify({
+        "id": session.id,
+        "run_id": session.run_id,
+        "summary": session.summary,
+        "messages": [
+            {
+                "role": message.role,
+                "text": message.content,
+                "tokens": message.tokens,
+                "prompt_tokens": message.prompt_tokens,
+                "latency_seconds": message.latency_seconds,
+            }
+            for message in messages
+        ],
+    })
+
+@chat.route("/chat_response/stats", methods=['GET'])
+def chat_stream_stats():
+    """Time-to-first-token and tokens/s of recent streamed chat responses"""
+    return jsonify(stream_stats.summary())
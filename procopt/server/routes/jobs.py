@@ -0,0 +1,30 @@
+from flask import Blueprint, jsonify
+from procopt.server.db import db
+from procopt.server.jobs import queue_stats
+from procopt.server.models import Job
+
+jobs = Blueprint('jobs', __name__)
+
+@jobs.route("/jobs/stats", methods=['GET'])
+def get_queue_stats():
+    """Queue depth and wait times of the background job queue"""
+    return jsonify(queue_stats())
+
+@jobs.route("/jobs/<int:job_id>", methods=['GET'])
+def get_job(job_id):
+    job = db.session.get(Job, job_id)
+    if not job:
+        return jsonify({"error": "Job not found"}), 404
+
+    return jsonify({
+        "id": job.id,
+        "run_id": job.run_id,
+        "step": job.step,
+        "status": job.status,
+        "attempts": job.attempts,
+        "max_attempts": job.max_attempts,
+        "error": job.error,
+        "created_at": job.created_at,
+        "started_at": job.started_at,
+        "finished_at": job.finished_at
+    })
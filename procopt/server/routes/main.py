@@ -1,4 +1,7 @@
-from flask import Blueprint, send_from_directory
+from flask import Blueprint, Response, jsonify, send_from_directory
+from procopt.server.llm_cache import llm_cache
+from procopt.server.llm_cassette import llm_cassette
+from procopt.server.metrics import registry
 
 main = Blueprint('main', __name__)
 
@@ -7,6 +10,21 @@ def index():
     """Serve the React frontend"""
     return send_from_directory('client/public', 'index.html')
 
+@main.route("/llm_cache/stats")
+def llm_cache_stats():
+    """Hit/miss counters and size of the LLM response cache"""
+    return jsonify(llm_cache.stats())
+
+@main.route("/llm_cassette/stats")
+def llm_cassette_stats():
+    """Mode, replay timing and recorded/replayed/missed counts of the LLM cassette"""
+    return jsonify(llm_cassette.stats())
+
+@main.route("/metrics")
+def metrics():
+    """LLM call, pipeline stage and job queue metrics in the Prometheus text format"""
+    return Response(registry.render(), mimetype="text/plain; version=0.0.4")
+
 # Serve static files from React build
 @main.route("/<path:path>")
 def serve_static(path):
@@ -1,26 +1,102 @@
-from flask import Blueprint, current_app, jsonify, request, send_from_directory
-from procopt.server.pipeline import run_pipeline
+from flask import Blueprint, Response, current_app, jsonify, request, send_from_directory
+from procopt.server.events import SSE_KEEPALIVE_SECONDS, format_sse, run_events
+from procopt.server.jobs import enqueue_job
+from procopt.server.tiling import TILING_STRATEGIES
 from procopt.server.models import ProcessRun
+from procopt.server.retrieval import run_indexes
+from procopt.server.tracing import load_traces, to_chrome_trace
+from procopt.server.results import (
+    find_bottlenecks,
+    load_bottlenecks,
+    load_improvements,
+    load_steps,
+    parse_bottlenecks_markdown,
+    parse_improvements_markdown,
+    parse_steps_markdown,
+    save_bottlenecks,
+    save_improvements,
+    save_steps,
+    section_markdown,
+)
 from procopt.server.db import db
-import threading
+from datetime import datetime
+from sqlalchemy import select, tuple_
+from typing import Tuple
+import base64
+import json
 import os
+import queue
 
 runs = Blueprint('runs', __name__)
 
+RUNS_PAGE_SIZE: int = 50
+RUNS_MAX_PAGE_SIZE: int = 500
+
+def _encode_cursor(created_at: datetime, run_id: int) -> str:
+    return base64.urlsafe_b64encode(f"{created_at.isoformat()}|{run_id}".encode("utf-8")).decode("ascii")
+
+def _decode_cursor(cursor: str) -> Tuple[datetime, int]:
+    created_at, run_id = base64.urlsafe_b64decode(cursor.encode("ascii")).decode("utf-8").split("|")
+    return datetime.fromisoformat(created_at), int(run_id)
+
 @runs.route("/runs", methods=['GET'])
 def list_runs():
-    runs = ProcessRun.query.order_by(ProcessRun.created_at.desc()).all()
-    result = []
-    
-    for run in runs:
-        result.append({
-            "id": run.id,
-            "status": run.status,
-            "created_at": run.created_at,
-            "updated_at": run.updated_at
-        })
-    
-    return jsonify(result)
+    """Runs newest first, `?limit=` at a time, optionally filtered by `?status=` (comma-separated).
+    The X-Next-Cursor header, passed back as `?cursor=`, fetches the next page; responses carry an ETag"""
+    limit = max(1, min(request.args.get('limit', RUNS_PAGE_SIZE, type=int), RUNS_MAX_PAGE_SIZE))
+
+    # Only the listed columns are read, never the markdown and stats blobs
+    query = select(ProcessRun.id, ProcessRun.status, ProcessRun.created_at, ProcessRun.updated_at)
+    statuses = [ status for status in request.args.get('status', '').split(',') if status ]
+    if statuses:
+        query = query.where(ProcessRun.status.in_(statuses))
+    cursor = request.args.get('cursor')
+    if cursor:
+        try:
+            created_at, run_id = _decode_cursor(cursor)
+        except ValueError:
+            return jsonify({"error": "Invalid cursor"}), 400
+        query = query.where(tuple_(ProcessRun.created_at, ProcessRun.id) < (created_at, run_id))
+    # Keyset pagination over ix_process_run_(status_)created_at_id: each page costs the same however deep it is
+    rows = db.session.execute(
+        query.order_by(ProcessRun.created_at.desc(), ProcessRun.id.desc()).limit(limit + 1)
+    ).all()
+
+    response = jsonify([
+        {
+            "id": row.id,
+            "status": row.status,
+            "created_at": row.created_at,
+            "updated_at": row.updated_at
+        }
+        for row in rows[:limit]
+    ])
+    if len(rows) > limit:
+        response.headers["X-Next-Cursor"] = _encode_cursor(rows[limit - 1].created_at, rows[limit - 1].id)
+    # Unchanged pages are answered with an empty 304
+    response.add_etag()
+    return response.make_conditional(request)
+
+@runs.route("/bottlenecks", methods=['GET'])
+def search_bottlenecks():
+    """Bottlenecks across all runs on steps whose name contains `?step_name=`, newest first.
+    Page with `?before_id=<id of the last bottleneck returned>`"""
+    step_name = request.args.get('step_name', '').strip()
+    if not step_name:
+        return jsonify({"error": "Missing step_name"}), 400
+    limit = min(request.args.get('limit', 100, type=int), 1000)
+    rows = find_bottlenecks(step_name, limit=limit, before_id=request.args.get('before_id', type=int))
+    return jsonify([
+        {
+            "id": bottleneck.id,
+            "run_id": bottleneck.run_id,
+            "step_number": bottleneck.step_number,
+            "step_name": name,
+            "description": bottleneck.description,
+            "impact": bottleneck.impact,
+        }
+        for bottleneck, name in rows
+    ])
 
 @runs.route("/runs/<int:run_id>/export/<format_type>", methods=['GET'])
 def export_run(run_id, format_type):
@@ -28,20 +104,18 @@ def export_run(run_id, format_type):
     if not run:
         return jsonify({"error": "Run not found"}), 404
     
-    content = None
-    if format_type == "transcription":
-        content = run.transcription
-    elif format_type == "bottlenecks":
-        content = run.bottlenecks
-    elif format_type == "improvements":
-        content = run.improvements
-    else:
+    loaders = { "transcription": load_steps, "bottlenecks": load_bottlenecks, "improvements": load_improvements }
+    if format_type not in loaders:
         return jsonify({"error": "Invalid format type"}), 400
-        
-    return jsonify({
-        "content": content,
+
+    response = {
+        "content": section_markdown(run, format_type),
         "filename": f"{format_type}.md"
-    })
+    }
+    # `?structured=true` also returns the section's rows
+    if request.args.get('structured', 'false').lower() == 'true':
+        response["items"] = [ item.model_dump() for item in loaders[format_type](run) ]
+    return jsonify(response)
 
 
 @runs.route("/runs/<int:run_id>", methods=['GET'])
@@ -51,7 +125,7 @@ def get_run(run_id):
         return jsonify({"error": "Run not found"}), 404
         
     # Only return status if processing is incomplete
-    if run.status in ["uploaded", "transcribing", "bottlenecks", "improvements"]:
+    if run.status in ["uploaded", "rasterizing", "transcribing", "bottlenecks", "improvements"]:
         return jsonify({
             "status": run.status,
             "id": run.id
@@ -61,9 +135,64 @@ def get_run(run_id):
     return jsonify({
         "id": run.id,
         "status": run.status,
-        "transcription": run.transcription,
-        "bottlenecks": run.bottlenecks,
-        "improvements": run.improvements
+        "transcription": section_markdown(run, "transcription"),
+        "bottlenecks": section_markdown(run, "bottlenecks"),
+        "improvements": section_markdown(run, "improvements"),
+        "page_number": run.page_number,
+        "stats": json.loads(run.stats) if run.stats else None
+    })
+
+@runs.route("/runs/<int:run_id>/trace", methods=['GET'])
+def get_run_trace(run_id):
+    """Span timelines of the run's pipeline steps, oldest first, optionally only `?step=<step>`.
+    `?format=chrome` returns them as Chrome trace events (chrome://tracing, ui.perfetto.dev)"""
+    run = db.session.get(ProcessRun, run_id)
+    if not run:
+        return jsonify({"error": "Run not found"}), 404
+
+    traces = load_traces(current_app.config["TRACE_FOLDER"], run_id)
+    step = request.args.get('step')
+    if step:
+        traces = [ trace for trace in traces if trace["attributes"].get("step") == step ]
+    if request.args.get('format') == 'chrome':
+        return jsonify(to_chrome_trace(traces))
+    return jsonify({
+        "run_id": run_id,
+        "traces": traces
+    })
+
+@runs.route("/runs/<int:run_id>/events", methods=['GET'])
+def get_run_events(run_id):
+    """Server-sent events for a run: `status` transitions, per-`tile` progress, `merging`,
+    `steps`, `step_error` and `job` retries. The first event is the run's current status.
+    (Pipeline failures aren't called `error`: EventSource fires that name for its own connection errors.)"""
+    # Subscribe before reading the status so no transition falls in between
+    last_event_id = request.headers.get("Last-Event-ID", type=int)
+    subscriber = run_events.subscribe(run_id, last_event_id)
+    run = db.session.get(ProcessRun, run_id)
+    if not run:
+        run_events.unsubscribe(run_id, subscriber)
+        return jsonify({"error": "Run not found"}), 404
+    status = run.status
+    # The stream can stay open for minutes; don't hold a DB connection for it
+    db.session.remove()
+
+    def _stream():
+        try:
+            yield format_sse("status", {"status": status})
+            while True:
+                try:
+                    event_id, event, data = subscriber.get(timeout=SSE_KEEPALIVE_SECONDS)
+                except queue.Empty:
+                    yield ": keepalive\n\n" # Also how a disconnected client is noticed
+                    continue
+                yield format_sse(event, data, event_id)
+        finally:
+            run_events.unsubscribe(run_id, subscriber)
+
+    return Response(_stream(), mimetype="text/event-stream", headers={
+        "Cache-Control": "no-cache",
+        "X-Accel-Buffering": "no",
     })
 
 @runs.route("/runs/<int:run_id>/image", methods=['GET'])
@@ -87,8 +216,9 @@ def update_transcription(run_id):
     if not data or 'transcription' not in data:
         return jsonify({"error": "Missing transcription data"}), 400
         
-    run.transcription = data['transcription']
+    save_steps(run, parse_steps_markdown(data['transcription']), markdown=data['transcription'])
     db.session.commit()
+    run_indexes.update(run)
     
     return jsonify({
         "status": "success",
@@ -105,8 +235,9 @@ def update_bottlenecks(run_id):
     if not data or 'bottlenecks' not in data:
         return jsonify({"error": "Missing bottlenecks data"}), 400
         
-    run.bottlenecks = data['bottlenecks']
+    save_bottlenecks(run, parse_bottlenecks_markdown(data['bottlenecks']), markdown=data['bottlenecks'])
     db.session.commit()
+    run_indexes.update(run)
     
     return jsonify({
         "status": "success",
@@ -123,8 +254,9 @@ def update_improvements(run_id):
     if not data or 'improvements' not in data:
         return jsonify({"error": "Missing improvements data"}), 400
         
-    run.improvements = data['improvements']
+    save_improvements(run, parse_improvements_markdown(data['improvements']), markdown=data['improvements'])
     db.session.commit()
+    run_indexes.update(run)
     
     return jsonify({
         "status": "success",
@@ -146,15 +278,23 @@ def run_process_step(run_id, step):
     if step == "improvements" and not run.bottlenecks:
         return jsonify({"error": "Bottlenecks must be identified first"}), 400
     
-    # Start task in background
-    thread = threading.Thread(
-        target=run_pipeline,
-        args=(current_app._get_current_object(), run_id, step)
-    )
-    thread.start()
+    # `?tiling_strategy=<name>` re-transcribes with a different tiling strategy
+    tiling_strategy = request.args.get('tiling_strategy')
+    if tiling_strategy:
+        if step != "transcribe" or tiling_strategy not in TILING_STRATEGIES:
+            return jsonify({"error": f"Invalid tiling strategy, expected one of {list(TILING_STRATEGIES)} for the transcribe step"}), 400
+        run.tiling_strategy = tiling_strategy
+        db.session.commit()
+
+    # `?force=true` re-runs the step without serving cached LLM responses
+    bypass_cache = request.args.get('force', 'false').lower() == 'true'
+
+    # Queue task for the background workers
+    job = enqueue_job(run_id, step, bypass_cache=bypass_cache, batch_id=run.batch_id)
     
     return jsonify({
         "status": "processing",
         "message": f"Started {step} processing",
-        "run_id": run_id
+        "run_id": run_id,
+        "job_id": job.id
     })
\ No newline at end of file
@@ -1,14 +1,38 @@
 from flask import Blueprint, jsonify, request, current_app
 from werkzeug.utils import secure_filename
 import os
-import threading
+import uuid
+from typing import List, Optional
 from procopt.server.models import ProcessRun
-from procopt.server.pipeline import run_pipeline
-from procopt.server.utils import convert_pdf_to_png
+from procopt.server.jobs import enqueue_jobs
+from procopt.server.tiling import TILING_STRATEGIES
+from procopt.server.utils import count_pdf_pages, pdf_page_image_path
 from procopt.server.db import db
 
 uploads = Blueprint('uploads', __name__)
 
+def build_runs(file_path: str, tiling_strategy: Optional[str] = None, batch_id: Optional[int] = None) -> List[ProcessRun]:
+    """Runs (not yet added to the session) for an uploaded file. PDFs get one run per page;
+    pages are rasterized by the job workers (in a process pool). Raises ValueError for unreadable PDFs"""
+    if not file_path.lower().endswith('.pdf'):
+        return [ProcessRun(image_path=file_path, tiling_strategy=tiling_strategy, batch_id=batch_id)]
+    try:
+        page_count = count_pdf_pages(file_path)
+    except Exception as e:
+        raise ValueError(f"Error reading PDF: {str(e)}")
+    if page_count == 0:
+        raise ValueError("PDF has no pages")
+    return [
+        ProcessRun(
+            image_path=pdf_page_image_path(file_path, page_number),
+            source_path=file_path,
+            page_number=page_number,
+            tiling_strategy=tiling_strategy,
+            batch_id=batch_id,
+        )
+        for page_number in range(page_count)
+    ]
+
 @uploads.route("/upload", methods=['POST'])
 def upload():
     try:
@@ -19,37 +43,32 @@ def upload():
         if file.filename == '':
             return jsonify({"error": "No selected file"}), 400
             
+        tiling_strategy = request.form.get('tiling_strategy')
+        if tiling_strategy and tiling_strategy not in TILING_STRATEGIES:
+            return jsonify({"error": f"Invalid tiling strategy, expected one of {list(TILING_STRATEGIES)}"}), 400
+            
         if file:
-            filename = secure_filename(file.filename)
+            # Prefixed so re-uploading a file with the same name never overwrites the one earlier runs point at
+            filename = f"{uuid.uuid4().hex[:12]}_{secure_filename(file.filename)}"
             file_path = os.path.join(current_app.config['UPLOAD_FOLDER'], filename)
             file.save(file_path)
             
-            # If it's a PDF, convert to PNG first
-            if filename.lower().endswith('.pdf'):
-                try:
-                    png_path = convert_pdf_to_png(file_path)
-                    # Remove the original PDF file
-                    os.remove(file_path)
-                    file_path = png_path
-                except Exception as e:
-                    return jsonify({"error": f"Error converting PDF: {str(e)}"}), 500
-            
-            # Create a new process run
-            new_run = ProcessRun(image_path=file_path)
-            db.session.add(new_run)
-            db.session.commit()
+            try:
+                new_runs = build_runs(file_path, tiling_strategy)
+            except ValueError as e:
+                os.remove(file_path) # No run points at it
+                return jsonify({"error": str(e)}), 400
             
-            # Start transcription task in background
-            thread = threading.Thread(
-                target=run_pipeline,
-                args=(current_app._get_current_object(), new_run.id, "transcribe")
-            )
-            thread.start()
+            # Create the process run(s) and queue their transcription in the same commit
+            db.session.add_all(new_runs)
+            db.session.flush()
+            enqueue_jobs([new_run.id for new_run in new_runs], "transcribe")
             
             return jsonify({
                 "status": "success",
                 "message": "File uploaded and transcription started",
-                "run_id": new_run.id
+                "run_id": new_runs[0].id,
+                "run_ids": [new_run.id for new_run in new_runs]
             })
                 
     except Exception as e:
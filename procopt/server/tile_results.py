@@ -0,0 +1,109 @@
+import hashlib
+import json
+from typing import Dict, List, Optional
+from PIL import Image
+from sqlalchemy import delete, select
+from procopt.server.db import db
+from procopt.server.encoding import TileEncoder
+from procopt.server.llm_utils import MODEL
+from procopt.server.models import TileResult
+from procopt.server.prompts import prompt__transcribe_process_map
+from procopt.server.utils import Box, TranscriptionOutputModel, iter_blocks
+
+########################################################
+# Incremental transcription
+#
+# Every transcribed tile is stored with a fingerprint of its pixels (plus the
+# model, prompt and encoder settings that shape the answer), including tiles
+# the model marked invalid. Before a run is transcribed, its tiles are
+# fingerprinted and any tile already transcribed -- in an earlier pass over
+# the same run or in a previous upload of the same map -- reuses the stored
+# result, so only tiles whose content changed go to the vision model. With
+# grid tiling, a corrected re-upload of a map therefore costs about as many
+# calls as the tiles the edit touches.
+########################################################
+
+FINGERPRINT_QUERY_CHUNK: int = 500 # Fingerprints per IN (...) lookup, below SQLite's variable limit
+
+def fingerprint_salt(encoder: TileEncoder) -> str:
+    """Everything besides the pixels that determines a tile's transcription"""
+    return json.dumps([
+        MODEL,
+        hashlib.sha256(prompt__transcribe_process_map().encode("utf-8")).hexdigest(),
+        encoder.image_format, encoder.quality, encoder.color_mode,
+        encoder.downscale_to_model, encoder.max_bytes, encoder.max_tokens,
+    ])
+
+def tile_fingerprint(tile: Image.Image, salt: str = "") -> str:
+    """Hash of the tile's decoded pixels, so re-saving a map in another format or compression level keeps its fingerprints"""
+    hasher = hashlib.blake2b(digest_size=32)
+    hasher.update(salt.encode("utf-8"))
+    hasher.update(f"{tile.mode}:{tile.width}x{tile.height}".encode("utf-8"))
+    hasher.update(tile.tobytes())
+    return hasher.hexdigest()
+
+def load_tile_results(fingerprints: List[str]) -> Dict[str, TranscriptionOutputModel]:
+    """Most recent stored result for each of `fingerprints` that has one, from any run"""
+    known: Dict[str, TranscriptionOutputModel] = {}
+    unique = list(dict.fromkeys(fingerprints))
+    for start in range(0, len(unique), FINGERPRINT_QUERY_CHUNK):
+        rows = db.session.execute(
+            select(TileResult.fingerprint, TileResult.result)
+            .where(TileResult.fingerprint.in_(unique[start:start + FINGERPRINT_QUERY_CHUNK]))
+            .order_by(TileResult.id.desc())
+        ).all()
+        for fingerprint, result in rows:
+            if fingerprint not in known:
+                known[fingerprint] = TranscriptionOutputModel.model_validate_json(result)
+    return known
+
+class TileResults:
+    """Per-tile fingerprints and results of one transcription pass.
+
+    `plan` fingerprints the tiles and fills in results that can be reused (it can be called again to
+    add tiles to the pass), `add` records each freshly transcribed tile, and `save` replaces the run's
+    stored tiles. Needs an app context.
+    """
+    def __init__(self, reuse: bool = True):
+        self.reuse = reuse
+        self.boxes: List[Box] = []
+        self.fingerprints: List[str] = []
+        self.results: Dict[int, TranscriptionOutputModel] = {}
+        self.num_reused = 0
+
+    def plan(self, img: Image.Image, boxes: List[Box], encoder: TileEncoder) -> List[int]:
+        """Fingerprint `boxes` of `img`, appended to the pass's tiles, and return the indices of those that still need transcribing"""
+        salt = fingerprint_salt(encoder)
+        start = len(self.boxes)
+        fingerprints = [ tile_fingerprint(tile, salt) for tile in iter_blocks(img, boxes) ]
+        self.boxes.extend(boxes)
+        self.fingerprints.extend(fingerprints)
+        known = load_tile_results(fingerprints) if self.reuse else {}
+        for idx, fingerprint in enumerate(fingerprints, start):
+            if fingerprint in known:
+                self.results[idx] = known[fingerprint]
+                self.num_reused += 1
+        return [ idx for idx in range(start, len(self.boxes)) if idx not in self.results ]
+
+    def add(self, idx: int, result: Optional[TranscriptionOutputModel]) -> None:
+        # Tiles the model rejected (margins, legends, whitespace) are kept like valid ones, so they're not
+        # sent again on the next pass. Only tiles whose call failed are retried
+        if result is not None:
+            self.results[idx] = result
+
+    def save(self, run_id: int) -> None:
+        """Replace the run's stored tiles with this pass's, committed right away so a failed merge doesn't lose them"""
+        if not self.boxes:
+            return # The pass failed before its tiles were planned, keep the stored ones
+        db.session.execute(delete(TileResult).where(TileResult.run_id == run_id))
+        db.session.add_all([
+            TileResult(
+                run_id=run_id,
+                tile_index=idx,
+                box=json.dumps(list(self.boxes[idx])),
+                fingerprint=self.fingerprints[idx],
+                result=result.model_dump_json(),
+            )
+            for idx, result in sorted(self.results.items())
+        ])
+        db.session.commit()
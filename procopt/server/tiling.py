@@ -0,0 +1,133 @@
+from typing import Callable, Dict, List, Tuple
+import numpy as np
+from procopt.server.utils import BLANK_INK_THRESHOLD, Box, grid_boxes
+
+########################################################
+# Tiling strategies
+#
+# A strategy maps a grayscale image array (H x W, uint8) and a target tile
+# size to a list of boxes to crop and send to the vision model.
+########################################################
+
+TilingStrategy = Callable[[np.ndarray, int], List[Box]]
+
+OVERLAP_RATIO: float = 0.15 # Fraction of a tile shared with its neighbour in the overlapping grid
+CONTENT_DOWNSAMPLE: int = 4 # Content detection runs on a min-pooled image this many times smaller
+CONTENT_MIN_GAP: int = 60 # Whitespace (in full-resolution pixels) that separates two content regions
+CONTENT_MARGIN: int = 20 # Padding (in pixels) added around each detected content region
+
+def fixed_grid(gray: np.ndarray, block_size: int) -> List[Box]:
+    """Non-overlapping `block_size` grid (the original tiling)"""
+    height, width = gray.shape
+    return grid_boxes(width, height, block_size)
+
+def overlapping_grid(gray: np.ndarray, block_size: int, overlap: float = OVERLAP_RATIO) -> List[Box]:
+    """`block_size` tiles whose neighbours share `overlap` of their width/height, so boxes cut
+    by one tile boundary appear whole in the next tile"""
+    height, width = gray.shape
+    stride = max(1, int(block_size * (1 - overlap)))
+
+    def _starts(length: int) -> List[int]:
+        if length <= block_size:
+            return [0]
+        num_tiles = -(-(length - block_size) // stride) + 1
+        return np.linspace(0, length - block_size, num_tiles).round().astype(int).tolist()
+
+    return [
+        (left, upper, min(left + block_size, width), min(upper + block_size, height))
+        for upper in _starts(height)
+        for left in _starts(width)
+    ]
+
+def sliding_window_2x2(gray: np.ndarray, block_size: int) -> List[Box]:
+    """Windows of 2x2 `block_size` tiles, i.e. fewer, larger requests"""
+    height, width = gray.shape
+    return grid_boxes(width, height, 2 * block_size)
+
+def _content_runs(profile: np.ndarray, min_gap: int) -> List[Tuple[int, int]]:
+    """[start, end) runs of a boolean profile, merging runs separated by fewer than `min_gap` False entries"""
+    nonzero = np.flatnonzero(profile)
+    if nonzero.size == 0:
+        return []
+    breaks = np.flatnonzero(np.diff(nonzero) > min_gap)
+    starts = np.concatenate(([nonzero[0]], nonzero[breaks + 1]))
+    ends = np.concatenate((nonzero[breaks], [nonzero[-1]])) + 1
+    return list(zip(starts.tolist(), ends.tolist()))
+
+def _xy_cut(mask: np.ndarray, box: Box, min_gap: int) -> List[Box]:
+    """Recursive XY-cut: split `box` on horizontal then vertical whitespace gaps until no gap is left"""
+    left, upper, right, lower = box
+    rows = _content_runs(mask[upper:lower, left:right].any(axis=1), min_gap)
+    if not rows:
+        return []
+    if len(rows) > 1:
+        return [ region for start, end in rows for region in _xy_cut(mask, (left, upper + start, right, upper + end), min_gap) ]
+
+    upper, lower = upper + rows[0][0], upper + rows[0][1]
+    cols = _content_runs(mask[upper:lower, left:right].any(axis=0), min_gap)
+    if len(cols) > 1:
+        return [ region for start, end in cols for region in _xy_cut(mask, (left + start, upper, left + end, lower), min_gap) ]
+    return [(left + cols[0][0], upper, left + cols[0][1], lower)]
+
+def _even_grid(box: Box, block_size: int) -> List[Box]:
+    """Split `box` into the fewest equally-sized tiles no larger than `block_size` (avoids thin slivers)"""
+    left, upper, right, lower = box
+    num_w = -(-(right - left) // block_size)
+    num_h = -(-(lower - upper) // block_size)
+    xs = np.linspace(left, right, num_w + 1).round().astype(int).tolist()
+    ys = np.linspace(upper, lower, num_h + 1).round().astype(int).tolist()
+    return [ (xs[j], ys[i], xs[j + 1], ys[i + 1]) for i in range(num_h) for j in range(num_w) ]
+
+def _pack_regions(regions: List[Box], block_size: int) -> List[Box]:
+    """Greedily merge small regions whose combined bounding box still fits in one tile,
+    so scattered labels don't each cost a separate call"""
+    packed: List[Box] = []
+    for left, upper, right, lower in sorted(regions, key=lambda box: (box[1], box[0])):
+        for idx, (p_left, p_upper, p_right, p_lower) in enumerate(packed):
+            union = (min(left, p_left), min(upper, p_upper), max(right, p_right), max(lower, p_lower))
+            if union[2] - union[0] <= block_size and union[3] - union[1] <= block_size:
+                packed[idx] = union
+                break
+        else:
+            packed.append((left, upper, right, lower))
+    return packed
+
+def content_regions(gray: np.ndarray, block_size: int,
+                    ink_threshold: int = BLANK_INK_THRESHOLD,
+                    min_gap: int = CONTENT_MIN_GAP,
+                    margin: int = CONTENT_MARGIN) -> List[Box]:
+    """Crop to content: find ink regions with projection profiles (XY-cut) on a downsampled
+    ink mask, pad them, and grid any region larger than `block_size`"""
+    height, width = gray.shape
+    factor = CONTENT_DOWNSAMPLE
+    h, w = height // factor, width // factor
+    if h == 0 or w == 0:
+        return fixed_grid(gray, block_size)
+
+    # Min-pool so that thin lines survive downsampling
+    mask = gray[:h * factor, :w * factor].reshape(h, factor, w, factor).min(axis=(1, 3)) < ink_threshold
+
+    regions: List[Box] = []
+    for left, upper, right, lower in _xy_cut(mask, (0, 0, w, h), max(1, min_gap // factor)):
+        regions.append((
+            max(0, left * factor - margin), max(0, upper * factor - margin),
+            min(width, right * factor + margin), min(height, lower * factor + margin),
+        ))
+
+    boxes: List[Box] = []
+    for region in _pack_regions(regions, block_size):
+        boxes.extend(_even_grid(region, block_size))
+    return boxes
+
+TILING_STRATEGIES: Dict[str, TilingStrategy] = {
+    "grid": fixed_grid,
+    "overlap": overlapping_grid,
+    "sliding_window": sliding_window_2x2,
+    "content": content_regions,
+}
+DEFAULT_TILING_STRATEGY: str = "grid"
+
+def get_tiling_strategy(name: str) -> TilingStrategy:
+    if name not in TILING_STRATEGIES:
+        raise ValueError(f"Unknown tiling strategy `{name}`, expected one of {list(TILING_STRATEGIES)}")
+    return TILING_STRATEGIES[name]
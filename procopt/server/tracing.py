@@ -0,0 +1,205 @@
+import contextvars
+import json
+import os
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from datetime import datetime
+from typing import Any, Callable, Dict, Iterator, List, Optional
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+
+########################################################
+# Run traces
+#
+# Each pipeline step of a run is recorded as a trace: a tree of timed spans
+# (tile requests, encodes, LLM calls, merges, DB commits) with attributes such
+# as the tile index, bytes sent, tokens and model. The current span lives in a
+# context variable, so nested `span()` blocks find their parent without it
+# being passed around; work handed to executor threads keeps its parent when
+# wrapped with `in_current_context`. Outside a trace `span()` records nothing.
+#
+# Finished traces are appended to a JSON-lines file per run in TRACE_FOLDER
+# and served by /runs/<id>/trace, so a slow run can be picked apart after the fact.
+########################################################
+
+TRACE_MAX_SPANS: int = 20000 # Per trace; spans past the limit are counted but not kept
+
+_current_span: contextvars.ContextVar[Optional["Span"]] = contextvars.ContextVar("procopt_current_span", default=None)
+_store_lock = threading.Lock()
+
+class Span:
+    __slots__ = ("trace", "span_id", "parent_id", "name", "start", "end", "cpu_start", "cpu_end", "thread", "attributes", "error")
+
+    def __init__(self, trace: "Trace", name: str, parent_id: Optional[int], attributes: Dict[str, Any]):
+        self.trace = trace
+        self.span_id: Optional[int] = None
+        self.parent_id = parent_id
+        self.name = name
+        self.start = time.perf_counter()
+        self.end: Optional[float] = None
+        self.cpu_start = time.thread_time() # CPU time of this span's thread, including child spans on the same thread
+        self.cpu_end: Optional[float] = None
+        self.thread = threading.current_thread().name
+        self.attributes = attributes
+        self.error: Optional[str] = None
+
+    def set(self, **attributes) -> None:
+        self.attributes.update(attributes)
+
+    def finish(self) -> None:
+        self.end = time.perf_counter()
+        self.cpu_end = time.thread_time()
+
+    def to_dict(self, origin: float) -> Dict[str, Any]:
+        return {
+            "id": self.span_id,
+            "parent_id": self.parent_id,
+            "name": self.name,
+            "start_ms": round((self.start - origin) * 1000, 3),
+            "duration_ms": round(((self.end or self.start) - self.start) * 1000, 3),
+            "cpu_ms": round(((self.cpu_end or self.cpu_start) - self.cpu_start) * 1000, 3),
+            "thread": self.thread,
+            "attributes": self.attributes,
+            "error": self.error,
+        }
+
+class _NoopSpan:
+    """Stand-in yielded by `span()` outside a trace"""
+    def set(self, **attributes) -> None:
+        pass
+
+NOOP_SPAN = _NoopSpan()
+
+class Trace:
+    def __init__(self, name: str, max_spans: int = TRACE_MAX_SPANS, **attributes):
+        self.trace_id = uuid.uuid4().hex
+        self.name = name
+        self.started_at = datetime.utcnow()
+        self.origin = time.perf_counter()
+        self.max_spans = max_spans
+        self.attributes = attributes
+        self.spans: List[Span] = []
+        self.num_dropped = 0
+        self._lock = threading.Lock()
+
+    def add(self, span: Span) -> None:
+        with self._lock:
+            if len(self.spans) >= self.max_spans:
+                self.num_dropped += 1
+                return
+            span.span_id = len(self.spans) + 1
+            self.spans.append(span)
+
+    def to_dict(self) -> Dict[str, Any]:
+        with self._lock:
+            spans = sorted(self.spans, key=lambda span: span.start)
+        root = spans[0] if spans else None
+        return {
+            "trace_id": self.trace_id,
+            "name": self.name,
+            "started_at": self.started_at.isoformat() + "Z",
+            "duration_ms": round(((root.end or root.start) - root.start) * 1000, 3) if root else 0,
+            "attributes": self.attributes,
+            "spans": [ span.to_dict(self.origin) for span in spans ],
+            "spans_dropped": self.num_dropped,
+        }
+
+@contextmanager
+def span(name: str, **attributes) -> Iterator[Any]:
+    """Time the `with` block as a child of the current span. Yields the span so attributes can be added with `.set()`"""
+    parent = _current_span.get()
+    if parent is None:
+        yield NOOP_SPAN
+        return
+    current = Span(parent.trace, name, parent.span_id, attributes)
+    parent.trace.add(current)
+    token = _current_span.set(current)
+    try:
+        yield current
+    except BaseException as e:
+        current.error = f"{type(e).__name__}: {str(e)}"
+        raise
+    finally:
+        current.finish()
+        _current_span.reset(token)
+
+@contextmanager
+def start_trace(name: str, enabled: bool = True, **attributes) -> Iterator[Optional[Trace]]:
+    """Record spans opened inside the `with` block into a new trace, rooted at a span called `name`.
+    Yields the trace, or None if `enabled` is False"""
+    if not enabled:
+        yield None
+        return
+    trace = Trace(name, **attributes)
+    root = Span(trace, name, None, dict(attributes))
+    trace.add(root)
+    token = _current_span.set(root)
+    try:
+        yield trace
+    except BaseException as e:
+        root.error = f"{type(e).__name__}: {str(e)}"
+        raise
+    finally:
+        root.finish()
+        _current_span.reset(token)
+
+def in_current_context(fn: Callable) -> Callable:
+    """Wrap `fn` to run with the caller's current span, e.g. when submitted to an executor thread"""
+    context = contextvars.copy_context()
+    def _run(*args, **kwargs):
+        # A context can only be entered by one thread at a time, so each call gets its own copy
+        return context.copy().run(fn, *args, **kwargs)
+    return _run
+
+@event.listens_for(Session, "before_commit")
+def _before_commit(session: Session) -> None:
+    if _current_span.get() is not None:
+        session.info["trace_commit_start"] = (time.perf_counter(), time.thread_time())
+
+@event.listens_for(Session, "after_commit")
+def _after_commit(session: Session) -> None:
+    parent = _current_span.get()
+    start = session.info.pop("trace_commit_start", None)
+    if parent is None or start is None:
+        return
+    commit = Span(parent.trace, "db_commit", parent.span_id, {})
+    commit.start, commit.cpu_start = start
+    commit.finish()
+    parent.trace.add(commit)
+
+def trace_path(folder: str, run_id: int) -> str:
+    return os.path.join(folder, f"run_{run_id}.jsonl")
+
+def save_trace(folder: str, run_id: int, trace: Trace) -> None:
+    """Append `trace` to the run's trace file"""
+    os.makedirs(folder, exist_ok=True)
+    line = json.dumps(trace.to_dict(), default=str)
+    with _store_lock, open(trace_path(folder, run_id), "a", encoding="utf-8") as f:
+        f.write(line + "\n")
+
+def load_traces(folder: str, run_id: int) -> List[Dict[str, Any]]:
+    """The run's traces, oldest first"""
+    path = trace_path(folder, run_id)
+    if not os.path.exists(path):
+        return []
+    with open(path, encoding="utf-8") as f:
+        return [ json.loads(line) for line in f if line.strip() ]
+
+def to_chrome_trace(traces: List[Dict[str, Any]]) -> Dict[str, Any]:
+    """Traces in the Chrome trace event format, for chrome://tracing or ui.perfetto.dev"""
+    events: List[Dict[str, Any]] = []
+    for trace in traces:
+        offset_us = datetime.fromisoformat(trace["started_at"].rstrip("Z")).timestamp() * 1e6
+        for span in trace["spans"]:
+            events.append({
+                "name": span["name"],
+                "ph": "X",
+                "ts": round(offset_us + span["start_ms"] * 1000),
+                "dur": round(span["duration_ms"] * 1000),
+                "pid": trace["attributes"].get("step", trace["name"]),
+                "tid": span["thread"],
+                "args": { **span["attributes"], **({ "error": span["error"] } if span["error"] else {}) },
+            })
+    return { "traceEvents": events, "displayTimeUnit": "ms" }
@@ -1,8 +1,14 @@
 import base64
+import multiprocessing
 import os
 import re
-from typing import List
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+from typing import Dict, Iterator, List, Optional, Tuple
 import fitz
+import numpy as np
 from PIL import Image
 import io
 from procopt.server.prompt_models import TranscriptionOutputModel
@@ -22,26 +28,155 @@ def remove_markdown(text: str):
     text = re.sub(r'(`+|~+)', '', text)
     return text
 
-def convert_pdf_to_png(path_to_pdf: str) -> str:
-    """Convert first page of PDF to PNG and return the path to the PNG file"""
-    doc = fitz.open(path_to_pdf)
-    page = doc[0]
-    pix = page.get_pixmap(matrix=fitz.Matrix(300/72, 300/72))  # 300 DPI
-    path_to_png = os.path.splitext(path_to_pdf)[0] + '.png'
-    pix.save(path_to_png)
-    doc.close()
-    
-    return path_to_png
+# PDF rasterization. Pages are rendered at the highest DPI (up to PDF_MAX_DPI) that keeps
+# the page within PDF_PIXEL_BUDGET pixels, so poster-sized pages don't explode in memory.
+PDF_MAX_DPI: int = 300
+PDF_MIN_DPI: int = 72
+PDF_PIXEL_BUDGET: int = 40_000_000
+RASTERIZE_WORKERS: int = int(os.getenv("RASTERIZE_WORKERS", os.cpu_count() or 1))
 
-def split_image_into_blocks(image_bytes: bytes, block_size: int = 500) -> List[Image.Image]:
-    """Split image into blocks of specified size"""
-    img = Image.open(io.BytesIO(image_bytes))
+_rasterize_pool: Optional[ProcessPoolExecutor] = None
+_rasterize_pool_lock = threading.Lock()
 
-    if img.mode != 'RGB':
-        img = img.convert('RGB')
-    
-    width, height = img.size
-    blocks = []
+def count_pdf_pages(path_to_pdf: str) -> int:
+    with fitz.open(path_to_pdf) as doc:
+        return doc.page_count
+
+def pdf_page_image_path(path_to_pdf: str, page_number: int) -> str:
+    """Path of the PNG rendered for (0-indexed) `page_number` of a PDF"""
+    return f"{os.path.splitext(path_to_pdf)[0]}_page{page_number + 1}.png"
+
+def adaptive_dpi(width_pt: float, height_pt: float, pixel_budget: int = PDF_PIXEL_BUDGET,
+                 max_dpi: int = PDF_MAX_DPI, min_dpi: int = PDF_MIN_DPI) -> int:
+    """Highest DPI <= `max_dpi` at which a page of the given size (in points) fits in `pixel_budget` pixels"""
+    area_sq_in = max(1e-6, (width_pt / 72) * (height_pt / 72))
+    return int(max(min_dpi, min(max_dpi, (pixel_budget / area_sq_in) ** 0.5)))
+
+def rasterize_pdf_page(path_to_pdf: str, page_number: int, path_to_png: str,
+                       pixel_budget: int = PDF_PIXEL_BUDGET, max_dpi: int = PDF_MAX_DPI) -> Dict:
+    """Render one PDF page to PNG at an adaptive DPI. Runs in the rasterization process pool"""
+    start = time.perf_counter()
+    with fitz.open(path_to_pdf) as doc:
+        page = doc[page_number]
+        dpi = adaptive_dpi(page.rect.width, page.rect.height, pixel_budget, max_dpi)
+        pix = page.get_pixmap(matrix=fitz.Matrix(dpi / 72, dpi / 72))
+        pix.save(path_to_png)
+        return {
+            "page_number": page_number,
+            "page_count": doc.page_count,
+            "dpi": dpi,
+            "image_size": [pix.width, pix.height],
+            "rasterize_seconds": round(time.perf_counter() - start, 3),
+        }
+
+def get_rasterize_pool() -> ProcessPoolExecutor:
+    """Process pool shared by all runs for rasterizing PDF pages off the request path"""
+    global _rasterize_pool
+    with _rasterize_pool_lock:
+        if _rasterize_pool is None:
+            # spawn: forking a process that already runs worker threads is unsafe
+            _rasterize_pool = ProcessPoolExecutor(max_workers=RASTERIZE_WORKERS, mp_context=multiprocessing.get_context("spawn"))
+    return _rasterize_pool
+
+Box = Tuple[int, int, int, int] # (left, upper, right, lower) in pixels
+
+# Blank tile detection. A tile is blank if almost none of its pixels are "ink"
+# (darker than BLANK_INK_THRESHOLD) or its intensity barely varies.
+BLANK_INK_THRESHOLD: int = 200
+BLANK_MIN_INK_RATIO: float = 0.001
+BLANK_MIN_STD: float = 2.0
+
+# Process-wide cap on memory held by decoded images and in-flight tiles across concurrent runs
+IMAGE_MEMORY_BUDGET: int = int(os.getenv("IMAGE_MEMORY_BUDGET_MB", 1024)) * 1024 * 1024
+
+class MemoryBudget:
+    """Counting budget (in bytes) shared by all runs. `reserve()` blocks until enough of the
+    budget is free, so peak memory stays bounded no matter how many maps are processed at once."""
+    def __init__(self, limit: int):
+        self.limit = limit
+        self.used = 0
+        self._cond = threading.Condition()
+
+    @contextmanager
+    def reserve(self, nbytes: int):
+        # A reservation larger than the whole budget waits until it has the budget to itself
+        nbytes = min(nbytes, self.limit)
+        with self._cond:
+            self._cond.wait_for(lambda: self.used + nbytes <= self.limit)
+            self.used += nbytes
+        try:
+            yield
+        finally:
+            with self._cond:
+                self.used -= nbytes
+                self._cond.notify_all()
+
+image_memory_budget = MemoryBudget(IMAGE_MEMORY_BUDGET)
+
+GRAYSCALE_BYTES_PER_PIXEL: int = 3 # `to_grayscale` briefly holds the L image, its bytes and the array
+SCORE_BYTES_PER_PIXEL: int = 10 # `score_boxes` briefly holds an int64 integral image and the squared pixels
+JPEG_DRAFT_SCALES: Tuple[int, ...] = (8, 4, 2) # Reductions libjpeg can decode at directly
+
+def decoded_bytes_per_pixel(mode: str) -> int:
+    """Bytes per pixel of a decoded PIL image in `mode`. PIL pads RGB (and other multi-band modes) to 32 bits"""
+    if mode in ("1", "L", "P"):
+        return 1
+    if mode.startswith("I;16"):
+        return 2
+    return 4
+
+def decode_peak_bytes(width: int, height: int, mode: str, image_format: Optional[str], factor: int) -> int:
+    """Peak memory of `open_image_reduced(path, factor)` followed by `to_grayscale` and `score_boxes`.
+
+    Only JPEGs decode straight to (close to) the reduced size; every other format is decoded at full
+    resolution first, so that full-size image is what the peak is made of."""
+    bytes_per_pixel = decoded_bytes_per_pixel(mode)
+    target_width, target_height = max(1, width // factor), max(1, height // factor)
+    scale = 1
+    if image_format == 'JPEG':
+        scale = next((scale for scale in JPEG_DRAFT_SCALES if scale <= factor), 1)
+    decoded_width, decoded_height = -(-width // scale), -(-height // scale)
+    decode_pixels = decoded_width * decoded_height
+    if decoded_width != target_width:
+        decode_pixels += target_width * target_height
+        if decoded_width % target_width:
+            decode_pixels += target_width * decoded_height # `resize()` makes a horizontal pass first
+    # Scoring runs with the reduced image and its grayscale array (1 byte per pixel) held
+    return max(decode_pixels * bytes_per_pixel,
+               target_width * target_height * (bytes_per_pixel + max(GRAYSCALE_BYTES_PER_PIXEL, 1 + SCORE_BYTES_PER_PIXEL)))
+
+def reduction_factor(width: int, height: int, bytes_per_pixel: int, max_bytes: int) -> int:
+    """Smallest integer downscale factor for which the decoded image fits in `max_bytes`"""
+    factor = 1
+    while (width // factor) * (height // factor) * bytes_per_pixel > max_bytes:
+        factor += 1
+    return factor
+
+def open_image_reduced(path: str, factor: int = 1) -> Image.Image:
+    """Decode an image at 1/`factor` resolution. JPEGs are decoded directly at reduced size
+    (DCT scaling via `draft`, by 1/2, 1/4 or 1/8); other formats are decoded fully and then reduced.
+    See `decode_peak_bytes` for the memory this takes."""
+    img = Image.open(path)
+    if factor > 1:
+        target = (max(1, img.width // factor), max(1, img.height // factor))
+        if img.format == 'JPEG':
+            img.draft(img.mode, target)
+        if img.width % target[0] == 0 and img.width > target[0]:
+            img = img.reduce(img.width // target[0])
+        elif img.size != target:
+            img = img.resize(target, Image.Resampling.BOX) # Non-integer ratio left by `draft`, same box averaging as `reduce()`
+    img.load()
+    return img
+
+def iter_blocks(img: Image.Image, boxes: List[Box]) -> Iterator[Image.Image]:
+    """Lazily crop `boxes` out of `img`, one RGB tile at a time"""
+    for box in boxes:
+        block = img.crop(box)
+        yield block if block.mode == 'RGB' else block.convert('RGB')
+
+def grid_boxes(width: int, height: int, block_size: int) -> List[Box]:
+    """Row-major grid of `block_size` boxes covering a `width` x `height` image"""
+    boxes = []
     
     num_blocks_w = (width + block_size - 1) // block_size
     num_blocks_h = (height + block_size - 1) // block_size
@@ -52,8 +187,60 @@ def split_image_into_blocks(image_bytes: bytes, block_size: int = 500) -> List[I
             upper = i * block_size
             right = min(left + block_size, width)
             lower = min(upper + block_size, height)
-            
-            block = img.crop((left, upper, right, lower))
-            blocks.append(block)
+            boxes.append((left, upper, right, lower))
     
-    return blocks
+    return boxes
+
+def _box_sums(values: np.ndarray, corners: np.ndarray, max_value: int) -> np.ndarray:
+    """Sum of `values` (each at most `max_value`) inside each (left, upper, right, lower) row of `corners`,
+    from an integral image built in place. Corners on the top or left edge read as 0"""
+    dtype = np.int32 if max_value * values.size < 2 ** 31 else np.int64
+    integral = values.astype(dtype)
+    np.cumsum(integral, axis=0, out=integral)
+    np.cumsum(integral, axis=1, out=integral)
+
+    def _at(ys: np.ndarray, xs: np.ndarray) -> np.ndarray:
+        return np.where((ys > 0) & (xs > 0), integral[np.maximum(ys - 1, 0), np.maximum(xs - 1, 0)], 0).astype(np.int64)
+
+    left, upper, right, lower = corners.T
+    return _at(lower, right) - _at(upper, right) - _at(lower, left) + _at(upper, left)
+
+def score_boxes(gray: np.ndarray, boxes: List[Box], ink_threshold: int = BLANK_INK_THRESHOLD) -> Tuple[np.ndarray, np.ndarray]:
+    """Return (ink ratio, intensity std) for each box of a grayscale image array.
+    Each statistic comes from one integral image over the whole array, so the cost doesn't grow with the
+    number or overlap of boxes. Boxes are clipped to the image, like slicing would"""
+    height, width = gray.shape
+    corners = np.array(boxes, dtype=np.int64).reshape(-1, 4)
+    corners[:, [0, 2]] = np.clip(corners[:, [0, 2]], 0, width)
+    corners[:, [1, 3]] = np.clip(corners[:, [1, 3]], 0, height)
+    corners[:, 2] = np.maximum(corners[:, 2], corners[:, 0]) # Inverted boxes are empty, like inverted slices
+    corners[:, 3] = np.maximum(corners[:, 3], corners[:, 1])
+    areas = (corners[:, 2] - corners[:, 0]) * (corners[:, 3] - corners[:, 1])
+
+    # One integral at a time, so at most one is held alongside its input
+    ink = _box_sums(gray < ink_threshold, corners, 1)
+    total = _box_sums(gray, corners, 255)
+    squares = _box_sums(np.square(gray, dtype=np.uint16), corners, 255 ** 2) # Squares still fit in 16 bits
+
+    nonempty = areas > 0
+    ink_ratios = np.divide(ink, areas, out=np.zeros(len(areas)), where=nonempty)
+    means = np.divide(total, areas, out=np.zeros(len(areas)), where=nonempty)
+    variances = np.divide(squares, areas, out=np.zeros(len(areas)), where=nonempty) - means ** 2
+    return ink_ratios, np.sqrt(np.maximum(variances, 0.0))
+
+def to_grayscale(img: Image.Image) -> np.ndarray:
+    """H x W uint8 grayscale array of an image"""
+    return np.asarray(img.convert('L'))
+
+def find_blank_boxes(gray: np.ndarray, boxes: List[Box],
+                     ink_threshold: int = BLANK_INK_THRESHOLD,
+                     min_ink_ratio: float = BLANK_MIN_INK_RATIO,
+                     min_std: float = BLANK_MIN_STD) -> np.ndarray:
+    """Boolean mask over `boxes`, True where the box is blank or near-empty"""
+    ink_ratios, stds = score_boxes(gray, boxes, ink_threshold)
+    return (ink_ratios < min_ink_ratio) | (stds < min_std)
+
+def split_image_into_blocks(image_bytes: bytes, block_size: int = 500) -> Iterator[Image.Image]:
+    """Lazily split image into blocks of specified size"""
+    img = Image.open(io.BytesIO(image_bytes))
+    return iter_blocks(img, grid_boxes(img.width, img.height, block_size))
@@ -0,0 +1,62 @@
+from typing import List, NamedTuple, Tuple
+import fitz
+from procopt.server.utils import Box
+
+########################################################
+# Vector-text fast path
+#
+# Maps exported from Visio/Lucid/etc. are vector PDFs whose text layer already
+# holds every label. Instead of OCR-by-vision on each tile, the page's text
+# blocks (with positions) are sent to the LLM as a compact textual layout in a
+# single text-only call. Only tiles that hold no extractable text but overlap
+# an embedded raster image (a pasted screenshot or scan) still go to the
+# vision model; vector shapes and connectors carry no text of their own.
+########################################################
+
+# (x0, y0, x1, y1) in fractions of the page size
+Region = Tuple[float, float, float, float]
+TextBlock = Tuple[Region, str]
+
+VECTOR_TEXT_MIN_CHARS: int = 20 # Pages with less extractable text than this (e.g. scans) use the vision path only
+
+class PageLayout(NamedTuple):
+    text_blocks: List[TextBlock] # In reading order
+    image_regions: List[Region] # Embedded raster images
+
+def extract_page_layout(path_to_pdf: str, page_number: int = 0) -> PageLayout:
+    """Text blocks and embedded image regions of a PDF page, with page-relative coordinates"""
+    with fitz.open(path_to_pdf) as doc:
+        page = doc[page_number]
+        width, height = page.rect.width, page.rect.height
+        text_blocks: List[TextBlock] = []
+        for x0, y0, x1, y1, text, _, block_type in page.get_text("blocks", sort=True):
+            text = " ".join(text.split())
+            if block_type != 0 or not text:
+                continue
+            text_blocks.append(((x0 / width, y0 / height, x1 / width, y1 / height), text))
+        image_regions: List[Region] = [
+            (x0 / width, y0 / height, x1 / width, y1 / height)
+            for x0, y0, x1, y1 in (info["bbox"] for info in page.get_image_info())
+        ]
+    return PageLayout(text_blocks, image_regions)
+
+def has_text_layer(layout: PageLayout, min_chars: int = VECTOR_TEXT_MIN_CHARS) -> bool:
+    return sum(len(text) for _, text in layout.text_blocks) >= min_chars
+
+def format_text_layout(text_blocks: List[TextBlock]) -> str:
+    """One line per block: its position as percentages of the page, then its text"""
+    return "\n".join(
+        f"[x={100 * x0:.0f}-{100 * x1:.0f}%, y={100 * y0:.0f}-{100 * y1:.0f}%] {text}"
+        for (x0, y0, x1, y1), text in text_blocks
+    )
+
+def vision_boxes(boxes: List[Box], layout: PageLayout, width: int, height: int) -> List[Box]:
+    """Boxes (in pixels of a `width` x `height` render of the page) the text layer doesn't cover:
+    no text block centre inside, but overlapping an embedded image"""
+    centres = [ ((x0 + x1) / 2 * width, (y0 + y1) / 2 * height) for (x0, y0, x1, y1), _ in layout.text_blocks ]
+    images = [ (x0 * width, y0 * height, x1 * width, y1 * height) for x0, y0, x1, y1 in layout.image_regions ]
+    return [
+        (left, upper, right, lower) for left, upper, right, lower in boxes
+        if not any(left <= x < right and upper <= y < lower for x, y in centres)
+        and any(x0 < right and left < x1 and y0 < lower and upper < y1 for x0, y0, x1, y1 in images)
+    ]